@@ -0,0 +1,93 @@
+'''
+Decode a flight recorder file written by TkLights.py or LightsService.py.
+
+Usage:
+python DecodeFlightRecord.py flight-20170520-101500-sequence.hfr [...]
+
+Prints one line for each event, oldest first, with the wall clock time, the time since the previous event in
+milliseconds and a description of the event.
+'''
+import sys
+import datetime
+
+from LightsCore import FlightRecorder
+from LightsCore import FR_RELAY_QUEUED, FR_PACKET_WRITTEN, FR_PORT_READ, FR_SESSION_STATE, FR_SEQUENCE_STARTED, \
+    FR_STEP_STARTED, FR_SEQUENCE_FINISHED, FR_SEQUENCE_RESET, FR_UI_COMMAND, FR_CRASH
+
+SESSION_STATES = {0: "disconnected", 1: "reconnecting", 2: "connected"}
+
+UI_COMMANDS = ["lights off", "one light", "two lights", "three lights", "four lights", "five lights",
+    "flashing one light", "start sequence", "reset sequence", "quit"]
+
+
+def relayDescription(value):
+    '''
+    The relays as a string of 1s and 0s, relay 1 on the left
+    '''
+    return "".join([str((value >> relay) & 1) for relay in range(5)])
+
+
+def describeEvent(eventType, value, extra):
+    if eventType == FR_RELAY_QUEUED:
+        return "relay queued %s" % relayDescription(value)
+    elif eventType == FR_PACKET_WRITTEN:
+        if chr(value) == 'C':
+            return "packet written C + %s" % relayDescription(extra)
+        return "packet written %s + %i" % (chr(value), extra)
+    elif eventType == FR_PORT_READ:
+        if extra:
+            return "port read, no reply"
+        return "port read %s" % relayDescription(value)
+    elif eventType == FR_SESSION_STATE:
+        return "session %s" % SESSION_STATES.get(value, value)
+    elif eventType == FR_SEQUENCE_STARTED:
+        return "sequence started, %i events" % extra
+    elif eventType == FR_STEP_STARTED:
+        return "step %i started" % extra
+    elif eventType == FR_SEQUENCE_FINISHED:
+        return "sequence finished"
+    elif eventType == FR_SEQUENCE_RESET:
+        return "sequence reset"
+    elif eventType == FR_UI_COMMAND:
+        if value < len(UI_COMMANDS):
+            return "button %s" % UI_COMMANDS[value]
+        return "button %i" % value
+    elif eventType == FR_CRASH:
+        return "CRASH"
+    return "unknown event %i %i %i" % (eventType, value, extra)
+
+
+def decodeFile(fileName):
+    with open(fileName, 'rb') as recordFile:
+        data = recordFile.read()
+
+    magic, recordSize, count, wallTime, monotonicAtFlush = FlightRecorder.HEADER.unpack_from(data)
+    if magic != FlightRecorder.MAGIC or recordSize != FlightRecorder.RECORD.size:
+        print("%s is not a flight recorder file we understand" % fileName)
+        return
+
+    print("%s: %i events, written %s" % (fileName, count, datetime.datetime.fromtimestamp(wallTime)))
+
+    previousNanoseconds = None
+    for recordNumber in range(count):
+        offset = FlightRecorder.HEADER.size + recordNumber * recordSize
+        nanoseconds, eventType, value, extra = FlightRecorder.RECORD.unpack_from(data, offset)
+
+        # the monotonic clock has no epoch, so we work back from the time the file was written
+        eventTime = datetime.datetime.fromtimestamp(wallTime - (monotonicAtFlush - nanoseconds / 1e9))
+        if previousNanoseconds is None:
+            delta = 0.0
+        else:
+            delta = (nanoseconds - previousNanoseconds) / 1e6
+        previousNanoseconds = nanoseconds
+
+        print("%s %+10.3f ms  %s" % (eventTime.strftime("%H:%M:%S.%f"), delta, describeEvent(eventType, value, extra)))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: %s [flight recorder file] ..." % sys.argv[0])
+        sys.exit(1)
+
+    for fileName in sys.argv[1:]:
+        decodeFile(fileName)
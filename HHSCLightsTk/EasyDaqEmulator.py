@@ -0,0 +1,212 @@
+'''
+Software emulator for the EasyDaq USB relay card.
+
+Usage:
+-l [file to log received bytes to] -d [number of silent decoy ports to create, default 0]
+
+This lets us run the race lights without the physical relay card. The emulator opens a Linux pseudo-terminal and
+speaks the EasyDaq protocol on it, so pyserial can open the pseudo-terminal just like the real port. Run it, then
+pass the port name it prints to the lights application, e.g.
+
+python EasyDaqEmulator.py
+python TkLights.py -p /dev/pts/3 -t 10
+
+The emulator understands the three packets we use:
+
+B + byte - configure the port direction
+C + byte - set the relay outputs
+A + byte - read back the relay outputs. The emulator replies with a single byte.
+
+Every byte received is recorded with a monotonic timestamp, as is every change to the relay outputs, so tests
+and benchmarks can compare when the lights actually changed with when they should have changed.
+
+SilentSerialPort is a pseudo-terminal that never replies, standing in for the other serial devices the lights
+application has to ignore when it looks for the card. Run the emulator with -d to create some, then pass all the
+port names to the application, e.g.
+
+python EasyDaqEmulator.py -d 3
+python TkLights.py -p /dev/pts/3,/dev/pts/4,/dev/pts/5,/dev/pts/6
+
+The emulator uses the pty module, so only runs on Linux (and other Unix systems).
+'''
+import os
+import pty
+import tty
+import select
+import threading
+import time
+import logging
+import sys
+import getopt
+
+#
+# Use the same clock as the lights application, so that timestamps can be compared. Run on its own, without
+# pyserial or under Python 3, there is nothing to compare with, so any monotonic clock will do.
+#
+try:
+    from LightsCore import monotonicTime
+except ImportError:
+    monotonicTime = getattr(time, 'monotonic', time.time)
+
+# the packets the EasyDaq card understands. Each is a command character followed by a single byte.
+READ_PORT = 'A'
+CONFIGURE_PORT = 'B'
+WRITE_PORT = 'C'
+
+
+class EasyDaqEmulator(object):
+
+    def __init__(self, logFileName=None):
+        #
+        # open our pseudo-terminal. We read and write on the master side, and the application opens the slave
+        # side by name. The slave is in raw mode so that bytes pass through untouched.
+        #
+        self.masterFd, self.slaveFd = pty.openpty()
+        tty.setraw(self.slaveFd)
+        self.portName = os.ttyname(self.slaveFd)
+
+        # the state of the card
+        self.portDirection = 0
+        self.outputState = 0
+
+        #
+        # Every byte we receive as a tuple of timestamp and byte, and every relay change as a tuple of the timestamp
+        # of the packet's last byte and the new output state.
+        #
+        self.receivedBytes = []
+        self.relayChanges = []
+        self.lock = threading.Lock()
+
+        # the command character of a packet when we are waiting for its byte
+        self.pendingCommand = None
+
+        self.logFile = None
+        if logFileName:
+            self.logFile = open(logFileName, 'w')
+
+        self.isRunning = False
+        self.thread = None
+
+    def start(self):
+        self.isRunning = True
+        self.thread = threading.Thread(target=self.run, name="EasyDaqEmulator")
+        self.thread.daemon = True
+        self.thread.start()
+        logging.info("EasyDaq emulator listening on %s" % self.portName)
+
+    def stop(self):
+        self.isRunning = False
+        if self.thread:
+            self.thread.join(2.0)
+        os.close(self.masterFd)
+        os.close(self.slaveFd)
+        if self.logFile:
+            self.logFile.close()
+
+    def run(self):
+        while self.isRunning:
+            # wait for data, waking up regularly to check whether we've been stopped
+            readable, _, _ = select.select([self.masterFd], [], [], 0.1)
+            if not readable:
+                continue
+
+            try:
+                data = os.read(self.masterFd, 64)
+            except OSError:
+                # the application has closed the port. Keep listening in case it reopens.
+                time.sleep(0.1)
+                continue
+
+            receivedTime = monotonicTime()
+            for aByte in data:
+                self.receiveByte(receivedTime, aByte)
+
+    def receiveByte(self, receivedTime, aByte):
+        with self.lock:
+            self.receivedBytes.append((receivedTime, aByte))
+
+        if self.logFile:
+            self.logFile.write("%.6f %02x\n" % (receivedTime, ord(aByte)))
+
+        if self.pendingCommand is None:
+            if aByte in (READ_PORT, CONFIGURE_PORT, WRITE_PORT):
+                self.pendingCommand = aByte
+            else:
+                logging.warning("EasyDaq emulator ignoring unexpected byte %02x" % ord(aByte))
+        else:
+            self.processPacket(receivedTime, self.pendingCommand, ord(aByte))
+            self.pendingCommand = None
+
+    def processPacket(self, receivedTime, command, value):
+        if command == CONFIGURE_PORT:
+            logging.debug("EasyDaq emulator port direction %i" % value)
+            self.portDirection = value
+        elif command == WRITE_PORT:
+            logging.debug("EasyDaq emulator relays %i" % value)
+            with self.lock:
+                self.outputState = value
+                self.relayChanges.append((receivedTime, value))
+        elif command == READ_PORT:
+            os.write(self.masterFd, chr(self.outputState))
+
+    def receivedLog(self):
+        '''
+        Return a copy of the bytes received so far
+        '''
+        with self.lock:
+            return list(self.receivedBytes)
+
+    def relayChangeLog(self):
+        '''
+        Return a copy of the relay changes so far
+        '''
+        with self.lock:
+            return list(self.relayChanges)
+
+
+class SilentSerialPort(object):
+    '''
+    A pseudo-terminal that accepts whatever is written to it and never replies
+    '''
+    def __init__(self):
+        self.masterFd, self.slaveFd = pty.openpty()
+        tty.setraw(self.slaveFd)
+        self.portName = os.ttyname(self.slaveFd)
+
+    def stop(self):
+        os.close(self.masterFd)
+        os.close(self.slaveFd)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+        format = "%(levelname)s:%(asctime)-15s %(message)s")
+
+    logFileName = None
+    numberDecoys = 0
+    myopts, args = getopt.getopt(sys.argv[1:],"l:d:",["log=","decoys="])
+    for o, a in myopts:
+        if o in ('-l','--log'):
+            logFileName = a
+        elif o in ('-d','--decoys'):
+            numberDecoys = int(a)
+
+    emulator = EasyDaqEmulator(logFileName)
+    emulator.start()
+    print("EasyDaq emulator running on %s. Press Ctrl-C to stop." % emulator.portName)
+
+    decoys = [SilentSerialPort() for decoy in range(numberDecoys)]
+    for decoy in decoys:
+        print("Silent decoy port on %s" % decoy.portName)
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+
+    emulator.stop()
+    for decoy in decoys:
+        decoy.stop()
+    for changeTime, value in emulator.relayChangeLog():
+        print("%.6f C + %i" % (changeTime, value))
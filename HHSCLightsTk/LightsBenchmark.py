@@ -0,0 +1,327 @@
+'''
+Timing accuracy benchmark for the race start sequences.
+
+Usage:
+-s [maximum number of starts, default 6] -t [test speed ratio, default 60] -c (class flag sequence, default is F flag)
+-e (write to the EasyDaq emulator rather than straight to a recording sink) -p [serial port of a real relay card]
+-v (read back every relay change) -o [file to write the JSON results to, default is stdout]
+-d [number of silent decoy ports, with -e] -g [number of emulated cards in a relay group, with -e, default 1]
+-x (run against a virtual clock, without -e or -p)
+
+The steps run testSpeedRatio times faster than real time, and so do the flashing lights, down to a toggle every
+150 ms, a little slower than the card takes packets. At the default of 60, each 30 second flashing step is half a
+second long and has three toggles to time, where toggling at the real rate would leave it one.
+
+Runs StartRaceSequence headless, on a LightsCore event loop rather than Tk, for 1 start up to the maximum number of starts. For every step
+and every flash we record when the relay change was meant to happen and when it actually happened, and report the
+p50, p99 and maximum error in milliseconds as JSON, so that changes to the scheduler can be compared.
+
+By default the relay changes go to a recording sink, which measures the scheduler on its own. With -e the changes go
+through EasyDaqUSBRelay and its I/O thread to the EasyDaq emulator, and we time them as the emulator receives them.
+With -p they go to a real card, and we can only time them as they are handed to EasyDaqUSBRelay.
+
+With -d the relay isn't told the emulator's port. It has to find it amongst the decoy ports, which never reply, as
+it would at startup without -p. The time from connecting to the session being ready is reported as connectSeconds.
+
+With -g the changes go to a group of emulated cards through EasyDaqRelayGroup. We time them as the first card
+receives them, and report the skew between the cards, both as the emulators saw it and as the group measured it,
+and the group's signed error against each change's deadline.
+
+With -x the sequence runs against a virtual clock, which jumps from one relay change to the next without waiting,
+so the sequences run thousands of times faster than real time. This checks the timeline rather than the timing:
+every change should be on time, to within the millisecond resolution of after. The wall clock time taken is
+reported as elapsedSeconds.
+'''
+import datetime
+import time
+import json
+import logging
+import sys
+import getopt
+import random
+
+import LightsCore
+from LightsCore import monotonicTime
+
+# the shortest time between toggles of flashing lights when we speed them up. The relay paces its packets 100 ms
+# apart, so any faster and we would be timing the pacing rather than the scheduler.
+MINIMUM_FLASH_INTERVAL_SECONDS = 0.15
+
+# how long the flashing step of each start lasts in real time
+FLASHING_STEP_SECONDS = 30
+
+
+def benchmarkFlashInterval(speedRatio):
+    '''
+    Return the time between toggles of the flashing lights, sped up by speedRatio but no shorter than
+    MINIMUM_FLASH_INTERVAL_SECONDS. The flashing step is split into whole toggles, so the last one is never closer
+    to the end of the step than the card can take packets.
+    '''
+    flashingStepSeconds = float(FLASHING_STEP_SECONDS) / speedRatio
+    toggles = int(FLASHING_STEP_SECONDS / LightsCore.FLASH_INTERVAL_SECONDS)
+    toggles = max(1, min(toggles, int(flashingStepSeconds / MINIMUM_FLASH_INTERVAL_SECONDS)))
+    # a microsecond over, so rounding can't squeeze in another toggle just before the end of the step
+    return flashingStepSeconds / toggles + 0.000001
+
+
+class RecordingRelaySink(object):
+    '''
+    A stand in for EasyDaqUSBRelay that records the time each relay change arrives
+    '''
+    writeLead = 0
+
+    def __init__(self, clock=monotonicTime):
+        self.clock = clock
+        self.relayChanges = []
+
+    def sendRelayByte(self, commandValue, writeAt=None):
+        self.relayChanges.append((self.clock(), commandValue))
+
+    def relayChangeLog(self):
+        return self.relayChanges
+
+
+class RelayPassThroughSink(RecordingRelaySink):
+    '''
+    Records the time each relay change arrives, then passes it on to an EasyDaqUSBRelay
+    '''
+    def __init__(self, easyDaqRelay, clock=monotonicTime):
+        RecordingRelaySink.__init__(self, clock)
+        self.easyDaqRelay = easyDaqRelay
+        # a relay group is sent each change ahead of its deadline
+        self.writeLead = easyDaqRelay.writeLead
+
+    def sendRelayByte(self, commandValue, writeAt=None):
+        RecordingRelaySink.sendRelayByte(self, commandValue)
+        self.easyDaqRelay.sendRelayByte(commandValue, writeAt)
+
+
+def percentile(sortedValues, fraction):
+    '''
+    Nearest rank percentile of a sorted list
+    '''
+    if not sortedValues:
+        return None
+    rank = int(round(fraction * (len(sortedValues) - 1)))
+    return sortedValues[rank]
+
+
+def eventKind(event):
+    if event.finishesSequence:
+        return "finish"
+    elif event.stepNumber is not None:
+        return "step"
+    else:
+        return "flash"
+
+
+def runSequence(numberStarts, isFFlagStart, speedRatio, scheduler, relaySink, timingSource):
+    '''
+    Run one start sequence and return a list of dictionaries, one for each relay change, with the intended and
+    actual times relative to the start of the sequence.
+    '''
+    sequence = LightsCore.StartRaceSequence(scheduler.clock)
+    sequence.testSpeedRatio = speedRatio
+    # flash faster too, so every flashing step has several flashes to time
+    sequence.flashInterval = benchmarkFlashInterval(speedRatio)
+
+    if isFFlagStart:
+        LightsCore.addFFlagStep(sequence, numberStarts)
+        startSequenceSeconds = 300 * numberStarts + 300
+    else:
+        startSequenceSeconds = 300 * numberStarts
+    LightsCore.addFiveMinuteStarts(sequence, numberStarts)
+
+    sequence.raceStartTime = datetime.datetime.now() + datetime.timedelta(seconds=float(startSequenceSeconds) / speedRatio)
+
+    changesBefore = len(timingSource.relayChangeLog())
+    sequence.start(relaySink, scheduler)
+    scheduler.runUntil(lambda: not sequence.isRunning)
+
+    # give any packets still on their way to the card time to arrive
+    if timingSource is not relaySink:
+        time.sleep(0.5)
+
+    actualChanges = timingSource.relayChangeLog()[changesBefore:]
+    sequenceStart = sequence.timeline[0].deadline
+
+    results = []
+    for eventNumber in range(len(sequence.timeline)):
+        event = sequence.timeline[eventNumber]
+        result = {
+            'kind': eventKind(event),
+            'relay': event.commandValue,
+            'intended': event.deadline - sequenceStart,
+        }
+        if eventNumber < len(actualChanges):
+            actualTime, actualValue = actualChanges[eventNumber]
+            result['actual'] = actualTime - sequenceStart
+            result['errorMs'] = (actualTime - event.deadline) * 1000
+            result['matches'] = actualValue == event.commandValue
+        results.append(result)
+    return results
+
+
+def summarise(numberStarts, results):
+    errors = sorted([abs(result['errorMs']) for result in results if 'errorMs' in result])
+    return {
+        'starts': numberStarts,
+        'events': len(results),
+        'missing': len([result for result in results if 'errorMs' not in result]),
+        'mismatched': len([result for result in results if not result.get('matches', True)]),
+        'p50ErrorMs': percentile(errors, 0.50),
+        'p99ErrorMs': percentile(errors, 0.99),
+        'maxErrorMs': errors[-1] if errors else None,
+        'meanSignedErrorMs': sum([result['errorMs'] for result in results if 'errorMs' in result]) / len(errors) if errors else None,
+    }
+
+
+def emulatorSkew(emulators):
+    '''
+    For each relay change, the spread in milliseconds between the first and last emulator to receive it
+    '''
+    changeLogs = [emulator.relayChangeLog() for emulator in emulators]
+    skews = []
+    for changeNumber in range(min([len(changeLog) for changeLog in changeLogs])):
+        times = [changeLog[changeNumber][0] for changeLog in changeLogs]
+        skews.append((max(times) - min(times)) * 1000)
+    skews.sort()
+    return {
+        'changes': len(skews),
+        'p50SkewMs': percentile(skews, 0.50),
+        'p99SkewMs': percentile(skews, 0.99),
+        'maxSkewMs': skews[-1] if skews else None,
+    }
+
+
+def main():
+    maximumStarts = 6
+    speedRatio = 60
+    isFFlagStart = True
+    useEmulator = False
+    comPort = None
+    verifyWrites = False
+    outputFileName = None
+    numberDecoys = 0
+    numberCards = 1
+
+    useVirtualClock = False
+
+    myopts, args = getopt.getopt(sys.argv[1:], "s:t:cep:vo:d:g:x", ["starts=", "testSpeedRatio=", "classFlag", "emulator", "port=", "verify", "output=", "decoys=", "group=", "virtual"])
+    for o, a in myopts:
+        if o in ('-s', '--starts'):
+            maximumStarts = int(a)
+        elif o in ('-t', '--testSpeedRatio'):
+            speedRatio = int(a)
+        elif o in ('-c', '--classFlag'):
+            isFFlagStart = False
+        elif o in ('-e', '--emulator'):
+            useEmulator = True
+        elif o in ('-p', '--port'):
+            comPort = a
+        elif o in ('-v', '--verify'):
+            verifyWrites = True
+        elif o in ('-o', '--output'):
+            outputFileName = a
+        elif o in ('-d', '--decoys'):
+            numberDecoys = int(a)
+        elif o in ('-g', '--group'):
+            numberCards = int(a)
+        elif o in ('-x', '--virtual'):
+            useVirtualClock = True
+
+    if useVirtualClock and not (useEmulator or comPort):
+        scheduler = LightsCore.VirtualClockEventLoop()
+    else:
+        useVirtualClock = False
+        scheduler = LightsCore.RealTimeEventLoop()
+    emulator = None
+    emulators = []
+    decoys = []
+    easyDaqRelay = None
+
+    if useEmulator:
+        # imported here, as the emulator only runs on Linux
+        import EasyDaqEmulator
+        emulators = [EasyDaqEmulator.EasyDaqEmulator() for card in range(numberCards)]
+        for emulator in emulators:
+            emulator.start()
+        emulator = emulators[0]
+        comPort = emulator.portName
+
+        # hide the emulator amongst the decoys and make the relay find it
+        if numberDecoys:
+            decoys = [EasyDaqEmulator.SilentSerialPort() for decoy in range(numberDecoys)]
+            comPort = [decoy.portName for decoy in decoys] + [emulator.portName]
+            random.shuffle(comPort)
+
+    connectSeconds = None
+    if len(emulators) > 1:
+        easyDaqRelay = LightsCore.EasyDaqRelayGroup([comPort] + [mirror.portName for mirror in emulators[1:]], scheduler, verifyWrites)
+    elif comPort:
+        easyDaqRelay = LightsCore.EasyDaqUSBRelay(comPort, scheduler, verifyWrites)
+    if easyDaqRelay:
+        connectStart = monotonicTime()
+        easyDaqRelay.connect()
+        if len(emulators) > 1:
+            # a group is connected as soon as one card is, but we want to time every card
+            scheduler.runUntil(lambda: all([relay.isConnected() for relay in easyDaqRelay.relays]))
+        else:
+            scheduler.runUntil(easyDaqRelay.isConnected)
+        connectSeconds = monotonicTime() - connectStart
+        relaySink = RelayPassThroughSink(easyDaqRelay)
+    else:
+        relaySink = RecordingRelaySink(scheduler.clock)
+
+    if emulator:
+        timingSource = emulator
+    else:
+        timingSource = relaySink
+
+    report = {
+        'speedRatio': speedRatio,
+        'fFlagStart': isFFlagStart,
+        'relay': 'emulator' if emulator else (comPort or 'recording'),
+        'clock': 'virtual' if useVirtualClock else 'monotonic',
+        'decoys': numberDecoys,
+        'cards': len(emulators) or 1,
+        'connectSeconds': connectSeconds,
+        'python': sys.version.split()[0],
+        'platform': sys.platform,
+        'runs': [],
+    }
+
+    benchmarkStart = monotonicTime()
+    for numberStarts in range(1, maximumStarts + 1):
+        logging.info("Benchmarking %d starts" % numberStarts)
+        results = runSequence(numberStarts, isFFlagStart, speedRatio, scheduler, relaySink, timingSource)
+        run = summarise(numberStarts, results)
+        run['timeline'] = results
+        report['runs'].append(run)
+    report['elapsedSeconds'] = monotonicTime() - benchmarkStart
+
+    if easyDaqRelay:
+        report['relayQueue'] = easyDaqRelay.queueSummary()
+        if verifyWrites:
+            report['relayConfirmation'] = easyDaqRelay.verificationSummary()
+        if len(emulators) > 1:
+            report['relaySkew'] = easyDaqRelay.skewSummary()
+            report['emulatorSkew'] = emulatorSkew(emulators)
+        easyDaqRelay.shutdown()
+        easyDaqRelay.waitForShutdown(2.0)
+    for emulator in emulators:
+        emulator.stop()
+    for decoy in decoys:
+        decoy.stop()
+
+    if outputFileName:
+        with open(outputFileName, 'w') as outputFile:
+            json.dump(report, outputFile, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+        format = "%(levelname)s:%(asctime)-15s %(message)s")
+    main()
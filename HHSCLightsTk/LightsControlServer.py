@@ -0,0 +1,437 @@
+'''
+Network control and telemetry for the race start lights.
+
+Remote displays, such as the tablet on the committee boat, connect over TCP and are sent the state of the lights
+whenever it changes: the countdown, the current and next step, the relay session and which lights are on. They can
+also send commands to start and reset the sequence and to set the lights.
+
+Clients either speak newline delimited JSON on a plain TCP connection, e.g.
+
+echo '{"command": "state"}' | nc localhost 8765
+
+or connect as a WebSocket from a browser, ws://hostname:8765/, and send and receive the same JSON as text messages.
+
+Every message to the client is a JSON object with a "type". State messages hold the whole state, so a client that
+connects, or falls behind, just needs the latest one:
+
+{"type": "state", "version": 12, "countdown": "04:59", "lights": [1, 0, 0, 0, 0], ...}
+
+Commands are JSON objects with a "command", and are answered with a reply message:
+
+{"command": "start", "flag": "F", "starts": 2, "minutes": 0}
+{"command": "reset"}
+{"command": "lights", "lights": "off" | "one" | "two" | "three" | "four" | "five" | "flashing"}
+
+{"type": "reply", "command": "reset", "ok": true}
+
+If the server has a token, a client must give it before it is sent anything or can send any commands. Plain TCP
+clients give it in their first message, which may also be a command:
+
+{"command": "auth", "token": "..."}
+
+and browsers either do the same or add it to the WebSocket address, ws://hostname:8765/?token=... A browser's
+Origin must also be on the allowed list, or on localhost, so a web page the tablet happens to have open can't
+drive the lights. A wrong token, or a disallowed Origin, closes the connection.
+
+None of this runs on the Tk thread. Commands are passed to the Tk thread on a queue, which the application polls,
+and publishing a state change is no more than updating a dictionary and waking the client threads. Each client has
+its own thread to write to it, which only ever sends the latest state, so a slow or stalled client can never hold
+up the lights or the other clients.
+'''
+import SocketServer
+import threading
+import Queue
+import socket
+import json
+import logging
+import base64
+import hashlib
+import struct
+import select
+import hmac
+import urlparse
+
+# the key WebSocket clients are sent back, from RFC 6455
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+# the WebSocket frame opcodes we use
+OPCODE_TEXT = 0x1
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+# how long (in seconds) a client waits for the application to answer a command
+COMMAND_TIMEOUT = 2.0
+
+# how long (in seconds) we wait to send to a client before we give up on it
+SEND_TIMEOUT = 5.0
+
+# how long (in seconds) we wait for a new client to start a WebSocket handshake before we treat it as a plain
+# TCP client, which may never send us anything
+HANDSHAKE_WAIT = 0.5
+
+# the longest message we accept from a client
+MAXIMUM_MESSAGE_SIZE = 4096
+
+# browser pages on these hosts are always allowed to connect
+LOCAL_ORIGIN_HOSTS = ('localhost', '127.0.0.1', '::1')
+
+
+class ClientClosed(Exception):
+    pass
+
+
+def sendWithTimeout(clientSocket, data):
+    '''
+    Send all the data, giving up if the client won't take any of it for SEND_TIMEOUT seconds. The socket itself
+    has no timeout, as the reader waits on it indefinitely.
+    '''
+    while data:
+        _, writable, _ = select.select([], [clientSocket], [], SEND_TIMEOUT)
+        if not writable:
+            raise socket.timeout("send timed out")
+        sent = clientSocket.send(data)
+        data = data[sent:]
+
+
+class LineConnection(object):
+    '''
+    Newline delimited JSON over a plain TCP connection
+    '''
+    def __init__(self, handler):
+        self.handler = handler
+        self.sendLock = threading.Lock()
+
+    def readMessage(self):
+        line = self.handler.rfile.readline(MAXIMUM_MESSAGE_SIZE)
+        if not line:
+            raise ClientClosed()
+        return line.strip()
+
+    def sendMessage(self, text):
+        with self.sendLock:
+            sendWithTimeout(self.handler.connection, text + '\n')
+
+
+class WebSocketConnection(object):
+    '''
+    A minimal RFC 6455 WebSocket, enough for a browser to send and receive text messages
+    '''
+    def __init__(self, handler):
+        self.handler = handler
+        self.sendLock = threading.Lock()
+
+    def handshake(self):
+        '''
+        Accept the upgrade whatever the path, checking the Origin and any token in the query. Return True if the
+        query had the right token, False if the client still needs to give us one.
+        '''
+        lightsServer = self.handler.server.lightsServer
+        requestLine = self.handler.rfile.readline(MAXIMUM_MESSAGE_SIZE).split()
+        path = requestLine[1] if len(requestLine) > 1 else '/'
+        headers = {}
+        while True:
+            line = self.handler.rfile.readline(MAXIMUM_MESSAGE_SIZE).strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        key = headers.get('sec-websocket-key')
+        if not key:
+            self.handler.connection.sendall("HTTP/1.1 400 Bad Request\r\n\r\n")
+            raise ClientClosed()
+
+        # browsers always send the Origin, so a page from anywhere else is refused before it can do anything
+        if 'origin' in headers and not lightsServer.isOriginAllowed(headers['origin']):
+            logging.warning("Lights client refused, origin %s is not allowed" % headers['origin'])
+            self.handler.connection.sendall("HTTP/1.1 403 Forbidden\r\n\r\n")
+            raise ClientClosed()
+
+        token = urlparse.parse_qs(urlparse.urlparse(path).query).get('token')
+        if token and not lightsServer.isTokenValid(token[0]):
+            logging.warning("Lights client refused, wrong token")
+            self.handler.connection.sendall("HTTP/1.1 403 Forbidden\r\n\r\n")
+            raise ClientClosed()
+
+        accept = base64.b64encode(hashlib.sha1(key + WEBSOCKET_GUID).digest())
+        self.handler.connection.sendall("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n"
+            "Connection: Upgrade\r\nSec-WebSocket-Accept: %s\r\n\r\n" % accept)
+        return bool(token)
+
+    def readExactly(self, length):
+        data = self.handler.rfile.read(length)
+        if len(data) < length:
+            raise ClientClosed()
+        return data
+
+    def readMessage(self):
+        while True:
+            first, second = struct.unpack('!BB', self.readExactly(2))
+            opcode = first & 0x0F
+            length = second & 0x7F
+            if length == 126:
+                length = struct.unpack('!H', self.readExactly(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', self.readExactly(8))[0]
+            if length > MAXIMUM_MESSAGE_SIZE:
+                raise ClientClosed()
+
+            # messages from the browser are always masked
+            mask = self.readExactly(4) if second & 0x80 else None
+            payload = bytearray(self.readExactly(length))
+            if mask:
+                mask = bytearray(mask)
+                for i in range(len(payload)):
+                    payload[i] ^= mask[i % 4]
+
+            if opcode == OPCODE_CLOSE:
+                raise ClientClosed()
+            elif opcode == OPCODE_PING:
+                self.sendFrame(OPCODE_PONG, str(payload))
+            elif opcode == OPCODE_TEXT:
+                return str(payload)
+
+    def sendFrame(self, opcode, payload):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+        with self.sendLock:
+            sendWithTimeout(self.handler.connection, header + payload)
+
+    def sendMessage(self, text):
+        self.sendFrame(OPCODE_TEXT, text)
+
+
+class LightsClientHandler(SocketServer.StreamRequestHandler):
+    '''
+    Runs on its own thread for each client. We read commands here, and push state changes from a second thread.
+    '''
+    def handle(self):
+        lightsServer = self.server.lightsServer
+        logging.info("Lights client connected from %s:%i" % self.client_address)
+        self.isConnected = True
+        self.isAuthenticated = lightsServer.token is None
+
+        try:
+            # a browser starts with an HTTP request to upgrade to a WebSocket. Anything else is a plain TCP client.
+            readable, _, _ = select.select([self.connection], [], [], HANDSHAKE_WAIT)
+            if readable and self.connection.recv(4, socket.MSG_PEEK) == 'GET ':
+                self.clientConnection = WebSocketConnection(self)
+                if self.clientConnection.handshake():
+                    self.isAuthenticated = True
+            else:
+                self.clientConnection = LineConnection(self)
+
+            # nothing is sent to the client until it has given us the token
+            if not self.isAuthenticated:
+                self.authenticate(self.clientConnection.readMessage())
+
+            stateWriter = threading.Thread(target=self.sendStateChanges, name="LightsClientWriter")
+            stateWriter.daemon = True
+            stateWriter.start()
+
+            while True:
+                message = self.clientConnection.readMessage()
+                if message:
+                    self.processMessage(message)
+
+        except (ClientClosed, socket.error):
+            pass
+        finally:
+            self.isConnected = False
+            lightsServer.wakeClients()
+            logging.info("Lights client disconnected from %s:%i" % self.client_address)
+
+    def authenticate(self, message):
+        '''
+        The first message from the client must have the token. If it is also a command, we carry it out.
+        '''
+        try:
+            request = json.loads(message)
+            token = request['token']
+        except (ValueError, KeyError, TypeError):
+            token = None
+        if not isinstance(token, basestring) or not self.server.lightsServer.isTokenValid(token):
+            logging.warning("Lights client from %s:%i refused, wrong token" % self.client_address)
+            self.sendReply({'type': 'reply', 'command': 'auth', 'ok': False, 'error': 'a valid token is needed'})
+            raise ClientClosed()
+
+        self.isAuthenticated = True
+        if request.get('command', 'auth') == 'auth':
+            self.sendReply({'type': 'reply', 'command': 'auth', 'ok': True})
+        else:
+            self.processMessage(message)
+
+    def processMessage(self, message):
+        try:
+            request = json.loads(message)
+            command = request['command']
+        except (ValueError, KeyError, TypeError):
+            self.sendReply({'type': 'reply', 'ok': False, 'error': 'expected a JSON object with a command'})
+            return
+
+        if command == 'state':
+            # the writer thread sends the state, so all we need to do is make sure it sends it again
+            self.server.lightsServer.wakeClients(resend=True)
+            return
+
+        self.sendReply(self.server.lightsServer.runCommand(command, request))
+
+    def sendReply(self, reply):
+        try:
+            self.clientConnection.sendMessage(json.dumps(reply))
+        except socket.error:
+            raise ClientClosed()
+
+    def sendStateChanges(self):
+        '''
+        Runs on the client's writer thread. Send the state whenever it changes. If the state changes more than
+        once while we are sending, we only send the latest.
+        '''
+        lightsServer = self.server.lightsServer
+        sentVersion = None
+        while True:
+            version, stateDocument = lightsServer.waitForState(sentVersion, self)
+            if version is None:
+                return
+            try:
+                self.clientConnection.sendMessage(stateDocument)
+                sentVersion = version
+            except socket.error:
+                # the client has stalled or gone away. Closing the socket ends its reader too.
+                self.isConnected = False
+                try:
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+                return
+
+
+class LightsTCPServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class LightsControlServer(object):
+    '''
+    Accepts remote clients, pushes the state of the lights to them and queues their commands for the Tk thread.
+    Clients must give the token, unless it is None. Browser pages must come from localhost or one of the allowed
+    origins, e.g. ['http://tablet.local:8000'].
+    '''
+    def __init__(self, host='localhost', port=8765, token=None, allowedOrigins=None):
+        self.host = host
+        self.port = port
+        self.token = token
+        self.allowedOrigins = set(origin.rstrip('/').lower() for origin in (allowedOrigins or []))
+
+        # commands for the Tk thread, each a tuple of command, the request and the queue for the reply
+        self.commandQueue = Queue.Queue()
+
+        # the latest state, as a dictionary and as the JSON we send. The version goes up with every change.
+        self.state = {'type': 'state'}
+        self.stateDocument = None
+        self.version = 0
+        self.stateCondition = threading.Condition()
+
+        self.tcpServer = None
+        self.serverThread = None
+        self.isRunning = False
+
+    def start(self):
+        self.isRunning = True
+        self.tcpServer = LightsTCPServer((self.host, self.port), LightsClientHandler)
+        self.tcpServer.lightsServer = self
+        self.port = self.tcpServer.server_address[1]
+        self.serverThread = threading.Thread(target=self.tcpServer.serve_forever, name="LightsControlServer")
+        self.serverThread.daemon = True
+        self.serverThread.start()
+        logging.info("Lights control server listening on %s:%i" % (self.host, self.port))
+
+    def stop(self):
+        if self.tcpServer:
+            self.tcpServer.shutdown()
+            self.tcpServer.server_close()
+        # and wake the client writers, so they finish
+        with self.stateCondition:
+            self.isRunning = False
+            self.stateCondition.notifyAll()
+
+    def isTokenValid(self, token):
+        if self.token is None:
+            return True
+        if isinstance(token, unicode):
+            token = token.encode('utf-8')
+        # compare in constant time, so the token can't be guessed a character at a time
+        return hmac.compare_digest(token, self.token)
+
+    def isOriginAllowed(self, origin):
+        origin = origin.rstrip('/').lower()
+        if origin in self.allowedOrigins:
+            return True
+        return urlparse.urlparse(origin).hostname in LOCAL_ORIGIN_HOSTS
+
+    def publish(self, changes):
+        '''
+        Called from the Tk thread. Merge the changes into the state and wake the client writers. We don't build
+        the JSON here, the first writer to wake does that.
+        '''
+        with self.stateCondition:
+            self.state.update(changes)
+            self.version += 1
+            self.stateDocument = None
+            self.stateCondition.notifyAll()
+
+    def wakeClients(self, resend=False):
+        with self.stateCondition:
+            if resend:
+                self.version += 1
+                self.stateDocument = None
+            self.stateCondition.notifyAll()
+
+    def waitForState(self, sentVersion, client):
+        '''
+        Wait for a version of the state we haven't sent, and return the version and its JSON. Returns None, None
+        once the client has gone or we have stopped. We wait without a timeout, which in Python 2 would poll,
+        as everything that changes what we wait for notifies the condition.
+        '''
+        with self.stateCondition:
+            # the client and the server are checked under the lock, so we can't miss the notify when they stop
+            while self.version == sentVersion and client.isConnected and self.isRunning:
+                self.stateCondition.wait()
+            if not (client.isConnected and self.isRunning):
+                return None, None
+            if self.stateDocument is None:
+                self.state['version'] = self.version
+                self.stateDocument = json.dumps(self.state)
+            return self.version, self.stateDocument
+
+    def runCommand(self, command, request):
+        '''
+        Called on a client's thread. Pass the command to the Tk thread and wait for its reply.
+        '''
+        replyQueue = Queue.Queue()
+        self.commandQueue.put((command, request, replyQueue))
+        try:
+            reply = replyQueue.get(timeout=COMMAND_TIMEOUT)
+        except Queue.Empty:
+            reply = {'ok': False, 'error': 'no reply from the lights'}
+        reply['type'] = 'reply'
+        reply['command'] = command
+        return reply
+
+    def pendingCommands(self):
+        '''
+        Called from the Tk thread. Return the commands waiting for it, without blocking.
+        '''
+        commands = []
+        try:
+            while True:
+                commands.append(self.commandQueue.get_nowait())
+        except Queue.Empty:
+            pass
+        return commands
@@ -0,0 +1,1465 @@
+'''
+The core of the race start lights: the start sequence and the EasyDaq relay, without any user interface.
+
+The lights application, TkLights.py, runs this under Tk. LightsService.py runs it headless, for example on a
+Raspberry Pi, and LightsBenchmark.py runs it against a virtual clock many times faster than real time.
+
+Everything here schedules its work on an event loop. An event loop is any object with the two methods of a Tk
+widget we use:
+
+after(milliseconds, callback) - call the callback after the delay, on the event loop's thread. Returns a timer.
+after_cancel(timer) - cancel a timer that hasn't fired.
+
+A Tk widget is an event loop, as are RealTimeEventLoop and VirtualClockEventLoop below. Any other loop can be
+wrapped to fit, for example Python 3's asyncio with loop.call_later and handle.cancel. The sequence and the relay
+call their observers on the event loop's thread. The relay does its serial I/O on its own thread.
+'''
+import datetime
+import serial
+import time
+import logging
+import sys
+import threading
+import Queue
+import collections
+import itertools
+import struct
+import os
+import glob
+import heapq
+
+
+# constants for lights state
+LIGHT_OFF = 0
+LIGHT_ON = 1
+LIGHT_FLASHING = 2
+
+# constants for serial port session state
+DISCONNECTED = 0
+RECONNECTING = 1
+CONNECTED = 2
+
+# constants for commands to the serial I/O thread
+IO_WRITE = 0
+IO_CONNECT = 1
+IO_DISCONNECT = 2
+IO_SHUTDOWN = 3
+IO_MAINTAIN = 4
+
+# how often (in milliseconds) the event loop thread picks up session state changes from the serial I/O thread,
+# and checks whether the session needs keeping alive or reconnecting
+STATE_POLL_INTERVAL = 100
+
+# how many times we read back (and, on a mismatch, rewrite) a relay command before we give up on it
+VERIFY_ATTEMPTS = 3
+
+# how long (in seconds) we wait for the card to reply to a read back, about one packet spacing. The card
+# replies within a few milliseconds, and a light change mustn't wait for the session's half second timeout.
+VERIFY_READ_TIMEOUT = 0.1
+
+# log the relay confirmation latencies after this many confirmations
+VERIFY_LOG_INTERVAL = 50
+
+# when we look for the EasyDaq card, how long (in seconds) we wait for a port to reply, and how many times we ask
+PROBE_TIMEOUT = 0.25
+PROBE_ATTEMPTS = 2
+
+# the longest (in seconds) we wait for the card to reply after we open its port, before we go ahead anyway
+SETTLE_TIMEOUT = 2.0
+
+# when a relay group changes the lights on several cards, how far ahead (in seconds) of the deadline for the writes
+# it is sent the change, so that every card's I/O thread has the packet and is waiting to write it at the same
+# moment. This covers a late event loop timer, as Tk's can be on Windows.
+GROUP_WRITE_LEAD = 0.06
+
+# flight recorder event types
+FR_RELAY_QUEUED = 1         # value is the relay byte
+FR_PACKET_WRITTEN = 2       # value is the packet's command character, extra is its byte
+FR_PORT_READ = 3            # value is the state of the card's outputs, extra is 1 if the card didn't reply
+FR_SESSION_STATE = 4        # value is the new session state
+FR_SEQUENCE_STARTED = 5     # extra is the number of events in the timeline
+FR_STEP_STARTED = 6         # extra is the step number
+FR_SEQUENCE_FINISHED = 7
+FR_SEQUENCE_RESET = 8
+FR_UI_COMMAND = 9           # value is one of the UI_ constants
+FR_CRASH = 10
+
+# UI commands for the flight recorder
+UI_LIGHTS_OFF = 0
+UI_ONE_LIGHT = 1
+UI_TWO_LIGHTS = 2
+UI_THREE_LIGHTS = 3
+UI_FOUR_LIGHTS = 4
+UI_FIVE_LIGHTS = 5
+UI_FLASHING_ONE_LIGHT = 6
+UI_START_SEQUENCE = 7
+UI_RESET_SEQUENCE = 8
+UI_QUIT = 9
+
+# the time between toggles when a step has flashing lights
+FLASH_INTERVAL_SECONDS = 0.5
+
+# Event loop timers, like Tk's, only have millisecond resolution and can fire a little early, so the
+# timeline dispatcher sends any event due within this many seconds straight away
+DISPATCH_TOLERANCE_SECONDS = 0.002
+
+#
+# The start sequence is timed against a monotonic clock, so that a change to the PC clock (for example
+# a time sync during the sequence) doesn't move the lights. Python 2 doesn't have time.monotonic. On
+# Windows time.clock is a high resolution monotonic counter. On Linux, such as the Raspberry Pi, which
+# often steps its clock when NTP syncs after boot, we call clock_gettime(CLOCK_MONOTONIC) with ctypes.
+# Anywhere else we fall back to time.time, and the sequence moves if the clock is changed while it runs.
+#
+CLOCK_MONOTONIC = 1
+
+def linuxMonotonicTime():
+    '''
+    Load clock_gettime from the C library, and return a function that reads CLOCK_MONOTONIC in seconds,
+    or None if we can't
+    '''
+    import ctypes
+
+    class Timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    # clock_gettime is in librt before glibc 2.17, and in libc itself since
+    for libraryName in ('librt.so.1', 'libc.so.6'):
+        try:
+            clockGettime = ctypes.CDLL(libraryName, use_errno=True).clock_gettime
+            break
+        except (OSError, AttributeError):
+            pass
+    else:
+        return None
+    clockGettime.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+
+    def monotonicTime():
+        timespec = Timespec()
+        if clockGettime(CLOCK_MONOTONIC, ctypes.byref(timespec)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return timespec.tv_sec + timespec.tv_nsec * 1e-9
+
+    # check it works before we time anything with it
+    try:
+        monotonicTime()
+    except OSError:
+        return None
+    return monotonicTime
+
+monotonicTime = None
+if hasattr(time, 'monotonic'):
+    monotonicTime = time.monotonic
+elif sys.platform == 'win32':
+    monotonicTime = time.clock
+elif sys.platform.startswith('linux'):
+    monotonicTime = linuxMonotonicTime()
+if monotonicTime is None:
+    monotonicTime = time.time
+
+
+
+class RealTimeEventLoop(object):
+    '''
+    An event loop without a user interface. It runs the callbacks on the thread that calls run or runUntil,
+    sleeping until each one is due.
+    '''
+    def __init__(self, clock=monotonicTime):
+        self.clock = clock
+        # each timer is a tuple of the time it is due, its number and its callback
+        self.timers = []
+        self.timerNumber = 0
+        self.cancelledTimers = set()
+        self.isStopped = False
+
+    def after(self, milliseconds, callback):
+        self.timerNumber += 1
+        heapq.heappush(self.timers, (self.clock() + milliseconds / 1000.0, self.timerNumber, callback))
+        return self.timerNumber
+
+    def after_cancel(self, timer):
+        self.cancelledTimers.add(timer)
+
+    def waitUntil(self, deadline):
+        delay = deadline - self.clock()
+        if delay > 0:
+            time.sleep(delay)
+
+    def runUntil(self, isFinished):
+        '''
+        Run callbacks until isFinished returns True, we are stopped, or there is nothing left to run
+        '''
+        while not isFinished() and not self.isStopped and self.timers:
+            deadline, timer, callback = heapq.heappop(self.timers)
+            if timer in self.cancelledTimers:
+                self.cancelledTimers.discard(timer)
+                continue
+            self.waitUntil(deadline)
+            callback()
+
+    def run(self):
+        self.runUntil(lambda: False)
+
+    def stop(self):
+        self.isStopped = True
+
+
+class VirtualClockEventLoop(RealTimeEventLoop):
+    '''
+    An event loop with its own clock, which jumps straight to each callback rather than waiting for it, so a start
+    sequence runs as fast as the callbacks do. Pass its clock to StartRaceSequence. Only use it with relays that
+    don't talk to a real card, as the serial I/O thread runs in real time.
+    '''
+    def __init__(self, startTime=0.0):
+        self.virtualTime = startTime
+        RealTimeEventLoop.__init__(self, self.now)
+
+    def now(self):
+        return self.virtualTime
+
+    def waitUntil(self, deadline):
+        self.virtualTime = max(self.virtualTime, deadline)
+
+
+class FlightRecorder(object):
+    '''
+    An in-memory flight recorder for the relay and the start sequence. Each event is packed into a fixed size
+    binary ring buffer with a monotonic timestamp in nanoseconds, which is cheap enough to do on every relay
+    change from any thread. The buffer is written to a file after each sequence, or if we crash. Use
+    DecodeFlightRecord.py to turn the file into a timeline.
+    '''
+    # each record is the timestamp, event type, value and extra
+    RECORD = struct.Struct('<qBBH')
+    
+    # the file header is the magic string, the record size, the number of records and the wall clock and
+    # monotonic times the file was written, which let us put wall clock times on the records
+    HEADER = struct.Struct('<8sIIdd')
+    MAGIC = 'HHSCFR01'
+    
+    def __init__(self, capacity=8192, directory='.'):
+        self.capacity = capacity
+        self.directory = directory
+        self.buffer = bytearray(capacity * self.RECORD.size)
+        # next() on a count is atomic, so both threads can record without taking a lock
+        self.counter = itertools.count()
+        self.recorded = 0
+        
+    def record(self, eventType, value=0, extra=0):
+        index = next(self.counter)
+        self.RECORD.pack_into(self.buffer, (index % self.capacity) * self.RECORD.size,
+            int(monotonicTime() * 1000000000), eventType, value, extra)
+        self.recorded = max(self.recorded, index + 1)
+        
+    def snapshot(self):
+        '''
+        Return the number of records in the buffer and the records, oldest first
+        '''
+        recorded = self.recorded
+        data = str(self.buffer)
+        if recorded <= self.capacity:
+            return recorded, data[:recorded * self.RECORD.size]
+        
+        oldest = (recorded % self.capacity) * self.RECORD.size
+        return self.capacity, data[oldest:] + data[:oldest]
+    
+    def flush(self, reason, wait=False):
+        '''
+        Write the buffer to a file. We take a copy of the buffer now and write it on a separate thread, unless we
+        are asked to wait, for example because we are about to exit.
+        '''
+        count, records = self.snapshot()
+        header = self.HEADER.pack(self.MAGIC, self.RECORD.size, count, time.time(), monotonicTime())
+        fileName = os.path.join(self.directory, "flight-%s-%s.hfr" % (datetime.datetime.now().strftime("%Y%m%d-%H%M%S"), reason))
+        
+        writer = threading.Thread(target=self.writeFile, args=(fileName, header + records), name="FlightRecorder")
+        writer.daemon = not wait
+        writer.start()
+        if wait:
+            writer.join()
+            
+    def writeFile(self, fileName, data):
+        try:
+            with open(fileName, 'wb') as recordFile:
+                recordFile.write(data)
+            logging.info("Flight recorder written to %s" % fileName)
+        except IOError as e:
+            logging.error("Unable to write flight recorder: {0}".format(e))
+
+
+# we have a single flight recorder for the application
+flightRecorder = FlightRecorder()
+
+
+def relayByte(relayArray):
+    '''
+    Turn the values in the list into a byte where the bit in the byte reflects the position in the list.
+    '''
+    commandValue = 0
+
+    for i in range(len(relayArray)):
+            bitValue = (relayArray[i] *  pow(2,i))
+            commandValue = commandValue + bitValue
+
+    return commandValue
+
+
+class RelayCommandQueue(object):
+    '''
+    The queue of commands for the serial I/O thread. Consecutive relay state ('C') packets are merged, so that only
+    the latest state is written to the card. Configuration ('B') packets and session commands are never merged
+    or dropped, and everything stays in the order it was sent. We also keep statistics on how long packets wait
+    in the queue before they are written.
+    '''
+    def __init__(self):
+        # each entry is a tuple of command, packet, the monotonic time it was queued and the monotonic time it
+        # should be written, or None to write it as soon as we can
+        self.commands = collections.deque()
+        self.condition = threading.Condition()
+        
+        self.mergedPackets = 0
+        self.writtenPackets = 0
+        self.totalLatency = 0.0
+        self.maximumLatency = 0.0
+        
+    def put(self, command, packet=None, writeAt=None):
+        with self.condition:
+            if (command == IO_WRITE and packet[0] == 'C' and self.commands
+                    and self.commands[-1][0] == IO_WRITE and self.commands[-1][1][0] == 'C'):
+                # replace the waiting relay command. We keep the time the first one was queued, so the
+                # latency covers the whole time the lights have been waiting to change.
+                self.commands[-1] = (IO_WRITE, packet, self.commands[-1][2], writeAt)
+                self.mergedPackets += 1
+            else:
+                self.commands.append((command, packet, monotonicTime(), writeAt))
+            self.condition.notify()
+            
+    def waitForCommand(self):
+        '''
+        Wait for a command. We never wait with a timeout, as Python 2's Condition.wait polls when it has one, and
+        would hold every command in the queue for up to 50 milliseconds.
+        '''
+        with self.condition:
+            while not self.commands:
+                self.condition.wait()
+        
+    def hasCommand(self):
+        with self.condition:
+            return len(self.commands) > 0
+        
+    def nextCommand(self):
+        with self.condition:
+            return self.commands[0][0]
+        
+    def nextWriteAt(self):
+        '''
+        The time the next command should be written, or None if it can be written straight away
+        '''
+        with self.condition:
+            if not self.commands:
+                return None
+            return self.commands[0][3]
+        
+    def takeCommand(self):
+        with self.condition:
+            return self.commands.popleft()
+        
+    def recordLatency(self, queuedTime):
+        latency = monotonicTime() - queuedTime
+        with self.condition:
+            self.writtenPackets += 1
+            self.totalLatency += latency
+            self.maximumLatency = max(self.maximumLatency, latency)
+        logging.debug("Packet waited %.1f ms in queue" % (latency * 1000))
+            
+    def latencySummary(self):
+        with self.condition:
+            if self.writtenPackets:
+                meanLatency = self.totalLatency / self.writtenPackets
+            else:
+                meanLatency = 0.0
+            return "%i packets written, %i merged, queue latency mean %.1f ms, max %.1f ms" % (
+                self.writtenPackets, self.mergedPackets, meanLatency * 1000, self.maximumLatency * 1000)
+
+
+class RelayLatencyHistogram(object):
+    '''
+    A rolling record of how long the relay card takes to confirm a relay change: the time from writing the command
+    to reading back the new state from the card. Updated on the serial I/O thread and read from the event loop thread.
+    '''
+    # the upper limit of each bucket, in seconds. Anything slower goes in a final bucket.
+    BUCKET_LIMITS = [0.125, 0.15, 0.2, 0.3, 0.5, 1.0]
+    
+    def __init__(self, size=200):
+        self.latencies = collections.deque(maxlen=size)
+        self.lock = threading.Lock()
+        self.confirmed = 0
+        self.mismatches = 0
+        self.failures = 0
+        
+    def record(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.confirmed += 1
+        
+    def recordMismatch(self):
+        with self.lock:
+            self.mismatches += 1
+        
+    def recordFailure(self):
+        with self.lock:
+            self.failures += 1
+            
+    def buckets(self):
+        '''
+        Return the number of recent latencies in each bucket
+        '''
+        counts = [0] * (len(self.BUCKET_LIMITS) + 1)
+        with self.lock:
+            for latency in self.latencies:
+                bucket = 0
+                while bucket < len(self.BUCKET_LIMITS) and latency > self.BUCKET_LIMITS[bucket]:
+                    bucket += 1
+                counts[bucket] += 1
+        return counts
+        
+    def summary(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            confirmed, mismatches, failures = self.confirmed, self.mismatches, self.failures
+        
+        if not latencies:
+            return "%i confirmed, %i mismatches, %i failed" % (confirmed, mismatches, failures)
+        
+        labels = ["<%dms" % (limit * 1000) for limit in self.BUCKET_LIMITS] + [">%dms" % (self.BUCKET_LIMITS[-1] * 1000)]
+        histogram = " ".join(["%s:%i" % (label, count) for label, count in zip(labels, self.buckets())])
+        return "%i confirmed, %i mismatches, %i failed, p50 %.0f ms, p95 %.0f ms, max %.0f ms (%s)" % (
+            confirmed, mismatches, failures,
+            latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.95)] * 1000, latencies[-1] * 1000,
+            histogram)
+
+
+def candidateSerialPorts():
+    '''
+    The serial ports that might have the EasyDaq card on them
+    '''
+    try:
+        from serial.tools import list_ports
+        ports = [port[0] for port in list_ports.comports()]
+    except ImportError:
+        ports = []
+    
+    # the card shows up as a USB serial port on Linux, which older versions of pyserial don't always list
+    for port in glob.glob('/dev/ttyUSB*') + glob.glob('/dev/ttyACM*'):
+        if port not in ports:
+            ports.append(port)
+    return ports
+
+
+def probeEasyDaqPort(portName, timeout=PROBE_TIMEOUT):
+    '''
+    Open the port and ask for the state of the card's outputs. The EasyDaq card replies with a single byte. We only
+    ask for a read, so we don't change anything on a port that turns out to be some other device. Returns the open
+    serial connection if the card replied, otherwise None.
+    '''
+    try:
+        connection = serial.Serial(portName, 9600, timeout=timeout)
+    except (serial.SerialException, ValueError, OSError) as e:
+        logging.debug("Unable to open %s: %s" % (portName, e))
+        return None
+    
+    try:
+        connection.flushInput()
+        for attempt in range(PROBE_ATTEMPTS):
+            connection.write('A' + chr(0))
+            if connection.read():
+                return connection
+    except (serial.SerialException, ValueError, OSError) as e:
+        logging.debug("Unable to probe %s: %s" % (portName, e))
+    
+    connection.close()
+    return None
+
+
+def discoverEasyDaqPort(candidatePorts=None, timeout=PROBE_TIMEOUT):
+    '''
+    Probe all the candidate ports at the same time, each on its own thread, and return the open serial connection
+    of the first one with an EasyDaq card on it, or None. A port that is slow to open or doesn't reply doesn't hold
+    us up beyond the probe timeout.
+    '''
+    if candidatePorts is None:
+        candidatePorts = candidateSerialPorts()
+    if not candidatePorts:
+        return None
+    
+    logging.info("Looking for the EasyDaq card on %s" % ", ".join(candidatePorts))
+    probeResults = Queue.Queue()
+    foundLock = threading.Lock()
+    found = []
+    
+    def probe(portName):
+        connection = probeEasyDaqPort(portName, timeout)
+        if connection:
+            with foundLock:
+                # if another port has already answered, we don't need this one
+                if found:
+                    connection.close()
+                    connection = None
+                else:
+                    found.append(connection)
+        probeResults.put(connection)
+    
+    for portName in candidatePorts:
+        probeThread = threading.Thread(target=probe, args=(portName,), name="EasyDaqProbe")
+        probeThread.daemon = True
+        probeThread.start()
+    
+    # wait for the first card, or for all the ports to give up. Opening a port can hang on some systems, so we
+    # never wait much longer than the probes should take
+    deadline = monotonicTime() + timeout * PROBE_ATTEMPTS + 1.0
+    for portName in candidatePorts:
+        try:
+            connection = probeResults.get(timeout=max(0, deadline - monotonicTime()))
+        except Queue.Empty:
+            break
+        if connection:
+            return connection
+    
+    # if a card turned up after we stopped waiting, close it so we can open it next time
+    with foundLock:
+        found.append(None)
+        if found[0]:
+            found[0].close()
+    return None
+
+
+class EasyDaqUSBRelay:
+
+    # a single card writes each relay change as soon as it is sent
+    writeLead = 0
+
+    def __init__(self, serialPortName,eventLoop,verifyWrites=False):
+        # capture the name of the serial port. On windows, this will be COM3, COM4 etc. The COM port is set
+        # when the relay card is first plugged into the PC. You can change it subsequently through the control panel.
+        #
+        # If we are given a list of ports, or None, we find the card ourselves when we connect, by probing the
+        # ports in the list, or all the serial ports. We look again whenever we reconnect, as the card may come
+        # back on a different port after it has been unplugged.
+        #
+        if serialPortName is None or isinstance(serialPortName, list):
+            self.discoverPort = True
+            self.candidatePorts = serialPortName
+            self.serialPortName = None
+        else:
+            self.discoverPort = False
+            self.candidatePorts = None
+            self.serialPortName = serialPortName
+        
+        #
+        # We use an event loop to schedule activity, see the top of this module. In the lights application this
+        # is the root object of the Tkinter application.
+        #
+        self.eventLoop = eventLoop
+        
+        # we use an observer model to enable observers to register for callbacks when the status of the
+        # serial port connection changes from connected to not connected
+        self.observers = []
+        
+        #
+        # we create our serial port connection now. We don't open the connection until we are asked to connect
+        #
+        # timeout is set to 0.5 second for reads. 
+        self.serialConnection = serial.Serial(timeout=0.5)
+        
+        # and tell the serial connection which serial port to connect
+        self.serialConnection.port = self.serialPortName      
+        
+        # the baud rate is always 9600
+        self.serialConnection.baudrate = 9600
+        
+        #
+        # track whether or not we are enabled. If we are enabled, then we continue to check that have an active connection
+        # and if not, we try to open the serial port. We start with not being enabled. As soon as we asked to connect,
+        # we are enabled.
+        #
+        self.isEnabled = False
+        
+        #
+        # If we are verifying writes, we follow every relay command with a read of the card's outputs to
+        # confirm that it switched, and keep a record of how long that took
+        #
+        self.verifyWrites = verifyWrites
+        self.verificationLatency = RelayLatencyHistogram()
+        self.reportedConfirmations = 0
+        
+        #
+        # When we are one of a group of cards, each relay change has a deadline shared by all the cards. We keep
+        # the recent deadlines, and how late we wrote the change, as tuples of deadline and lateness in seconds.
+        #
+        self.deadlineErrors = collections.deque(maxlen=200)
+        
+        #
+        # track the time of the last command. We default to now as the startup time
+        #
+        self.lastPacketTime = monotonicTime()
+        
+        #
+        # trace the last relay command. This enables us to resend in the event of a disconnect
+        #
+        self.lastRelayCommand = None
+        
+        #
+        # and the last configuration packet. We send it whenever we establish a session, so a configuration
+        # sent while we are disconnected is never lost
+        #
+        self.relayConfiguration = 'B' + chr(relayByte([0,0,0,0,0]))
+        
+        #
+        # We track our session status through constants DISCONNECTED,RECONNECTING,CONNECTED. The serial I/O
+        # thread owns ioSessionState, and the event loop thread sees the changes in sessionState.
+        #
+        self.sessionState = DISCONNECTED
+        self.ioSessionState = DISCONNECTED
+        self.nextReconnectTime = None
+        
+        # True while an IO_MAINTAIN command is waiting for the I/O thread
+        self.maintainQueued = False
+        
+        #
+        # All the serial port I/O happens on a separate thread, so a slow or wedged USB port never blocks the
+        # event loop thread. Commands go to the I/O thread on the command queue, and session state changes come back
+        # on the state queue, which we poll from the event loop thread.
+        #
+        self.commandQueue = RelayCommandQueue()
+        self.stateQueue = Queue.Queue()
+        self.ioThread = threading.Thread(target=self.runSession, name="EasyDaqIO")
+        self.ioThread.daemon = True
+        self.ioThread.start()
+        self.eventLoop.after(STATE_POLL_INTERVAL, self.pollSessionState)
+            
+    def setSessionState(self,state):
+        self.sessionState = state
+        logging.info("Session state is %s" % self.sessionStateDescription())
+        self.notifyObservers()
+        
+    def sessionStateDescription(self):
+        if self.sessionState == CONNECTED:
+            return "CONNECTED on %s" % self.serialPortName
+        elif self.sessionState == DISCONNECTED:
+            return "Warning: DISCONNECTED"
+        elif self.sessionState == RECONNECTING:
+            return "Warning: DISCONNECTED ATTEMPTING TO RECONNECT"
+        
+    def isConnected(self):
+        return self.sessionState == CONNECTED
+        
+    def isDisconnected(self):
+        return self.sessionState == DISCONNECTED
+        
+    def isReconnecting(self):
+        return self.sessionState == RECONNECTING
+        
+    def notifyObservers(self):
+        for anObserver in self.observers:
+            anObserver.relayStateChanged(self)
+    
+    def addObserver(self, anObserver):
+        '''
+        Add an observer to the relay. The callback the method relayStatusChanged
+        '''
+        self.observers.append(anObserver)
+        
+    def processedCommand(self):
+        '''
+        We've processed a command. Capture the current date time.
+        '''
+        self.lastCommandProcessedTime = datetime.datetime.now()
+        
+    def pollSessionState(self):
+        '''
+        Runs on the event loop thread. Pick up any session state changes posted by the serial I/O thread and
+        tell our observers about them.
+        '''
+        # we always poll again, as nothing else keeps the session alive or reconnects it
+        try:
+            try:
+                while True:
+                    self.setSessionState(self.stateQueue.get_nowait())
+            except Queue.Empty:
+                pass
+            
+            # and tell our observers if the card has confirmed any relay changes
+            if self.verificationLatency.confirmed != self.reportedConfirmations:
+                self.reportedConfirmations = self.verificationLatency.confirmed
+                for anObserver in self.observers:
+                    anObserver.relayVerificationChanged(self)
+                    
+            # the I/O thread only wakes for commands, so we tell it when the session needs keeping alive or reconnecting
+            if not self.maintainQueued:
+                secondsUntilDue = self.secondsUntilSessionDue()
+                if secondsUntilDue is not None and secondsUntilDue <= 0:
+                    self.maintainQueued = True
+                    self.commandQueue.put(IO_MAINTAIN)
+        finally:
+            self.eventLoop.after(STATE_POLL_INTERVAL, self.pollSessionState)
+        
+    def postSessionState(self, state):
+        '''
+        Runs on the serial I/O thread. Record our new state and pass it back to the event loop thread.
+        '''
+        self.ioSessionState = state
+        flightRecorder.record(FR_SESSION_STATE, state)
+        self.stateQueue.put(state)
+        
+    def beConnected(self):
+        self.postSessionState(CONNECTED)
+        
+    def beNotConnected(self):
+        self.postSessionState(DISCONNECTED)
+        
+    def beReconnecting(self):
+        # try again in five seconds. The time is set before the event loop thread can see the new state.
+        logging.info("Reconnecting to serial port")
+        self.nextReconnectTime = monotonicTime() + 5.0
+        self.postSessionState(RECONNECTING)
+        
+    def runSession(self):
+        '''
+        The serial I/O thread. If it fails, we save the flight recorder before the thread dies.
+        '''
+        try:
+            self.runSessionLoop()
+        except Exception:
+            logging.exception("Serial I/O thread failed")
+            flightRecorder.record(FR_CRASH)
+            flightRecorder.flush("crash", wait=True)
+            raise
+        
+    def runSessionLoop(self):
+        '''
+        We wait for commands on the command queue. The event loop thread sends IO_MAINTAIN when it is time to
+        keep the session alive or try to reconnect.
+        '''
+        while True:
+            self.commandQueue.waitForCommand()
+            
+            # we don't take a packet off the queue until the card is ready for it, so that
+            # a newer relay command sent in the meantime can replace it
+            if self.commandQueue.nextCommand() == IO_WRITE and self.ioSessionState == CONNECTED:
+                self.waitForWriteDeadline()
+                self.waitForPacketSpacing()
+            
+            command, packet, queuedTime, writeAt = self.commandQueue.takeCommand()
+            
+            if command == IO_WRITE:
+                self.processPacket(packet, queuedTime, writeAt)
+            elif command == IO_MAINTAIN:
+                self.maintainSession()
+                self.maintainQueued = False
+            elif command == IO_CONNECT:
+                self.openSession()
+            elif command == IO_DISCONNECT:
+                self.isEnabled = False
+                self.serialConnection.close()
+                self.beNotConnected()
+                self.logStatistics()
+            elif command == IO_SHUTDOWN:
+                self.serialConnection.close()
+                self.logStatistics()
+                return
+                
+    def logStatistics(self):
+        logging.info("Relay queue on %s: %s" % (self.serialPortName, self.commandQueue.latencySummary()))
+        if self.verifyWrites:
+            logging.info("Relay confirmation on %s: %s" % (self.serialPortName, self.verificationLatency.summary()))
+            
+    def queueSummary(self):
+        return self.commandQueue.latencySummary()
+    
+    def verificationSummary(self):
+        return self.verificationLatency.summary()
+    
+    def waitForShutdown(self, timeout):
+        self.ioThread.join(timeout)
+                
+    def secondsUntilSessionDue(self):
+        '''
+        How long until the session needs maintaining: a keepalive query when we are connected, or another attempt
+        when we are reconnecting. None means it doesn't need maintaining.
+        '''
+        if self.ioSessionState == CONNECTED:
+            return max(0, 5000 - self.timeSinceLastPacket()) / 1000.0
+        elif self.isEnabled and self.ioSessionState == RECONNECTING:
+            # read once, as the I/O thread sets it
+            nextReconnectTime = self.nextReconnectTime
+            if nextReconnectTime is None:
+                return None
+            return max(0, nextReconnectTime - monotonicTime())
+        else:
+            return None
+        
+    def maintainSession(self):
+        # if we're reconnecting, it is time to try again
+        if self.ioSessionState == RECONNECTING:
+            self.openSession()
+        
+        # otherwise, if it is more than 5000 milliseconds since the last packet, check the card is still there
+        elif self.ioSessionState == CONNECTED and self.timeSinceLastPacket() >= 5000:
+            logging.debug("Time since last packet %i so sending query packet" % self.timeSinceLastPacket())
+            # ask the EasyDaq to output its status, and read the reply
+            portState = self.queryPortState()
+            
+            # if we are verifying, check the card still has the last relay command
+            if self.verifyWrites and portState is not None and self.lastRelayCommand and portState != ord(self.lastRelayCommand[1]):
+                logging.warning("Relay outputs are %i, expected %i. Resending last relay command" % (portState, ord(self.lastRelayCommand[1])))
+                self.verificationLatency.recordMismatch()
+                self.writePacketToEasyDaq(self.lastRelayCommand)
+                
+    def queryPortState(self, timeout=None):
+        '''
+        Runs on the serial I/O thread. Write a packet that requests the EasyDaq to output its status, and read
+        the reply, waiting timeout seconds for it, or the session's timeout. Returns None if the card didn't reply.
+        '''
+        try:
+            # throw away anything left over from an earlier read, so we read the reply to this request
+            self.serialConnection.flushInput()
+        except (serial.SerialException, ValueError):
+            pass
+        
+        if not self.writePacketToEasyDaq('A' + chr(0)):
+            return None
+        
+        return self.readSession(timeout)
+        
+    def readSession(self, timeout=None):
+        '''
+        Read the single byte the card sends in reply to a request for its status. Returns None if the
+        card didn't reply in time, or the read failed, in which case we will be reconnecting.
+        '''
+        logging.debug("Reading from session")
+        sessionTimeout = self.serialConnection.timeout
+        try:
+            if timeout is not None:
+                self.serialConnection.timeout = timeout
+            try:
+                reply = self.serialConnection.read()
+            finally:
+                if timeout is not None:
+                    self.serialConnection.timeout = sessionTimeout
+            logging.debug("Read from session")
+            
+        except (serial.SerialException, ValueError) as e:
+            logging.error("I/O error: {0}".format(e))
+            self.serialConnection.close()
+            self.beReconnecting()
+            return None
+        
+        if not reply:
+            logging.warning("No reply from relay card")
+            flightRecorder.record(FR_PORT_READ, 0, 1)
+            return None
+        
+        flightRecorder.record(FR_PORT_READ, ord(reply))
+        return ord(reply)
+    
+    def verifyRelayCommand(self, relayPacket):
+        '''
+        Runs on the serial I/O thread, straight after a relay command has been written. Read back the card's
+        outputs until they match the command, rewriting the command if they don't. Each read and rewrite is
+        paced like any other packet, and we give up as soon as a newer command is waiting, as it replaces this one.
+        Each read only waits VERIFY_READ_TIMEOUT, so a light change never waits long for a read to finish.
+        '''
+        expectedState = ord(relayPacket[1])
+        writeTime = self.lastPacketTime
+        
+        for attempt in range(VERIFY_ATTEMPTS):
+            if self.commandQueue.hasCommand():
+                return
+            portState = self.queryPortState(VERIFY_READ_TIMEOUT)
+            
+            if self.ioSessionState != CONNECTED:
+                return
+            
+            if portState == expectedState:
+                self.verificationLatency.record(monotonicTime() - writeTime)
+                logging.debug("Relay confirmed %i after %.1f ms" % (expectedState, (monotonicTime() - writeTime) * 1000))
+                if self.verificationLatency.confirmed % VERIFY_LOG_INTERVAL == 0:
+                    logging.info("Relay confirmation: %s" % self.verificationLatency.summary())
+                return
+            
+            logging.warning("Relay outputs are %s, expected %i" % (portState, expectedState))
+            self.verificationLatency.recordMismatch()
+            
+            if self.commandQueue.hasCommand():
+                return
+            if not self.writePacketToEasyDaq(relayPacket):
+                return
+            
+        logging.error("Relay card did not confirm %i after %i attempts" % (expectedState, VERIFY_ATTEMPTS))
+        self.verificationLatency.recordFailure()
+    
+    
+    def establishSession(self):
+        logging.debug("Establishing session")
+        
+        previousState = self.ioSessionState
+        
+        # configure the card. If this fails we will already be reconnecting
+        if not self.writePacketToEasyDaq(self.relayConfiguration):
+            return
+        
+        # and be connected
+        self.beConnected()
+        
+        if previousState == RECONNECTING and self.lastRelayCommand:
+            logging.info("Recovering ... sending last relay command: %s" % self.printableCommand(self.lastRelayCommand))
+            self.writePacketToEasyDaq(self.lastRelayCommand)
+    
+    def openSession(self):
+        # we are sometimes trying to connect when we are already
+        # connected
+        if self.ioSessionState != CONNECTED:
+            self.isEnabled = True
+            if self.discoverPort:
+                self.discoverSession()
+                return
+            
+            logging.debug("Connecting to serial port")
+            try:
+                # try to open the serial port
+                if self.serialConnection.isOpen():
+                    logging.debug("Request to open serial port when already open")
+                else:
+                    self.serialConnection.open()
+                    logging.debug("Connected to serial port")
+            
+            except (serial.SerialException,ValueError) as e:           
+                logging.error("I/O error: {0}".format(e))
+                self.serialConnection.close()
+                self.beReconnecting()
+                return
+            
+            # wait for the card to settle and establish the session
+            if not self.waitForCardReply():
+                logging.warning("No reply from relay card on %s, connecting anyway" % self.serialPortName)
+            # if the port failed while we waited, we are already reconnecting
+            if self.serialConnection.isOpen():
+                self.establishSession()
+        else:
+            logging.debug("Request for connect when already connected")
+            
+    def discoverSession(self):
+        '''
+        Runs on the serial I/O thread. Find the port with the card on it and establish the session. The card has
+        already replied to the probe, so it is ready and we don't need to wait for it to settle.
+        '''
+        self.serialConnection.close()
+        connection = discoverEasyDaqPort(self.candidatePorts)
+        if not connection:
+            logging.warning("No EasyDaq card found")
+            self.beReconnecting()
+            return
+        
+        connection.timeout = self.serialConnection.timeout
+        self.serialConnection = connection
+        self.serialPortName = connection.port
+        logging.info("Found EasyDaq card on %s" % self.serialPortName)
+        self.establishSession()
+        
+    def waitForCardReply(self):
+        '''
+        Runs on the serial I/O thread, after we open the port. Ask the card for its outputs until it replies,
+        rather than waiting for a fixed time. Returns True if it replied. If the port fails we will be reconnecting.
+        '''
+        deadline = monotonicTime() + SETTLE_TIMEOUT
+        while monotonicTime() < deadline:
+            if self.queryPortState() is not None:
+                return True
+            if not self.serialConnection.isOpen():
+                return False
+        return False
+            
+    def connect(self):
+        self.commandQueue.put(IO_CONNECT)
+    
+    def disconnect(self):
+        self.commandQueue.put(IO_DISCONNECT)
+        
+    def shutdown(self):
+        '''
+        Close the serial port and stop the I/O thread once any queued packets have been written
+        '''
+        self.commandQueue.put(IO_SHUTDOWN)
+        
+    def timeSinceLastPacket(self):
+        '''
+        calculate the time in milliseconds since the last command
+        '''
+        return int((monotonicTime() - self.lastPacketTime) * 1000)
+    
+    
+    def processPacket(self, relayPacket, queuedTime, writeAt=None):
+        '''
+        Runs on the serial I/O thread. Write a packet that was sent to us through the command queue.
+        '''
+        #
+        # Not the most elegant, but we check to see if this packet is a command by looking for a C as the first byte of the packet.
+        # We remember the last command, so we can play it in when we recover the session.
+        #
+        if relayPacket[0] == 'C':
+            self.lastRelayCommand = relayPacket
+        elif relayPacket[0] == 'B':
+            self.relayConfiguration = relayPacket
+        
+        # if we are connected, we write the packet. If we are not connected,
+        # the session recovery will play in the configuration and the relay command
+        if self.ioSessionState == CONNECTED:
+            if self.writePacketToEasyDaq(relayPacket):
+                self.commandQueue.recordLatency(queuedTime)
+                if writeAt is not None:
+                    self.deadlineErrors.append((writeAt, self.lastPacketTime - writeAt))
+                
+                if self.verifyWrites and relayPacket[0] == 'C':
+                    self.verifyRelayCommand(relayPacket)
+    
+    def nextWriteTime(self):
+        '''
+        The earliest time the card will be ready for another packet
+        '''
+        return self.lastPacketTime + 0.1
+    
+    def waitForWriteDeadline(self):
+        '''
+        Runs on the serial I/O thread. If the next packet has a deadline, wait for it. A newer relay command can
+        replace the packet while we wait, so we check the deadline again when we wake up.
+        '''
+        while True:
+            writeAt = self.commandQueue.nextWriteAt()
+            if writeAt is None:
+                return
+            remaining = writeAt - monotonicTime()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+    
+    def waitForPacketSpacing(self):
+        if self.timeSinceLastPacket() < 100:
+            logging.debug("Delaying writing packet to easyDaq")
+            time.sleep((100 - self.timeSinceLastPacket()) / 1000.0)
+    
+    def writePacketToEasyDaq(self, relayPacket):
+        '''
+        Runs on the serial I/O thread. Write a packet to EasyDaq. If we have written a packet within the last
+        100 milliseconds, then wait until 100 milliseconds have passed so we don't overwhelm the card.
+        Returns False if the write failed.
+        '''
+        self.waitForPacketSpacing()
+        
+        try:
+            logging.debug("Writing to serial port: %s" % self.printableCommand(relayPacket))
+            self.serialConnection.write(relayPacket)
+            
+            self.lastPacketTime = monotonicTime()
+            flightRecorder.record(FR_PACKET_WRITTEN, ord(relayPacket[0]), ord(relayPacket[1]))
+            return True
+        except (serial.SerialException,ValueError) as e:
+            logging.error("I/O error: {0}".format(e))
+            self.serialConnection.close()
+            self.beReconnecting()
+            return False
+    
+    def printableCommand(self,relayCommand):
+        return relayCommand[0] + "," + str(ord(relayCommand[1]))
+
+    def sendRelayCommand(self,relayArray):
+        self.sendRelayByte(relayByte(relayArray))
+
+    def sendRelayByte(self,commandValue,writeAt=None):
+        '''
+        Queue a relay change, to be written as soon as we can, or at writeAt if it is given
+        '''
+        # the flight recorder captures every relay change, so we only log them when debugging
+        flightRecorder.record(FR_RELAY_QUEUED, commandValue)
+        logging.debug("Sending C + %i" % commandValue)
+        self.commandQueue.put(IO_WRITE, 'C' + chr(commandValue), writeAt)
+        for anObserver in self.observers:
+            anObserver.relayCommandSent(self, commandValue)
+
+        
+    def sendRelayConfiguration(self,relayArray):
+        commandValue = relayByte(relayArray)
+
+        logging.info("Sending B + %i" % commandValue)        
+        self.commandQueue.put(IO_WRITE, 'B' + chr(commandValue))
+
+
+class EasyDaqRelayGroup(object):
+    '''
+    A group of EasyDaq cards that show the same lights, for example on two start lines, or a mirror panel
+    on shore. It looks like a single EasyDaqUSBRelay to the rest of the application.
+    
+    Each card keeps its own session and I/O thread. Every relay change is sent to all the cards with the same
+    deadline, and each card's I/O thread writes it at that deadline, so the cards change together. The start
+    sequence sends us each change writeLead seconds ahead of its deadline, so that every card is ready for it.
+    We measure the skew, the spread between the first and last card to write each change, and how far each
+    card's writes were from their deadlines.
+    '''
+    writeLead = GROUP_WRITE_LEAD
+    
+    def __init__(self, serialPortNames, eventLoop, verifyWrites=False):
+        self.relays = [EasyDaqUSBRelay(serialPortName, eventLoop, verifyWrites) for serialPortName in serialPortNames]
+        self.observers = []
+        for relay in self.relays:
+            relay.addObserver(self)
+            
+    def addObserver(self, anObserver):
+        self.observers.append(anObserver)
+        
+    def relayStateChanged(self, easyDaqRelay):
+        for anObserver in self.observers:
+            anObserver.relayStateChanged(self)
+            
+    def relayVerificationChanged(self, easyDaqRelay):
+        for anObserver in self.observers:
+            anObserver.relayVerificationChanged(self)
+            
+    def relayCommandSent(self, easyDaqRelay, commandValue):
+        # we tell our observers once for the whole group, in sendRelayByte
+        pass
+            
+    def isConnected(self):
+        '''
+        We can run a sequence as long as at least one card is connected. The others replay the last relay
+        command when they reconnect.
+        '''
+        for relay in self.relays:
+            if relay.isConnected():
+                return True
+        return False
+    
+    def sessionStateDescription(self):
+        return "; ".join(["Card %i %s" % (cardNumber + 1, self.relays[cardNumber].sessionStateDescription())
+            for cardNumber in range(len(self.relays))])
+    
+    def connect(self):
+        for relay in self.relays:
+            relay.connect()
+            
+    def disconnect(self):
+        for relay in self.relays:
+            relay.disconnect()
+            
+    def shutdown(self):
+        for relay in self.relays:
+            relay.shutdown()
+            
+    def waitForShutdown(self, timeout):
+        deadline = monotonicTime() + timeout
+        for relay in self.relays:
+            relay.waitForShutdown(max(0, deadline - monotonicTime()))
+            
+    def alignedWriteTime(self, deadline=None):
+        '''
+        The time every card should write the next relay change: its deadline, or a little ahead of now if it
+        doesn't have one, and no earlier than every connected card is ready for another packet
+        '''
+        if deadline is None:
+            writeAt = monotonicTime() + GROUP_WRITE_LEAD
+        else:
+            writeAt = deadline
+        for relay in self.relays:
+            if relay.isConnected():
+                writeAt = max(writeAt, relay.nextWriteTime())
+        return writeAt
+    
+    def sendRelayCommand(self, relayArray):
+        self.sendRelayByte(relayByte(relayArray))
+        
+    def sendRelayByte(self, commandValue, writeAt=None):
+        writeAt = self.alignedWriteTime(writeAt)
+        for relay in self.relays:
+            relay.sendRelayByte(commandValue, writeAt)
+        for anObserver in self.observers:
+            anObserver.relayCommandSent(self, commandValue)
+            
+    def sendRelayConfiguration(self, relayArray):
+        for relay in self.relays:
+            relay.sendRelayConfiguration(relayArray)
+            
+    def queueSummary(self):
+        return "; ".join(["%s: %s" % (relay.serialPortName, relay.queueSummary()) for relay in self.relays])
+    
+    def verificationSummary(self):
+        return "; ".join(["%s: %s" % (relay.serialPortName, relay.verificationSummary()) for relay in self.relays])
+    
+    def skewSummary(self):
+        '''
+        Describe how closely the cards changed together, over the recent changes written by every card, and the
+        signed error of each card's writes against their deadlines
+        '''
+        errorsByDeadline = {}
+        for relay in self.relays:
+            for writeAt, lateness in list(relay.deadlineErrors):
+                errorsByDeadline.setdefault(writeAt, []).append(lateness)
+        
+        skews = sorted([max(errors) - min(errors) for errors in errorsByDeadline.values() if len(errors) == len(self.relays)])
+        if not skews:
+            return "no changes written by every card"
+        
+        cardLateness = []
+        for relay in self.relays:
+            lateness = [error for writeAt, error in list(relay.deadlineErrors)]
+            cardLateness.append("%s error against deadline mean %+.1f ms, worst %+.1f ms" % (relay.serialPortName,
+                sum(lateness) / len(lateness) * 1000, max(lateness, key=abs) * 1000))
+        
+        return "%i changes, skew p50 %.1f ms, p95 %.1f ms, max %.1f ms; %s" % (len(skews),
+            skews[len(skews) // 2] * 1000, skews[int(len(skews) * 0.95)] * 1000, skews[-1] * 1000,
+            "; ".join(cardLateness))
+    
+    def logStatistics(self):
+        for relay in self.relays:
+            relay.logStatistics()
+        logging.info("Relay group: %s" % self.skewSummary())
+
+    
+class RelayTimelineEvent(object):
+    '''
+    A single relay change in a compiled start sequence: the monotonic deadline at which it should happen,
+    the relay byte to send and, for the first event of a step, the number of the step it starts.
+    '''
+    def __init__(self, deadline, commandValue, stepNumber=None, finishesSequence=False):
+        self.deadline = deadline
+        self.commandValue = commandValue
+        self.stepNumber = stepNumber
+        self.finishesSequence = finishesSequence
+
+    def __str__(self):
+        return "%f C + %i" % (self.deadline, self.commandValue)
+
+
+class StartRaceSequence(object):
+    def __init__(self, clock=monotonicTime, testSpeedRatio=1):
+        # the clock we time the sequence against. This is our monotonic clock, unless we are running against
+        # a virtual clock
+        self.clock = clock
+        # how much faster than real time we run the steps
+        self.testSpeedRatio = testSpeedRatio
+        # the time between toggles of flashing lights. It isn't scaled by testSpeedRatio, so the lights flash
+        # as they will on the day, but a benchmark can change it
+        self.flashInterval = FLASH_INTERVAL_SECONDS
+        self.startRaceSteps = []
+        self.raceStartTime = None
+        self.isRunning = False
+        self.raceStartTime = None
+        self.raceFinishCallback = None
+        self.observers = []
+        self.timeline = []
+        self.dispatchTimer = None
+        
+    def notifyObservers(self):
+        for anObserver in self.observers:
+            anObserver.startRaceSequenceChanged(self)
+    
+    def addObserver(self, anObserver):
+        '''
+        Add an observer to the relay. The callback the method relayStatusChanged
+        '''
+        self.observers.append(anObserver)
+        
+    def addStartStep(self, aStartStep):
+        self.startRaceSteps.append(aStartStep)
+        
+    def start(self,easyDaqRelay,eventLoop):
+        self.isRunning = True
+        self.eventLoop = eventLoop
+        self.easyDaqRelay = easyDaqRelay
+        self.currentStepNumber = 0
+        
+        # convert the race start time into a deadline on our monotonic clock. From here on
+        # everything is timed against the monotonic clock.
+        self.raceStartDeadline = self.clock() + (self.raceStartTime - datetime.datetime.now()).total_seconds()
+        
+        self.compileTimeline()
+        flightRecorder.record(FR_SEQUENCE_STARTED, 0, len(self.timeline))
+        self.nextEventNumber = 0
+        self.dispatchDueEvents()
+        
+    def reset(self):
+        if self.dispatchTimer:
+            self.eventLoop.after_cancel(self.dispatchTimer)
+            self.dispatchTimer = None
+        flightRecorder.record(FR_SEQUENCE_RESET)
+        self.isRunning = False
+        self.startRaceSteps = []
+        self.timeline = []
+        self.notifyObservers()
+        
+    def stepStartDeadline(self, aStartStep):
+        return self.raceStartDeadline - (float(aStartStep.fromSecondsBefore) / self.testSpeedRatio)
+    
+    def stepFinishDeadline(self, aStartStep):
+        return self.raceStartDeadline - (float(aStartStep.toSecondsBefore) / self.testSpeedRatio)
+        
+    def compileTimeline(self):
+        '''
+        Compile every relay change in the sequence, including each flash toggle, into a list of events
+        sorted by deadline. The final event turns off all the lights at the race start.
+        '''
+        self.timeline = []
+        
+        for stepNumber in range(len(self.startRaceSteps)):
+            aStartStep = self.startRaceSteps[stepNumber]
+            self.timeline.extend(aStartStep.timelineEvents(stepNumber,
+                self.stepStartDeadline(aStartStep), self.stepFinishDeadline(aStartStep), self.flashInterval))
+        
+        self.timeline.append(RelayTimelineEvent(self.stepFinishDeadline(self.startRaceSteps[-1]),
+            relayByte([LIGHT_OFF, LIGHT_OFF, LIGHT_OFF, LIGHT_OFF, LIGHT_OFF]), finishesSequence=True))
+        
+        # sort is stable, so events with the same deadline stay in sequence order
+        self.timeline.sort(key=lambda event: event.deadline)
+        
+        logging.info("Compiled timeline of %i relay events for %i steps" % (len(self.timeline), len(self.startRaceSteps)))
+        
+    def dispatchDueEvents(self):
+        '''
+        Send every event that is now due, then schedule ourselves for the deadline of the next one.
+        '''
+        self.dispatchTimer = None
+        stepChanged = False
+        writeLead = self.relayWriteLead()
+        
+        while self.isRunning and self.nextEventNumber < len(self.timeline):
+            event = self.timeline[self.nextEventNumber]
+            if event.deadline - writeLead > self.clock() + DISPATCH_TOLERANCE_SECONDS:
+                break
+            
+            if writeLead:
+                self.easyDaqRelay.sendRelayByte(event.commandValue, event.deadline)
+            else:
+                self.easyDaqRelay.sendRelayByte(event.commandValue)
+            self.nextEventNumber += 1
+            
+            if event.stepNumber is not None:
+                self.currentStepNumber = event.stepNumber
+                flightRecorder.record(FR_STEP_STARTED, 0, event.stepNumber)
+                stepChanged = True
+                logging.info("Step %i %s duration will be %f" % (self.currentStepNumber, self.currentStep(),
+                    self.stepFinishDeadline(self.currentStep()) - self.clock()))
+                
+            if event.finishesSequence:
+                flightRecorder.record(FR_SEQUENCE_FINISHED)
+                self.isRunning = False
+                stepChanged = True
+        
+        if self.isRunning and self.nextEventNumber < len(self.timeline):
+            delay = self.timeline[self.nextEventNumber].deadline - writeLead - self.clock()
+            self.dispatchTimer = self.eventLoop.after(max(0, int(round(delay * 1000))), self.dispatchDueEvents)
+            
+        if stepChanged:
+            self.notifyObservers()
+    
+    def relayWriteLead(self):
+        '''
+        How far ahead of its deadline the relay wants each change, so that it can write it at the deadline. Our
+        deadlines only mean the same to the relay when we run on the monotonic clock.
+        '''
+        if self.clock is not monotonicTime:
+            return 0
+        return self.easyDaqRelay.writeLead
+    
+    def currentStep(self):
+        return self.startRaceSteps[self.currentStepNumber]
+        
+    def hasNextStep(self):
+        return not self.nextStep() == None
+        
+    def nextStep(self):
+        if self.currentStepNumber < (len(self.startRaceSteps)-1):
+            return self.startRaceSteps[self.currentStepNumber+1]
+        else:
+            return None
+
+    def currentStepSecondsRemaining(self):
+        timeRemaining = self.stepFinishDeadline(self.currentStep()) - self.clock()
+        
+        return int(max(0, timeRemaining))
+            
+         
+        
+class StartRaceStep(object):
+    def __init__(self, fromSecondsBefore, toSecondsBefore, lightState, description):
+        self.fromSecondsBefore = fromSecondsBefore
+        self.toSecondsBefore = toSecondsBefore
+        self.lightState = lightState
+        self.description = description
+        
+        
+    def __str__(self):
+        return "%s for %d seconds" % (self.description, (self.fromSecondsBefore - self.toSecondsBefore))
+        
+    def timelineEvents(self, stepNumber, startDeadline, finishDeadline, flashInterval=FLASH_INTERVAL_SECONDS):
+        '''
+        Return the relay events for this step, between its start and finish deadlines
+        '''
+        if LIGHT_FLASHING in self.lightState:
+            return self.flashingLightsEvents(stepNumber, startDeadline, finishDeadline, flashInterval)
+        else:
+            return [RelayTimelineEvent(startDeadline, relayByte(self.lightState), stepNumber)]
+        
+    def flashingLightsEvents(self, stepNumber, startDeadline, finishDeadline, flashInterval=FLASH_INTERVAL_SECONDS):
+        events = []
+        flashingState = 0
+        deadline = startDeadline
+        
+        while deadline < finishDeadline:
+            # increment our state
+            flashingState += 1
+            
+            # if we are on an even state, 
+            if (flashingState % 2 == 0):
+            
+                # this cryptic looking statement creates a copy of the
+                # light state list turning LIGHT_FLASHING to LIGHT_ON
+                
+                lightStateIteration = [LIGHT_ON if light == LIGHT_FLASHING else light for light in self.lightState]
+             
+            else:
+                lightStateIteration = [LIGHT_OFF if light == LIGHT_FLASHING else light for light in self.lightState]
+            
+            # only the first toggle marks the start of the step
+            if flashingState == 1:
+                events.append(RelayTimelineEvent(deadline, relayByte(lightStateIteration), stepNumber))
+            else:
+                events.append(RelayTimelineEvent(deadline, relayByte(lightStateIteration)))
+            
+            # each deadline is calculated from the start of the step, so rounding errors don't accumulate
+            deadline = startDeadline + flashingState * flashInterval
+            
+        return events
+            
+def addFFlagStep(sequence,numberStarts):
+
+    # 
+    # We calculate the end time for the F Flag step as five minutes per numberStarts . The start time is five minutes earlier.
+    sequence.addStartStep(StartRaceStep(300 + numberStarts*300, 0 + numberStarts*300,[LIGHT_OFF,LIGHT_OFF, LIGHT_OFF, LIGHT_OFF, LIGHT_OFF], "F Flag, 10 minute warning"))
+            
+def addFiveMinuteStarts(sequence, numberStarts):
+
+
+    for i in range(numberStarts):
+    
+        # we need to add on N race worth's of delay,
+        # where N is the number of races after this race
+        racesAfter = numberStarts - (i+1)
+        
+        raceDelay = racesAfter * 300
+        
+        descriptionRaceNumber = i + 1
+        
+
+        sequence.addStartStep(StartRaceStep(300 + raceDelay,240+ raceDelay,[LIGHT_ON, LIGHT_ON, LIGHT_ON, LIGHT_ON, LIGHT_ON],"Race %d, 5 minute lights" % descriptionRaceNumber))
+        sequence.addStartStep(StartRaceStep(240+ raceDelay,180+ raceDelay,[ LIGHT_ON, LIGHT_ON, LIGHT_ON, LIGHT_ON,LIGHT_OFF],"Race %d, 4 minute lights" % descriptionRaceNumber))
+        sequence.addStartStep(StartRaceStep(180+ raceDelay,120+ raceDelay,[LIGHT_ON, LIGHT_ON, LIGHT_ON,LIGHT_OFF, LIGHT_OFF ],"Race %d, 3 minute lights" % descriptionRaceNumber))
+        sequence.addStartStep(StartRaceStep(120+ raceDelay,60+ raceDelay,[LIGHT_ON, LIGHT_ON, LIGHT_OFF, LIGHT_OFF, LIGHT_OFF ],"Race %d, 2 minute lights" % descriptionRaceNumber))
+        sequence.addStartStep(StartRaceStep(60+ raceDelay,30+ raceDelay,[LIGHT_ON,LIGHT_OFF, LIGHT_OFF, LIGHT_OFF, LIGHT_OFF],"Race %d, 1 minute lights" % descriptionRaceNumber))
+        sequence.addStartStep(StartRaceStep(30+ raceDelay,0+ raceDelay,[LIGHT_FLASHING,LIGHT_OFF, LIGHT_OFF, LIGHT_OFF, LIGHT_OFF ],"Race %d, 30 seconds lights" % descriptionRaceNumber))
+        
@@ -0,0 +1,102 @@
+'''
+Run a race start sequence without a user interface, for example on a Raspberry Pi by the start line.
+
+Usage:
+-p [serial port of the relay card, or a comma separated list to probe, repeat for more cards, default is to probe
+all the serial ports] -s [number of starts, default 1] -c (class flag sequence, default is F flag)
+-m [minutes to sequence start, default 0] -t [test speed ratio, default 1] -v (read back every relay change)
+-r [directory for flight recorder files, default is the current directory]
+
+This runs the same sequence and relay code as TkLights.py, from LightsCore.py, on a RealTimeEventLoop rather than
+the Tk event loop. It connects to the relay, waits for the sequence start, runs the sequence, turns the lights off
+and exits. The steps are logged as they start, and the flight recorder is written at the end.
+'''
+import datetime
+import logging
+import sys
+import getopt
+
+import LightsCore
+from LightsCore import flightRecorder, monotonicTime
+
+
+def runStartSequence(easyDaqRelay, eventLoop, numberStarts, isFFlagStart, minutesToSequenceStart, speedRatio):
+    sequence = LightsCore.StartRaceSequence(eventLoop.clock, speedRatio)
+    if isFFlagStart:
+        LightsCore.addFFlagStep(sequence, numberStarts)
+        startSequenceMinutesDuration = 5 * numberStarts + 5
+    else:
+        startSequenceMinutesDuration = 5 * numberStarts
+    LightsCore.addFiveMinuteStarts(sequence, numberStarts)
+
+    startDelay = float(minutesToSequenceStart) * 60 / speedRatio
+    sequence.raceStartTime = (datetime.datetime.now() + datetime.timedelta(seconds=startDelay)
+        + datetime.timedelta(minutes=startSequenceMinutesDuration) / speedRatio)
+    logging.info("Starting light sequence in %d seconds, race start at %s" % (startDelay, sequence.raceStartTime))
+
+    sequenceStarted = []
+
+    def startSequence():
+        sequenceStarted.append(monotonicTime())
+        sequence.start(easyDaqRelay, eventLoop)
+
+    eventLoop.after(int(round(startDelay * 1000)), startSequence)
+    eventLoop.runUntil(lambda: sequenceStarted and not sequence.isRunning)
+
+
+def main():
+    comPorts = []
+    numberStarts = 1
+    isFFlagStart = True
+    minutesToSequenceStart = 0
+    speedRatio = 1
+    verifyWrites = False
+
+    myopts, args = getopt.getopt(sys.argv[1:], "p:s:cm:t:vr:", ["port=", "starts=", "classFlag", "minutes=", "testSpeedRatio=", "verify", "recorder="])
+    for o, a in myopts:
+        if o in ('-p', '--port'):
+            if ',' in a:
+                comPorts.append(a.split(','))
+            else:
+                comPorts.append(a)
+        elif o in ('-s', '--starts'):
+            numberStarts = int(a)
+        elif o in ('-c', '--classFlag'):
+            isFFlagStart = False
+        elif o in ('-m', '--minutes'):
+            minutesToSequenceStart = int(a)
+        elif o in ('-t', '--testSpeedRatio'):
+            speedRatio = int(a)
+        elif o in ('-v', '--verify'):
+            verifyWrites = True
+        elif o in ('-r', '--recorder'):
+            flightRecorder.directory = a
+
+    eventLoop = LightsCore.RealTimeEventLoop()
+    if len(comPorts) > 1:
+        easyDaqRelay = LightsCore.EasyDaqRelayGroup(comPorts, eventLoop, verifyWrites)
+    elif comPorts:
+        easyDaqRelay = LightsCore.EasyDaqUSBRelay(comPorts[0], eventLoop, verifyWrites)
+    else:
+        easyDaqRelay = LightsCore.EasyDaqUSBRelay(None, eventLoop, verifyWrites)
+
+    easyDaqRelay.connect()
+    try:
+        eventLoop.runUntil(easyDaqRelay.isConnected)
+        logging.info(easyDaqRelay.sessionStateDescription())
+        runStartSequence(easyDaqRelay, eventLoop, numberStarts, isFFlagStart, minutesToSequenceStart, speedRatio)
+    except KeyboardInterrupt:
+        logging.warning("Interrupted, turning the lights off")
+        flightRecorder.record(LightsCore.FR_SEQUENCE_RESET)
+
+    easyDaqRelay.sendRelayCommand([LightsCore.LIGHT_OFF] * 5)
+    easyDaqRelay.logStatistics()
+    easyDaqRelay.shutdown()
+    easyDaqRelay.waitForShutdown(2.0)
+    flightRecorder.flush("sequence", wait=True)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+        format = "%(levelname)s:%(asctime)-15s %(message)s")
+    main()
@@ -4,11 +4,25 @@ Created on 4 Aug 2013
 @author: Matthew Bradley
 
 Usage: 
--p [serial port to connect to] -t [default 1, set to more than 1 to run faster]
+-p [serial port to connect to] -t [default 1, set to more than 1 to run faster] -v (read back every relay change)
+-r [directory for flight recorder files, default is the current directory]
+
+If no serial port is given, we probe all the serial ports at startup and use the one with the EasyDaq card on it.
+You can also give a comma separated list of ports to probe, e.g. -p /dev/pts/3,/dev/pts/4
+
+To show the same lights on more than one card, for example on two start lines, give -p once for each card.
+
+-n [host:]port starts the network control server, which streams the state of the lights to remote displays and
+accepts commands from them, see LightsControlServer.py. It listens on localhost unless a host is given, e.g.
+-n 0.0.0.0:8765 for the committee boat tablet. Anywhere but localhost, it also needs -k [token], which every
+remote display must give before it can see or control the lights. -o [comma separated origins] lists the web pages
+allowed to connect from a browser, e.g. -o http://tablet.local:8000, as well as pages on localhost.
 
 This is a quick and dirty implementation of an application to allow the race team at HillHead to control the race start lights. It is written
 in Python using the pyserial module to talk to the EasyDaq USB relay over a serial port, and the Tk widget toolkit to provide the user interface.
-The application is single threaded, and uses the Tk event scheduler to queue any asnchronous activity, including managing the serial interface.
+The user interface is single threaded, and uses the Tk event scheduler to queue any asnchronous activity. The serial interface to the relay
+runs on its own thread, so a slow USB port never holds up the user interface. The sequence and the relay are in LightsCore.py, which
+doesn't need Tk.
 
 Note that pyserial is not part of the standard ActivePython distribution, see pyserial.sourceforge.net. To install pyserial, first install
 ActivePython then type the following from the command prompt:
@@ -21,12 +35,14 @@ import tkMessageBox as tkMB
 import ttk as ttk
 import tkFont
 import datetime
-import serial
 import time
 import logging
 import sys
 import getopt
 
+# the sequence and the relay, which we run on the Tk event loop
+from LightsCore import *
+
 
 '''
  Changes
@@ -48,6 +64,15 @@ for example if the race team forget to start initiate the lights countdown befor
 
 testSpeedRatio = 1
 comPort = None
+mirrorComPorts = []
+verifyRelayWrites = False
+controlServerAddress = None
+controlServerToken = None
+controlServerOrigins = []
+
+# the starts and the minutes to the sequence start we allow, from the spinboxes or from remote clients
+STARTS_RANGE = (1, 9)
+MINUTES_TO_SEQUENCE_RANGE = (0, 5)
 
 
 
@@ -58,498 +83,218 @@ logging.basicConfig(level=logging.INFO,
 # how much faster we want the steps to go for testing
 testSpeedRatio = 1
 
-# constants for lights state
-LIGHT_OFF = 0
-LIGHT_ON = 1
-LIGHT_FLASHING = 2
-
-# constants for serial port session state
-DISCONNECTED = 0
-RECONNECTING = 1
-CONNECTED = 2
-
+def millisecondsToNextSecond(secondsRemaining):
+    '''
+    The delay until a countdown with secondsRemaining left next shows a different number of whole seconds
+    '''
+    return int((secondsRemaining % 1.0) * 1000) + 1
 
-class EasyDaqUSBRelay:
 
-    def __init__(self, serialPortName,tkRoot):
-        # capture the name of the serial port. On windows, this will be COM3, COM4 etc. The COM port is set
-        # when the relay card is first plugged into the PC. You can change it subsequently through the control panel.
-        self.serialPortName = serialPortName
-        
-        #
-        # We use the Tkinter event mechanism to schedule activity. You must therefore pass the root object of your Tkinter application
-        #
-        self.tkRoot = tkRoot
-        
-        # we use an observer model to enable observers to register for callbacks when the status of the
-        # serial port connection changes from connected to not connected
-        self.observers = []
-        
-        #
-        # we create our serial port connection now. We don't open the connection until we are asked to connect
-        #
-        # timeout is set to 0.5 second for reads. 
-        self.serialConnection = serial.Serial(timeout=0.5)
-        
-        # and tell the serial connection which serial port to connect
-        self.serialConnection.port = self.serialPortName      
-        
-        # the baud rate is always 9600
-        self.serialConnection.baudrate = 9600
-        
-        #
-        # track whether or not we are enabled. If we are enabled, then we continue to check that have an active connection
-        # and if not, we try to open the serial port. We start with not being enabled. As soon as we asked to connect,
-        # we are enabled.
-        #
-        self.isEnabled = False
-        
-        
-        #
-        # track the time of the last command. We default to now as the startup time
-        #
-        self.lastPacketTime = datetime.datetime.now()
-        
-        #
-        # trace the previous relay command. This enables us to resend in the event of a disconnect
-        #
-        self.currentRelayCommand = None
-        self.previousRelayCommand = None
-        
-        #
-        # We track our session status through constants DISCONNECTED,RECONNECTING,CONNECTED
-        #
-        self.sessionState = DISCONNECTED
-            
-    def setSessionState(self,state):
-        self.sessionState = state
-        logging.info("Session state is %s" % self.sessionStateDescription())
-        self.notifyObservers()
-        
-    def beConnected(self):
-        self.setSessionState(CONNECTED)
-        
-    def beNotConnected(self):
-        self.setSessionState(DISCONNECTED)
-        
-    def beReconnecting(self):
-        self.setSessionState(RECONNECTING)
-        
-        
-    def sessionStateDescription(self):
-        if self.sessionState == CONNECTED:
-            return "CONNECTED"
-        elif self.sessionState == DISCONNECTED:
-            return "Warning: DISCONNECTED"
-        elif self.sessionState == RECONNECTING:
-            return "Warning: DISCONNECTED ATTEMPTING TO RECONNECT"
-        
-    def isConnected(self):
-        return self.sessionState == CONNECTED
-        
-    def isDisconnected(self):
-        return self.sessionState == DISCONNECTED
-        
-    def isReconnecting(self):
-        return self.sessionState == RECONNECTING
-        
-    def notifyObservers(self):
-        for anObserver in self.observers:
-            anObserver.relayStateChanged(self)
-    
-    def addObserver(self, anObserver):
-        '''
-        Add an observer to the relay. The callback the method relayStatusChanged
-        '''
-        self.observers.append(anObserver)
+class CallbackLoadMonitor(object):
+    '''
+    Measures the load we put on the Tk main loop: how many timer callbacks run, how long they take and
+    how late they start.
+    '''
+    def __init__(self):
+        self.startTime = monotonicTime()
+        self.callbacks = 0
+        self.busyTime = 0.0
+        self.maximumRunTime = 0.0
+        self.maximumLateness = 0.0
         
-    def processedCommand(self):
-        '''
-        We've processed a command. Capture the current date time.
-        '''
-        self.lastCommandProcessedTime = datetime.datetime.now()
+    def wrap(self, milliseconds, callback):
+        dueTime = monotonicTime() + milliseconds / 1000.0
         
-    def maintainSession(self):
-        # check the number of milliseconds since the last command.
-        # If it is more than 5000 milliseconds
-        if self.isConnected():
-            logging.debug("Maintaining session")
-            
-            if (self.timeSinceLastPacket() > 5000):
-                try:
-                    logging.debug("Time since last packet %i so sending query packet" % self.timeSinceLastPacket())
-                    # create a relay packet that requests the EasyDaq to output its status
-                    self.currentRelayPacket = 'A' + chr(0)
-                    # and queue a request
-                    self.queuePacketToEasyDaq()
-                    # schedule a read for 500 milliseconds
-                    self.tkRoot.after(500,self.readSession)
-                    # and schedule to do this again in 5000 milli
-                    self.tkRoot.after(5000,self.maintainSession)
-                except (serial.SerialException):
-                    logging.debug("Exception writing read request to session")
-                    self.beNotConnected()
-                    self.reconnect()
-            # otherwise maintain session when 5000 millis has elapsed
-            else:
-                self.tkRoot.after(5000-self.timeSinceLastPacket(),self.maintainSession)
+        def measuredCallback(*args):
+            startTime = monotonicTime()
+            try:
+                return callback(*args)
+            finally:
+                runTime = monotonicTime() - startTime
+                self.callbacks += 1
+                self.busyTime += runTime
+                self.maximumRunTime = max(self.maximumRunTime, runTime)
+                self.maximumLateness = max(self.maximumLateness, startTime - dueTime)
                 
-        
-    def readSession(self):
-        logging.debug("Reading from session")
-        try:
-            # read a single byte. This should be our current status but at the moment we don't check for that
-            x = self.serialConnection.read()
-            logging.debug("Read from session")
-            
-        except (serial.SerialException, ValueError) as e:
-            logging.error("I/O error: {0}".format(e))
-            self.serialConnection.close()
-            self.beReconnecting()
-            self.reconnect()
-    
+        return measuredCallback
     
-    def establishSession(self):
-        logging.debug("Establishing session in state: %s" % self.sessionStateDescription() )
-        self.sendRelayConfiguration([0,0,0,0,0])
-        
-        previousState = self.sessionState
-        
-        # and be connected
-        self.beConnected()
-        
-        if previousState == RECONNECTING:
-                
-            if self.currentRelayCommand:
-                logging.info("Recovering ... sending current relay command: %s" % self.printableCommand(self.currentRelayCommand))
-                self.currentRelayPacket = self.currentRelayCommand
-                self.queuePacketToEasyDaq()
-            elif self.previousRelayCommand:
-                logging.info("Recovering ... sending previous relay command: %s" % self.printableCommand(self.previousRelayCommand))
-                self.currentRelayPacket = self.previousRelayCommand
-                self.queuePacketToEasyDaq()
-        self.tkRoot.after(5000,self.maintainSession)
+    def summary(self):
+        elapsedTime = monotonicTime() - self.startTime
+        return "%i callbacks in %.0f seconds, %.2f%% busy, longest %.1f ms, latest start %.1f ms" % (
+            self.callbacks, elapsedTime, 100 * self.busyTime / max(elapsedTime, 0.001),
+            self.maximumRunTime * 1000, self.maximumLateness * 1000)
+
+
+def isValidSetting(value, validRange):
+    '''
+    True if a setting from a remote client is a whole number in the range, given as (lowest, highest)
+    '''
+    return isinstance(value, (int, long)) and not isinstance(value, bool) and validRange[0] <= value <= validRange[1]
+
+
+class Application(tk.Frame):              
+    def __init__(self, master=None):
+        tk.Frame.__init__(self, master)
+        self.callbackLoad = CallbackLoadMonitor()
+        # the text we last set on each label, so we only touch a label when its text changes
+        self.labelText = {}
+        self.countdownRunning = False
+        self.isConfirmingStart = False
+        self.countdownTimer = None
+        self.stepTimeRemainingTimer = None
+        self.isFlashing = False
+        self.flashTimer = None
+        self.easyDayRelay = None
+        self.controlServer = None
+        self.master.report_callback_exception = self.reportCallbackException
+        self.grid()                       
+        self.createWidgets()
+        self.isFFlagStart = True
+        # the sequence comes first, as the relay asks whether it is running when it connects
+        self.startRaceSequence = StartRaceSequence(testSpeedRatio=testSpeedRatio)
+        self.startRaceSequence.addObserver(self)
+        self.connectToRelay()
+        self.checkComPortSet()
+        if controlServerAddress:
+            self.startControlServer(controlServerAddress)
     
-    def connect(self):
-        # we are sometimes trying to connect when we are already
-        # connected
-        if not self.isConnected():
-            logging.debug("Connecting to serial port")
-            self.enabled = True
-            try:
-                # try to open the serial port
-                if self.serialConnection.isOpen():
-                    logging.debug("Request to open serial port when already open")
-                else:
-                    self.serialConnection.open()
-                    logging.debug("Connected to serial port")
-                # wait for a second and establish the session
-                self.tkRoot.after(2000,self.establishSession)
-            
-            except (serial.SerialException,ValueError) as e:           
-                logging.error("I/O error: {0}".format(e))
-                self.serialConnection.close()
-                self.beReconnecting()
-                self.reconnect()
-        else:
-            logging.debug("Request for connect when already connected")
-            
     
-    def reconnect(self):
-        logging.info("Reconnecting to serial port")
-        self.tkRoot.after(5000,self.connect)
-        
-        
     
-    def disconnect(self):
-        self.enabled = False
-        if self.isConnected:
-            self.serialConnection.close()
-            self.beNotConnected()
-        
-    def timeSinceLastPacket(self):
+    def after(self, ms, func=None, *args):
         '''
-        calculate the time since the last command
+        Everything we schedule goes through here, so we can measure the load on the main loop
         '''
-        deltaSinceLastPacket = datetime.datetime.now() - self.lastPacketTime
-        
-        return int((deltaSinceLastPacket.microseconds/1000) + deltaSinceLastPacket.seconds*1000)
+        if func is None:
+            return tk.Frame.after(self, ms)
+        return tk.Frame.after(self, ms, self.callbackLoad.wrap(ms, func), *args)
     
-    
-    def writePacketToEasyDaq(self):
-        # if we are connected, we write our packet
-        try:
-            logging.debug("Writing to serial port: %s" % self.printableCommand(self.currentRelayPacket))
-            self.serialConnection.write(self.currentRelayPacket)
-            
-            #
-            # Not the most elegant, but we check to see if this packet is a command by looking for a C as the first byte of the packet
-            #
-            if self.currentRelayPacket[0] =='C':
-                
-                self.previousRelayCommand = self.currentRelayCommand
-                self.currentRelayCommand = None
-
-            
-            self.lastPacketTime = datetime.datetime.now()
-        except (serial.SerialException,ValueError) as e:
-            logging.error("I/O error: {0}".format(e))
-            self.serialConnection.close()
-            self.beReconnecting()
-            
-            self.reconnect()
-    
-    def printableCommand(self,relayCommand):
-        return relayCommand[0] + "," + str(ord(relayCommand[1]))
-    
-    def queuePacketToEasyDaq(self):
+    def setLabelText(self, stringVar, text):
         '''
-        Write a command to EasyDaq. If we have written a command within the last 100 milliseconds,
-        then delay by 100 milliseconds, otherwise write the command now.
+        Set the text of a label, but only if it has changed. If the label is one we show remotely, publish it.
         '''
-        # easy scenario is that we can write the command immediately
-        
-        
-        # if time delta is at least 100 milliseconds
-            
-        if (self.timeSinceLastPacket() > 100):
-            # we can write the command now.
-            self.writePacketToEasyDaq()
+        if self.labelText.get(str(stringVar)) != text:
+            self.labelText[str(stringVar)] = text
+            stringVar.set(text)
+            if self.controlServer and str(stringVar) in self.telemetryFields:
+                self.publishState({self.telemetryFields[str(stringVar)]: text})
                 
-        else:
-            # and queue to be written in 100 milliseconds
-            logging.debug("Queuing writing packet to easyDaq")
-            self.tkRoot.after(100-self.timeSinceLastPacket(), self.writePacketToEasyDaq)
-
-    def sendRelayCommand(self,relayArray):
-        # turn the values in the list into a byte where the bit in the byte reflects the position in the list.
-        
-        commandValue = 0
-        
-        for i in range(len(relayArray)):
-                bitValue = (relayArray[i] *  pow(2,i))
-                commandValue = commandValue + bitValue
-        
-        logging.info("Sending C + %i" % commandValue)
-        relayCommand = 'C' + chr(commandValue)
-        self.currentRelayCommand = relayCommand
-        
-        self.currentRelayPacket = relayCommand
-        # if we are connected, we queue the packet. If we are not connected,
-        # the session recovery will play in the relay packet
-        if self.isConnected():
-            self.queuePacketToEasyDaq()
-
-
-        
-    def sendRelayConfiguration(self,relayArray):
-        # turn the values in the list into a byte where the bit in the byte reflects the position in the list.
-        
-        commandValue = 0
-        
-        for i in range(len(relayArray)):
-                bitValue = (relayArray[i] *  pow(2,i))
-                commandValue = commandValue + bitValue
-        
-        logging.info("Sending B + %i" % commandValue)        
-        self.currentRelayPacket = 'B' + chr(commandValue)
-        
-        self.queuePacketToEasyDaq()
-
-
-    
-class StartRaceSequence(object):
-    def __init__(self):
-        self.startRaceSteps = []
-        self.raceStartTime = None
-        self.isRunning = False
-        self.raceStartTime = None
-        self.raceFinishCallback = None
-        self.observers = []
-        
-    def notifyObservers(self):
-        for anObserver in self.observers:
-            anObserver.startRaceSequenceChanged(self)
-    
-    def addObserver(self, anObserver):
+    def startControlServer(self, address):
         '''
-        Add an observer to the relay. The callback the method relayStatusChanged
+        Start the network control server. Address is a port, or host:port.
         '''
-        self.observers.append(anObserver)
-        
-    def addStartStep(self, aStartStep):
-        self.startRaceSteps.append(aStartStep)
-        
-    def start(self,easyDaqRelay,tkRoot):
-        self.isRunning = True
-        self.tkRoot = tkRoot
-        self.easyDaqRelay = easyDaqRelay
-        self.currentStepNumber = 0
-        self.startCurrentStep()
-        
-    def reset(self):
-        self.currentStep().stop()
-        self.isRunning = False
-        self.startRaceSteps = []
-        self.notifyObservers()
-        
-    
-    def currentStep(self):
-        return self.startRaceSteps[self.currentStepNumber]
-        
-    def hasNextStep(self):
-        return not self.nextStep() == None
-        
-    def nextStep(self):
-        if self.currentStepNumber < (len(self.startRaceSteps)-1):
-            return self.startRaceSteps[self.currentStepNumber+1]
-        else:
-            return None
-    
-    def startCurrentStep(self):
-        self.currentStep().run(self.easyDaqRelay,self.tkRoot)
-                    
-        # calculate when the step should _finish_. This is the steps
-        # toSecondsBefore subtracted from the race start time
-        self.currentStepFinishTime = self.raceStartTime - datetime.timedelta(seconds=(self.currentStep().toSecondsBefore/ testSpeedRatio))
-        
-        # so now we know the duration of the step
-        stepDuration = self.currentStepFinishTime - datetime.datetime.now()
-        
-        logging.info( "Step %i %s duration will be %f" % (self.currentStepNumber, self.currentStep(), stepDuration.total_seconds()))
-        
-        # and we move onto the next step after the duration of the step
-        self.tkRoot.after(int(round(stepDuration.total_seconds()) * 1000), self.moveToNextStep)
-        self.notifyObservers()
-
-
-    def currentStepSecondsRemaining(self):
-        timeRemaining =  self.currentStepFinishTime - datetime.datetime.now()
-        
-        return timeRemaining.seconds
-            
-    def moveToNextStep(self):
-        # stop the current step
-        self.currentStep().stop()
-        # check that we're running
-        if self.isRunning and self.currentStepNumber < len(self.startRaceSteps)-1:
-            # increment the step number
-            self.currentStepNumber += 1
-            # and start the step
-            self.startCurrentStep()
-        else:
-            # turn off all the lights
-            # and turn off the lights
-        
-        
-            self.easyDaqRelay.sendRelayCommand(
-            [LIGHT_OFF, LIGHT_OFF, LIGHT_OFF, LIGHT_OFF, LIGHT_OFF])
-            self.isRunning = False
-            self.notifyObservers()
-            
-         
-        
-class StartRaceStep(object):
-    def __init__(self, fromSecondsBefore, toSecondsBefore, lightState, description):
-        self.fromSecondsBefore = fromSecondsBefore
-        self.toSecondsBefore = toSecondsBefore
-        self.lightState = lightState
-        self.flashingState = 0
-        self.description = description
-        
-        
-    def __str__(self):
-        return "%s for %d seconds" % (self.description, (self.fromSecondsBefore - self.toSecondsBefore))
-        
-    def run(self,easyDaqRelay,tkRoot):
+        # imported here, as we only need it if we are controlled remotely
+        import LightsControlServer
+        
+        host, _, port = address.rpartition(':')
+        self.controlServer = LightsControlServer.LightsControlServer(host or 'localhost', int(port),
+            token=controlServerToken, allowedOrigins=controlServerOrigins)
+        
+        # the labels we show remotely, and what we call them
+        self.telemetryFields = {
+            str(self.countdownToFirstLight): 'countdown',
+            str(self.relayStatus): 'relay',
+            str(self.relayVerification): 'relayConfirmation',
+            str(self.currentStepDescription): 'currentStep',
+            str(self.currentStepTimeRemaining): 'currentStepTimeRemaining',
+            str(self.nextStepDescription): 'nextStep',
+        }
+        state = {'lights': [0, 0, 0, 0, 0]}
+        for stringVar in (self.countdownToFirstLight, self.relayStatus, self.relayVerification, self.currentStepDescription,
+                self.currentStepTimeRemaining, self.nextStepDescription):
+            state[self.telemetryFields[str(stringVar)]] = stringVar.get()
+        self.publishState(state)
+        
+        self.controlServer.start()
+        self.after(STATE_POLL_INTERVAL, self.pollRemoteCommands)
+        
+    def publishState(self, changes):
         '''
-        run this step
+        Send state changes to the remote displays, along with what the sequence is doing
         '''
-        self.easyDaqRelay = easyDaqRelay
-        self.running = True
-        self.tkRoot = tkRoot
-        
-        if LIGHT_FLASHING in self.lightState:
-            self.runWithFlashingLights()
-        else:
-            self.runWithSteadyLights()
-            
-    def runWithSteadyLights(self):
-        self.easyDaqRelay.sendRelayCommand(self.lightState)
-        
-    def stop(self):
-        self.running = False
+        changes['countdownRunning'] = self.countdownRunning
+        changes['sequenceRunning'] = self.startRaceSequence.isRunning
+        changes['flashing'] = self.isFlashing
+        changes['connected'] = self.easyDaqRelay.isConnected()
+        self.controlServer.publish(changes)
         
+    def pollRemoteCommands(self):
+        '''
+        Carry out any commands from remote clients. Each client is waiting on its own thread for our reply.
+        '''
+        for command, request, replyQueue in self.controlServer.pendingCommands():
+            try:
+                reply = self.remoteCommand(command, request)
+            except (ValueError, TypeError, KeyError) as e:
+                reply = {'ok': False, 'error': str(e)}
+            replyQueue.put(reply)
+        self.after(STATE_POLL_INTERVAL, self.pollRemoteCommands)
         
-    def runWithFlashingLights(self):
-        if self.running:
-            # increment our state
-            self.flashingState += 1
-            
-            
-            
-            # if we are on an even state, 
-            if (self.flashingState % 2 == 0):
-            
-                # this cryptic looking statement creates a copy of the
-                # light state list turning LIGHT_FLASHING to LIGHT_ON
-                
-                lightStateIteration = [LIGHT_ON if light == LIGHT_FLASHING else light for light in self.lightState]
-             
-            else:
-                lightStateIteration = [LIGHT_OFF if light == LIGHT_FLASHING else light for light in self.lightState]
-             
-            self.easyDaqRelay.sendRelayCommand(lightStateIteration)
-            self.tkRoot.after(500,self.runWithFlashingLights)
+    def remoteCommand(self, command, request):
+        '''
+        Carry out a command from a remote client, as if the matching button had been pressed
+        '''
+        if command == 'start':
+            # the start button can't tell us this, as reconnecting the relay enables it
+            if self.isSequenceActive():
+                return {'ok': False, 'error': 'the sequence is already running'}
+            if self.isConfirmingStart:
+                return {'ok': False, 'error': 'the sequence is being started on the lights PC'}
+            if not self.easyDaqRelay.isConnected():
+                return {'ok': False, 'error': 'the relay is not connected'}
+            flag = request.get('flag', 'F')
+            starts = request.get('starts', self.numberStarts.get())
+            minutes = request.get('minutes', self.timeToSequenceStart.get())
+            # check everything before we touch the controls, so a bad request changes nothing
+            if flag not in ('F', 'C'):
+                return {'ok': False, 'error': 'flag must be F or C'}
+            if not isValidSetting(starts, STARTS_RANGE):
+                return {'ok': False, 'error': 'starts must be a whole number from %d to %d' % STARTS_RANGE}
+            if not isValidSetting(minutes, MINUTES_TO_SEQUENCE_RANGE):
+                return {'ok': False, 'error': 'minutes must be a whole number from %d to %d' % MINUTES_TO_SEQUENCE_RANGE}
+            self.isFFlagStart = flag == 'F'
+            self.startType.set("Flag" if self.isFFlagStart else "Class")
+            self.numberStarts.set(starts)
+            self.timeToSequenceStart.set(minutes)
+            self.startCountdown()
             
-
-def addFFlagStep(sequence,numberStarts):
-
-    # 
-    # We calculate the end time for the F Flag step as five minutes per numberStarts . The start time is five minutes earlier.
-    sequence.addStartStep(StartRaceStep(300 + numberStarts*300, 0 + numberStarts*300,[LIGHT_OFF,LIGHT_OFF, LIGHT_OFF, LIGHT_OFF, LIGHT_OFF], "F Flag, 10 minute warning"))
+        elif command == 'reset':
+            if not self.isSequenceActive():
+                return {'ok': False, 'error': 'there is no sequence to reset'}
+            self.resetSequence()
+            
+        elif command == 'lights':
+            lightButtons = {
+                'off': self.lightsOff,
+                'one': self.oneLight,
+                'two': self.twoLights,
+                'three': self.threeLights,
+                'four': self.fourLights,
+                'five': self.fiveLights,
+                'flashing': self.flashingOneLight,
+            }
+            if request.get('lights') not in lightButtons:
+                return {'ok': False, 'error': 'lights must be one of %s' % ", ".join(sorted(lightButtons.keys()))}
+            if not self.easyDaqRelay.isConnected():
+                return {'ok': False, 'error': 'the relay is not connected'}
+            lightButtons[request['lights']]()
             
-def addFiveMinuteStarts(sequence, numberStarts):
-
-
-    for i in range(numberStarts):
-    
-        # we need to add on N race worth's of delay,
-        # where N is the number of races after this race
-        racesAfter = numberStarts - (i+1)
-        
-        raceDelay = racesAfter * 300
-        
-        descriptionRaceNumber = i + 1
-        
-        print sequence
-        
-
-        sequence.addStartStep(StartRaceStep(300 + raceDelay,240+ raceDelay,[LIGHT_ON, LIGHT_ON, LIGHT_ON, LIGHT_ON, LIGHT_ON],"Race %d, 5 minute lights" % descriptionRaceNumber))
-        sequence.addStartStep(StartRaceStep(240+ raceDelay,180+ raceDelay,[ LIGHT_ON, LIGHT_ON, LIGHT_ON, LIGHT_ON,LIGHT_OFF],"Race %d, 4 minute lights" % descriptionRaceNumber))
-        sequence.addStartStep(StartRaceStep(180+ raceDelay,120+ raceDelay,[LIGHT_ON, LIGHT_ON, LIGHT_ON,LIGHT_OFF, LIGHT_OFF ],"Race %d, 3 minute lights" % descriptionRaceNumber))
-        sequence.addStartStep(StartRaceStep(120+ raceDelay,60+ raceDelay,[LIGHT_ON, LIGHT_ON, LIGHT_OFF, LIGHT_OFF, LIGHT_OFF ],"Race %d, 2 minute lights" % descriptionRaceNumber))
-        sequence.addStartStep(StartRaceStep(60+ raceDelay,30+ raceDelay,[LIGHT_ON,LIGHT_OFF, LIGHT_OFF, LIGHT_OFF, LIGHT_OFF],"Race %d, 1 minute lights" % descriptionRaceNumber))
-        sequence.addStartStep(StartRaceStep(30+ raceDelay,0+ raceDelay,[LIGHT_FLASHING,LIGHT_OFF, LIGHT_OFF, LIGHT_OFF, LIGHT_OFF ],"Race %d, 30 seconds lights" % descriptionRaceNumber))
+        else:
+            return {'ok': False, 'error': 'unknown command %s' % command}
         
-class Application(tk.Frame):              
-    def __init__(self, master=None):
-        tk.Frame.__init__(self, master)
-        self.easyDayRelay = None
-        self.grid()                       
-        self.createWidgets()
-        self.connectToRelay()
-        self.isFFlagStart = True
-        self.startRaceSequence = StartRaceSequence()
-        self.startRaceSequence.addObserver(self)
-        self.checkComPortSet()
-    
+        return {'ok': True}
     
+    def reportCallbackException(self, exceptionType, exceptionValue, exceptionTraceback):
+        '''
+        Tk calls this when one of our callbacks raises an exception. We log it and save the flight recorder.
+        '''
+        logging.error("Exception in Tk callback", exc_info=(exceptionType, exceptionValue, exceptionTraceback))
+        flightRecorder.record(FR_CRASH)
+        flightRecorder.flush("crash", wait=True)
     
     def checkComPortSet(self):
-        # check that we have a COM port. This should be passed on the command line
+        # check whether we have a COM port. If not, the relay looks for the card on all the serial ports
         if not comPort:
-            tkMB.showerror("No serial port defined", "You must pass the serial port as a parameter to the application, e.g. -p COM3")
+            logging.info("No serial port given, the relay will look for the EasyDaq card")
             
              
     def startCountdownOnConfirm(self):
@@ -564,11 +309,18 @@ class Application(tk.Frame):
         else:
             message = "C flag sequence with %d starts starting in %d minutes" % (self.numberStarts.get(), self.timeToSequenceStart.get())
             
-        if tkMB.askokcancel("Start Sequence",message ):
+        # the dialog runs Tk's loop, so remote commands are carried out while it is open
+        self.isConfirmingStart = True
+        try:
+            confirmed = tkMB.askokcancel("Start Sequence",message )
+        finally:
+            self.isConfirmingStart = False
+        if confirmed and not self.isSequenceActive():
             self.startCountdown()
             
     def startCountdown(self):
-        self.isFlashing = False
+        flightRecorder.record(FR_UI_COMMAND, UI_START_SEQUENCE)
+        self.stopFlashing()
         
         logging.info("Starting race sequence with %d starts " % self.numberStarts.get())
         
@@ -583,7 +335,7 @@ class Application(tk.Frame):
         # and schedule the start of the race sequence)
         startDelay = int(round(self.timeToSequenceStart.get() * 60 / testSpeedRatio))
         
-        self.startSequenceTime = datetime.datetime.now() + datetime.timedelta(seconds=startDelay)
+        self.startSequenceDeadline = monotonicTime() + startDelay
         
         if self.isFFlagStart:
             startSequenceMinutesDuration = (5*self.numberStarts.get()) + 5
@@ -606,22 +358,33 @@ class Application(tk.Frame):
         self.resetSequenceButton['state'] = tk.NORMAL
         
     def updateCountdown(self):
+        self.countdownTimer = None
         if self.countdownRunning:
-            countdownTimeRemaining = self.startSequenceTime - datetime.datetime.now()
-            minutes, seconds = divmod(countdownTimeRemaining.seconds, 60)
+            secondsRemaining = max(0, self.startSequenceDeadline - monotonicTime())
+            minutes, seconds = divmod(int(secondsRemaining), 60)
             
-            self.countdownToFirstLight.set("%02d:%02d" % (minutes,seconds))
+            self.setLabelText(self.countdownToFirstLight, "%02d:%02d" % (minutes,seconds))
             
-            self.after(250,self.updateCountdown)
+            # and update again when the countdown next changes
+            self.countdownTimer = self.after(millisecondsToNextSecond(secondsRemaining), self.updateCountdown)
+    
+    def isSequenceActive(self):
+        '''
+        True from the moment the countdown starts until the sequence finishes or is reset
+        '''
+        return self.countdownRunning or self.startRaceSequence.isRunning
     
     def runRaceSequence(self):
         self.countdownRunning = False
-        self.countdownToFirstLight.set("Sequence started")
+        self.setLabelText(self.countdownToFirstLight, "Sequence started")
         self.startRaceSequence.start(self.easyDaqRelay,self)
         
     def connectToRelay(self):
-        # create a relay instance
-        self.easyDaqRelay = EasyDaqUSBRelay(comPort,self)
+        # create a relay instance, or a group if we are driving more than one card
+        if mirrorComPorts:
+            self.easyDaqRelay = EasyDaqRelayGroup([comPort] + mirrorComPorts,self,verifyRelayWrites)
+        else:
+            self.easyDaqRelay = EasyDaqUSBRelay(comPort,self,verifyRelayWrites)
         # add ourselves as an observer
         self.easyDaqRelay.addObserver(self)
         # tell it to connect
@@ -630,29 +393,42 @@ class Application(tk.Frame):
  
 
     def lightsOff(self):
-        self.isFlashing = False
+        flightRecorder.record(FR_UI_COMMAND, UI_LIGHTS_OFF)
+        self.stopFlashing()
         self.easyDaqRelay.sendRelayCommand([LIGHT_OFF,LIGHT_OFF,LIGHT_OFF,LIGHT_OFF,LIGHT_OFF])
         
 
 
     
     def quitApp(self):
+        flightRecorder.record(FR_UI_COMMAND, UI_QUIT)
         # when we quit we turn off all the lights
         
         if self.easyDaqRelay.isConnected():
             self.easyDaqRelay.sendRelayCommand([LIGHT_OFF,LIGHT_OFF,LIGHT_OFF,LIGHT_OFF,LIGHT_OFF])
             self.after(1000,self.easyDaqRelay.disconnect)
-        # now ask ttk to quit
+        logging.info("Main loop load: %s" % self.callbackLoad.summary())
+        # now ask ttk to quit, saving the flight recorder first
+        self.after(1900,lambda: flightRecorder.flush("quit", wait=True))
+        if self.controlServer:
+            self.after(1900,self.controlServer.stop)
         self.after(2000,self.quit)
         
     def relayStateChanged(self,easyDaqRelay):
-        self.relayStatus.set(easyDaqRelay.sessionStateDescription())
+        self.setLabelText(self.relayStatus, easyDaqRelay.sessionStateDescription())
         if easyDaqRelay.isConnected():            
             self.enableLightButtons()
         else:
             
             self.disableLightButtons()
             
+    def relayVerificationChanged(self,easyDaqRelay):
+        self.setLabelText(self.relayVerification, "Relay confirmation: %s" % easyDaqRelay.verificationSummary())
+        
+    def relayCommandSent(self,easyDaqRelay,commandValue):
+        if self.controlServer:
+            self.publishState({'lights': [(commandValue >> relay) & 1 for relay in range(5)]})
+            
     def enableLightButtons(self):
         
         self.lightsOffButton['state'] = tk.NORMAL
@@ -662,7 +438,9 @@ class Application(tk.Frame):
         self.threeLightsButton['state'] = tk.NORMAL
         self.fourLightsButton['state'] = tk.NORMAL
         self.fiveLightsButton['state'] = tk.NORMAL
-        self.startButton['state'] = tk.NORMAL
+        # the relay can reconnect in the middle of a sequence, which must not be started a second time
+        if not self.isSequenceActive():
+            self.startButton['state'] = tk.NORMAL
 
     def disableLightButtons(self):
         
@@ -674,63 +452,82 @@ class Application(tk.Frame):
         self.fiveLightsButton['state'] = tk.DISABLED
         self.startButton['state'] = tk.DISABLED
 
-    def flashOn(self):
-        if self.isFlashing:
+    def flash(self):
+        if self.flashCount % 2 == 0:
             self.easyDaqRelay.sendRelayCommand([LIGHT_ON,LIGHT_OFF,LIGHT_OFF,LIGHT_OFF,LIGHT_OFF])
-            self.after(500,self.flashOff)
-        
-    def flashOff(self):
-        if self.isFlashing:
+        else:
             self.easyDaqRelay.sendRelayCommand([LIGHT_OFF,LIGHT_OFF,LIGHT_OFF,LIGHT_OFF,LIGHT_OFF])
-            self.after(500,self.flashOn)
-    
+        self.flashCount += 1
+        
+        # time each toggle from when we started flashing, so the flashing doesn't drift
+        delay = self.flashStartTime + self.flashCount * FLASH_INTERVAL_SECONDS - monotonicTime()
+        self.flashTimer = self.after(max(0, int(round(delay * 1000))), self.flash)
+        
+    def stopFlashing(self):
+        self.isFlashing = False
+        if self.flashTimer:
+            self.after_cancel(self.flashTimer)
+            self.flashTimer = None
     
     def flashingOneLight(self):
+        flightRecorder.record(FR_UI_COMMAND, UI_FLASHING_ONE_LIGHT)
+        self.stopFlashing()
         self.isFlashing = True
+        self.flashStartTime = monotonicTime()
+        self.flashCount = 0
         
-        self.flashOn()
+        self.flash()
     
     def oneLight(self):
-        self.isFlashing = False
+        flightRecorder.record(FR_UI_COMMAND, UI_ONE_LIGHT)
+        self.stopFlashing()
         
         self.easyDaqRelay.sendRelayCommand([LIGHT_ON,LIGHT_OFF,LIGHT_OFF,LIGHT_OFF,LIGHT_OFF])
     
     def twoLights(self):
-        self.isFlashing = False
+        flightRecorder.record(FR_UI_COMMAND, UI_TWO_LIGHTS)
+        self.stopFlashing()
         self.easyDaqRelay.sendRelayCommand([LIGHT_ON,LIGHT_ON,LIGHT_OFF,LIGHT_OFF,LIGHT_OFF])
     
     def threeLights(self):
-        self.isFlashing = False
+        flightRecorder.record(FR_UI_COMMAND, UI_THREE_LIGHTS)
+        self.stopFlashing()
         self.easyDaqRelay.sendRelayCommand([LIGHT_ON,LIGHT_ON,LIGHT_ON,LIGHT_OFF,LIGHT_OFF])
     
     def fourLights(self):
-        self.isFlashing = False
+        flightRecorder.record(FR_UI_COMMAND, UI_FOUR_LIGHTS)
+        self.stopFlashing()
         
         self.easyDaqRelay.sendRelayCommand([LIGHT_ON,LIGHT_ON,LIGHT_ON,LIGHT_ON,LIGHT_OFF])
     
     
     def fiveLights(self):
-        self.isFlashing = False
+        flightRecorder.record(FR_UI_COMMAND, UI_FIVE_LIGHTS)
+        self.stopFlashing()
         
         self.easyDaqRelay.sendRelayCommand([LIGHT_ON,LIGHT_ON,LIGHT_ON,
             LIGHT_ON,LIGHT_ON])
         
     def resetSequence(self):
+        flightRecorder.record(FR_UI_COMMAND, UI_RESET_SEQUENCE)
         # if we're counting down to the sequence start, cancel the timer
         if self.countdownRunning:
             self.countdownRunning = False
             self.after_cancel(self.runRaceSequenceTimer)
+            if self.countdownTimer:
+                self.after_cancel(self.countdownTimer)
+                self.countdownTimer = None
             
             
             
         if self.startRaceSequence.isRunning:
             self.startRaceSequence.reset()
-            self.currentStepTimeRemaining.set("Not started")
+            self.setLabelText(self.currentStepTimeRemaining, "Not started")
         
         # either way, set the label back to ..:..
         self.startButton['state'] = tk.NORMAL
         self.resetSequenceButton['state'] = tk.DISABLED
-        self.countdownToFirstLight.set("..:..")
+        self.setLabelText(self.countdownToFirstLight, "..:..")
     
     def createWidgets(self):
     
@@ -763,8 +560,8 @@ class Application(tk.Frame):
         self.numberStarts = tk.IntVar()
         self.numberStartsSpinbox = tk.Spinbox(self,
             textvariable=self.numberStarts,
-            from_=1,
-            to=9,
+            from_=STARTS_RANGE[0],
+            to=STARTS_RANGE[1],
             width=3)
         
         self.numberStartsSpinbox.grid(row=0,column=3,sticky=tk.W)
@@ -778,8 +575,8 @@ class Application(tk.Frame):
         self.timeToSequenceStart.set(1)
         self.timeToSequenceStartSpinbox = tk.Spinbox(self,
             textvariable=self.timeToSequenceStart,
-            from_=0,
-            to=5,
+            from_=MINUTES_TO_SEQUENCE_RANGE[0],
+            to=MINUTES_TO_SEQUENCE_RANGE[1],
             width=3)
         
         self.timeToSequenceStartSpinbox.grid(row=1,column=3,sticky=tk.W)
@@ -800,6 +597,17 @@ class Application(tk.Frame):
             textvariable=self.relayStatus,
             anchor=tk.W)
         self.relayStatusLabel.grid(row=10,column=0,sticky=tk.W,columnspan=4)
+        
+        self.relayVerification = tk.StringVar()
+        if verifyRelayWrites:
+            self.relayVerification.set("Relay confirmation: waiting for first change")
+        else:
+            self.relayVerification.set("Relay confirmation: off")
+        self.relayVerificationLabel = ttk.Label(self,
+            textvariable=self.relayVerification,
+            style="steps.TLabel",
+            anchor=tk.W)
+        self.relayVerificationLabel.grid(row=11,column=0,sticky=tk.W,columnspan=6)
 
 
         self.manualLightsFrame = ttk.LabelFrame(self,text="Manual control")
@@ -909,45 +717,90 @@ class Application(tk.Frame):
         
         
     def updateCurrentStepTimeRemaining(self):
+        self.stepTimeRemainingTimer = None
         if self.startRaceSequence.isRunning:
             
+            secondsRemaining = max(0, self.startRaceSequence.stepFinishDeadline(self.startRaceSequence.currentStep())
+                - self.startRaceSequence.clock())
+            minutes, seconds = divmod(int(secondsRemaining), 60)
             
-            minutes, seconds = divmod(self.startRaceSequence.currentStepSecondsRemaining(), 60)
+            self.setLabelText(self.currentStepTimeRemaining, "%02d:%02d" % (minutes,seconds))
             
-            self.currentStepTimeRemaining.set("%02d:%02d" % (minutes,seconds))
-            self.after(500,self.updateCurrentStepTimeRemaining)
+            # and update again when the time remaining next changes
+            self.stepTimeRemainingTimer = self.after(millisecondsToNextSecond(secondsRemaining), self.updateCurrentStepTimeRemaining)
 
     def startRaceSequenceChanged(self, startRaceSequence):
+        # the step has changed, so restart the time remaining from the new step's deadline
+        if self.stepTimeRemainingTimer:
+            self.after_cancel(self.stepTimeRemainingTimer)
+            self.stepTimeRemainingTimer = None
         
         if startRaceSequence.isRunning:
             
-            self.currentStepDescription.set(str(startRaceSequence.currentStep()))
+            self.setLabelText(self.currentStepDescription, str(startRaceSequence.currentStep()))
             self.updateCurrentStepTimeRemaining()
         else:
-            self.currentStepDescription.set(str("None"))
+            self.setLabelText(self.currentStepDescription, "None")
             self.startButton["state"] = tk.NORMAL
             self.resetSequenceButton['state'] = tk.DISABLED
+            logging.info("Main loop load: %s" % self.callbackLoad.summary())
+            self.easyDaqRelay.logStatistics()
+            # the sequence has finished or been reset, so save the flight recorder
+            flightRecorder.flush("sequence")
             
         if startRaceSequence.isRunning and startRaceSequence.hasNextStep():
-            self.nextStepDescription.set(str(startRaceSequence.nextStep()))
+            self.setLabelText(self.nextStepDescription, str(startRaceSequence.nextStep()))
         else:
-            self.nextStepDescription.set("None")
+            self.setLabelText(self.nextStepDescription, "None")
             
 
-# read the command line arguments
+if __name__ == '__main__':
+    # read the command line arguments
 
-logging.debug(sys.argv)
-myopts, args = getopt.getopt(sys.argv[1:],"p:t:",["port=","testSpeedRatio="])        
+    logging.debug(sys.argv)
+    myopts, args = getopt.getopt(sys.argv[1:],"p:t:vr:n:k:o:",["port=","testSpeedRatio=","verify","recorder=","network=","token=","origins="])        
 
-for o, a in myopts:
-    logging.debug("Option %s value %s" % (o,a))
-    if o in ('-p','--port'):
-        comPort=a
-    elif o in ('-t','--testSpeedRatio'):
-        testSpeedRatio=int(a)
-    else:
-        print("Usage: %s -p [serial port to connect to] -t [default 1, set to more than 1 to run faster]" % sys.argv[0])
-        
-app = Application()                       
-app.master.title('HHSC Race Lights')    
-app.mainloop()  
\ No newline at end of file
+    for o, a in myopts:
+        logging.debug("Option %s value %s" % (o,a))
+        if o in ('-p','--port'):
+            # a list of ports to look for the card on, or the card's port
+            if ',' in a:
+                port=a.split(',')
+            else:
+                port=a
+            # every -p after the first is another card showing the same lights
+            if comPort is None:
+                comPort=port
+            else:
+                mirrorComPorts.append(port)
+        elif o in ('-t','--testSpeedRatio'):
+            testSpeedRatio=int(a)
+        elif o in ('-v','--verify'):
+            verifyRelayWrites=True
+        elif o in ('-r','--recorder'):
+            flightRecorder.directory=a
+        elif o in ('-n','--network'):
+            controlServerAddress=a
+        elif o in ('-k','--token'):
+            controlServerToken=a
+        elif o in ('-o','--origins'):
+            controlServerOrigins=a.split(',')
+        else:
+            print("Usage: %s -p [serial port to connect to, or a comma separated list to probe, repeat for more cards] -t [default 1, set to more than 1 to run faster] -v (read back every relay change) -r [directory for flight recorder files] -n [[host:]port for network control] -k [token for network clients] -o [comma separated web origins allowed to connect]" % sys.argv[0])
+
+    # the lights can be controlled over the network, so only ever listen beyond this machine with a token
+    if controlServerAddress and controlServerAddress.rpartition(':')[0] not in ('', 'localhost', '127.0.0.1') \
+            and not controlServerToken:
+        print("The network control server needs a token (-k) to listen on %s" % controlServerAddress)
+        sys.exit(2)
+        
+    # if we crash outside a Tk callback, save the flight recorder before we go
+    def saveFlightRecorderOnCrash(exceptionType, exceptionValue, exceptionTraceback):
+        flightRecorder.record(FR_CRASH)
+        flightRecorder.flush("crash", wait=True)
+        sys.__excepthook__(exceptionType, exceptionValue, exceptionTraceback)
+    sys.excepthook = saveFlightRecorderOnCrash
+        
+    app = Application()                       
+    app.master.title('HHSC Race Lights')    
+    app.mainloop()  
\ No newline at end of file
@@ -28,6 +28,17 @@ Directions for use:
     # Save gauges in the default web directory
     GAUGE_ROOT = public_html/
 
+    # Save the gauges side by side in one image, gauges.png, with gauges.css and
+    # gauges.json to say where each gauge is. The default is a file for each gauge.
+    sprite_sheet = false
+
+    # png or webp. WebP needs PIL built with WebP support. The default is png
+    image_format = png
+
+    # Reduce the gauges to a palette of this many colours, and optimise the PNG.
+    # The default, 0, is full colour
+    palette_colours = 0
+
     [[Temperature]]
     minvalue = -20
     maxvalue = 40
@@ -69,85 +80,108 @@ Directions for use:
     labelfontsize = 12
 # Hours of historic data to use for gauge background shading
     history = 3
+
+5) To redraw the wind gauges from LOOP packets, between report cycles, add
+   user.nicksengines.LiveGauges to service_list in weewx.conf, and a [LiveGauges]
+   section to weewx.conf:
+
+[LiveGauges]
+    # The skin with the [GaugeGenerator] section
+    skin = Standard
+
+    # The gauges to redraw. Only the wind gauges can be drawn from LOOP packets. Add
+    # WindGust only if the station's LOOP packets have windGust, as not every driver's do
+    gauges = WindSpeed, WindDirection
+
+    # The most frames a second to draw. Each frame redraws every gauge that has changed
+    max_rate = 0.5
+
+    # How long one frame should take, in milliseconds: drawing and saving every
+    # gauge in it, and redrawing any face, with the archive read for the history
+    frame_budget_ms = 100
+
+   The gauges are drawn on a thread of their own, so the engine never waits for
+   them. If LOOP packets arrive faster than max_rate, only the latest is drawn.
+   Everything but the needle and the digital value is drawn once and kept, and
+   the direction gauge's history shading is redrawn when a new archive record
+   arrives. A gauge is only saved when its needle or digital value would change
+   a pixel, and is left alone for a packet without its field.
+
+   Every frame is timed. A frame over frame_budget_ms is logged, and the frame
+   rate is lowered so that drawing never takes more than a quarter of the time.
+   The frame times are logged every hour. To time the frames on the weewx host:
+
+   PYTHONPATH=bin python bin/user/nicksengines.py [skin.conf, default /etc/weewx/skins/Standard/skin.conf]
+
+   That also compares the bytes and encoding time of the gauges in files of their
+   own with the sprite sheet, and with the palette and WebP encodings.
+
+   The live gauges are always saved as full colour PNG files of their own. The
+   gauge generator leaves them out, so the two never write the same file.
 """
 
 import time
 import syslog
 import math
+import threading
+import collections
+import json
 import Image, ImageDraw, ImageFont
 import os.path
 
+import configobj
+
 import weewx.reportengine
 import weewx.archive
 import weewx.units
+from weewx.wxengine import StdService
 
-class GaugeGenerator(weewx.reportengine.CachedReportGenerator):
-    """Class for creating nice gauge graphics."""
-       
-    def run(self):
-        t1 = time.time()
+# The angles of the ends of the scale, in degrees clockwise from the bottom of the gauge
+GAUGE_MIN_ANGLE = 45
+GAUGE_MAX_ANGLE = 315
 
-        syslog.syslog(syslog.LOG_INFO, "reportengine: Gauge generator code run (yippee!)")
+# The number of directions the wind history is counted into
+WIND_DIRECTION_BINS = 16
 
-        self.gauges =  [{'field': "outTemp", 	 'name': "Temperature"},
-			            {'field': "barometer", 	 'name': "Pressure"}, 
-			            {'field': "windSpeed",   'name': "WindSpeed"}, 
-			            {'field': "windGust", 	 'name': "WindGust"},
-			            {'field': "outHumidity", 'name': "Humidity"},
-			            {'field': "windDir",     'name': "WindDirection"}]
+# The gauges that can be drawn from LOOP packets, with the field and the units they show
+LIVE_GAUGES = {'WindSpeed': ('windSpeed', 'knot'),
+               'WindGust': ('windGust', 'knot'),
+               'WindDirection': ('windDir', None)}
 
-	    # Load up config info from skin.conf file
-        self.gauge_dict = self.skin_dict['GaugeGenerator']
-        self.formatter = weewx.units.Formatter.fromSkinDict(self.skin_dict)
-        self.converter = weewx.units.Converter.fromSkinDict(self.skin_dict)
-     
-        self.whereToSaveIt = os.path.join(self.config_dict['WEEWX_ROOT'], self.gauge_dict.get('GAUGE_ROOT'))
- 
-        archivedb = self._getArchive(self.skin_dict['archive_database'])
+# The name of the sprite sheet, and its CSS and JSON map
+SPRITE_SHEET_NAME = "gauges"
 
-        rec = self.getRecord(archivedb, archivedb.lastGoodStamp())
+# The most frames a second the live gauges draw, unless max_rate says otherwise
+LIVE_GAUGES_DEFAULT_RATE = 0.5
 
-        if rec is not None:
+# The largest share of the time the live gauges may spend drawing
+LIVE_GAUGES_MAX_SHARE = 0.25
 
-            # Draw a gauge for everything that has a config entry
-            for gauge in self.gauge_dict:
-                # Is it actually a gauge?             
-                for gaugeinfo in self.gauges:
-                    if gaugeinfo['name'] == gauge:
-                        if rec.has_key(gaugeinfo['field']):
-                            # TODO: Look up units actually used by quantity and call apropriate lookup function
-                            if gaugeinfo['field'] == 'outTemp': self.drawGauge(rec[gaugeinfo['field']].degree_C.raw, gaugeinfo['name'])
-                            if gaugeinfo['field'] == 'barometer': self.drawGauge(rec[gaugeinfo['field']].mbar.raw, gaugeinfo['name'])
-                            if gaugeinfo['field'] == 'windSpeed': self.drawGauge(rec[gaugeinfo['field']].knot.raw, gaugeinfo['name'])
-                            if gaugeinfo['field'] == 'windGust': self.drawGauge(rec[gaugeinfo['field']].knot.raw, gaugeinfo['name'])
-                            if gaugeinfo['field'] == 'outHumidity': self.drawGauge(float(str(rec[gaugeinfo['field']]).strip('%')), gaugeinfo['name'])
-                            
-                            if gaugeinfo['field'] == 'windDir' :self.drawFunkyWindGauge(gaugeinfo['name'])
-                            
-        t2= time.time()
-        syslog.syslog(syslog.LOG_INFO, """reportengine: Time taken %.2f seconds""" % (t2 - t1))
+# How often the live gauges log their frame times, in seconds
+LIVE_GAUGES_REPORT_INTERVAL = 3600
 
+class GaugeDrawing(object):
+    """Drawing the gauges, for the gauge generator and the live gauges"""
 
-    def drawFunkyWindGauge(self, gaugeName):
-        """Wind direction gauge generator with shaded background to indicate historic wind directions"""
-        
+    def gaugeGeometry(self):
+        """The width, height, centre and radius of the gauges"""
         imageWidth = self.gauge_dict.as_int('image_width')
         imageHeight = self.gauge_dict.as_int('image_height')
         imageOrigin = (imageWidth / 2, imageHeight / 2)
-        
-        syslog.syslog(syslog.LOG_INFO, """reportengine: Generating %s gauge, (%d x %d)""" % (gaugeName, imageWidth, imageHeight))
 
-        labelFontSize = self.gauge_dict[gaugeName].as_int('labelfontsize')
+        if imageWidth < imageHeight:
+            radius = imageWidth * 0.45
+        else:
+            radius = imageHeight * 0.45
 
-        archivedb = self._getArchive(self.skin_dict['archive_database'])
-        (data_time, data_value) = archivedb.getSqlVectors('windDir', archivedb.lastGoodStamp() - self.gauge_dict[gaugeName].as_int('history') * 60,
-                                    archivedb.lastGoodStamp(), 300, 'avg')
-    
-        for rec in data_value:
-            syslog.syslog(syslog.LOG_INFO, """reportengine: %s""" % rec)
+        return imageWidth, imageHeight, imageOrigin, radius
+
+    def windHistory(self, gaugeName):
+        """The share of the last 'history' hours of wind in each of 16 directions, scaled so the largest is 1, and
+        the latest wind direction"""
        
         # Number of bins to count wind history into
-        numBins = 16
+        numBins = WIND_DIRECTION_BINS
 
         # One data point recorded every 5 mins for 'history' number of hours
         numPoints =  self.gauge_dict[gaugeName].as_int('history') * 60 / 5
@@ -165,26 +199,38 @@ class GaugeGenerator(weewx.reportengine.CachedReportGenerator):
         archive = weewx.archive.Archive.open(self.config_dict['Databases'][archive_db])
 
         windDirNow = None
-        windSpeedNow = None
 
-        for row in archive.genSql("SELECT windDir, windSpeed FROM archive ORDER BY dateTime DESC LIMIT %d" % numPoints):
-            # This line is occasionally crashing out with error: 
-            # TypeError: float() argument must be a string or a number
-            if row[0] is not None:
+        # The live gauges rebuild the face every archive period, so close the archive each time
+        try:
+            for row in archive.genSql("SELECT windDir FROM archive ORDER BY dateTime DESC LIMIT %d" % numPoints):
+                # The wind direction is NULL when there is no wind
+                if row[0] is None:
+                    continue
                 windDir = float(row[0])
                 if (windDir < 0) or (windDir > 360):
-                    syslog.syslog(syslog.LOG_INFO, "drawFunkyWindGauge: %f should be in the range 0-360 degrees", windDir)
-                else:
-                    buckets[int(windDir * numBins / 360)] += 1
-
-            if windSpeedNow is None:                
-                windSpeedNow = float(row[1])
+                    syslog.syslog(syslog.LOG_INFO, "drawFunkyWindGauge: %f should be in the range 0-360 degrees" % windDir)
+                    continue
+                # 360 degrees is north, the same as 0
+                buckets[int(windDir * numBins / 360) % numBins] += 1
 
-            if windDirNow is None:
-                windDirNow = windDir
+                if windDirNow is None:
+                    windDirNow = windDir
+        finally:
+            archive.close()
 
+        # With no wind in the history, the face is blank
         max = maxValue(buckets)
-        buckets = [i / max for i in buckets]
+        if max > 0:
+            buckets = [i / max for i in buckets]
+
+        return buckets, windDirNow
+
+    def drawWindFace(self, gaugeName, buckets):
+        """The wind direction gauge without the needle or the digital value"""
+
+        imageWidth, imageHeight, imageOrigin, radius = self.gaugeGeometry()
+        labelFontSize = self.gauge_dict[gaugeName].as_int('labelfontsize')
+        numBins = len(buckets)
 
         #
         # Draw the gauge
@@ -193,13 +239,7 @@ class GaugeGenerator(weewx.reportengine.CachedReportGenerator):
 
         draw = ImageDraw.Draw(im)
 
-        if imageWidth < imageHeight:
-            radius = imageWidth * 0.45
-        else:
-            radius = imageHeight * 0.45
-
-        sansFont = ImageFont.truetype("/usr/share/fonts/truetype/freefont/FreeSans.ttf", labelFontSize)
-        bigSansFont = ImageFont.truetype("/usr/share/fonts/truetype/freefont/FreeSans.ttf", 20)
+        sansFont = gaugeFont(labelFontSize)
 
         # Background
         angle= 0.0
@@ -235,36 +275,13 @@ class GaugeGenerator(weewx.reportengine.CachedReportGenerator):
             endPoint = (imageOrigin[0] - radius * math.sin(angle), imageOrigin[1] + radius * math.cos(angle))
             draw.line((startPoint, endPoint), fill = (0, 0, 0))
 
-        # The needle
-        angle = math.radians(windDirNow)
-        endPoint = (imageOrigin[0] - radius * math.sin(angle) * 0.7, imageOrigin[1] + radius * math.cos(angle) * 0.7)
-        leftPoint = (imageOrigin[0] - radius * math.sin(angle - math.pi * 7 / 8) * 0.2,
-                      imageOrigin[1] + radius * math.cos(angle - math.pi * 7 / 8) * 0.2)
-        rightPoint = (imageOrigin[0] - radius * math.sin(angle + math.pi * 7 / 8) * 0.2,
-                      imageOrigin[1] + radius * math.cos(angle + math.pi * 7 / 8) * 0.2)
-        midPoint = (imageOrigin[0] - radius * math.sin(angle + math.pi) * 0.1,
-                      imageOrigin[1] + radius * math.cos(angle + math.pi) * 0.1)
-
-        draw.line((leftPoint, endPoint), fill = (3, 29, 219))
-        draw.line((rightPoint, endPoint), fill = (3, 29, 219))
-        draw.line((leftPoint, midPoint), fill = (3, 29, 219))
-        draw.line((rightPoint, midPoint), fill = (3, 29, 219))
-
-        # Outline
+        # Outline. The needle and the digital value are well inside it, so it can be drawn before them
         draw.ellipse(((imageOrigin[0] - radius, imageOrigin[1] - radius),
                      (imageOrigin[0] + radius, imageOrigin[1] + radius)), outline = (0, 0, 0))
 
-        # Digital value text
-        #degreeSign= u'\N{DEGREE SIGN}'
-        #digitalText = "%d" % windDirNow + degreeSign
-        digitalText= self.formatter.to_ordinal_compass((windDirNow, "degree_compass", "group_direction"))
-        stringSize = bigSansFont.getsize(digitalText)
-        draw.text((imageOrigin[0] - stringSize[0] / 2, imageOrigin[1] + radius * 0.4 - stringSize[1] / 2), digitalText,
-                  font = bigSansFont, fill = (3, 29, 219))
-
-        del draw 
+        del draw
 
-        im.save(self.whereToSaveIt + gaugeName + "Gauge.png", "PNG")
+        return im
 
     def histogram(self, gaugeName, fieldName):
         # TODO - lookup fieldName from gaugelist
@@ -284,50 +301,80 @@ class GaugeGenerator(weewx.reportengine.CachedReportGenerator):
 
         roof = 0
         
-        for row in archive.genSql("SELECT " + fieldName + " FROM archive ORDER BY dateTime DESC LIMIT %d" % numPoints):
-            if row[0] is not None:            
-                histValue = float(row[0])
-
-                if histValue > maxValue:
-                    syslog.syslog(syslog.LOG_DEBUG, "histogram: %s = %f is higher than maxvalue (%f)", fieldName, histValue, maxValue)
-                elif histValue < minValue:
-                    syslog.syslog(syslog.LOG_DEBUG, "histogram: %s = %f is lower than minvalue (%f)", fieldName, histValue, minValue)
-                else:
-                    bucketNum = int((histValue - minValue) / bucketSpan)
-                    buckets[bucketNum] += 1.0
-                    
-                    if buckets[bucketNum] > roof: 
-                        roof = buckets[bucketNum]
-
-        buckets = [i / roof for i in buckets]
+        try:
+            for row in archive.genSql("SELECT " + fieldName + " FROM archive ORDER BY dateTime DESC LIMIT %d" % numPoints):
+                if row[0] is not None:            
+                    histValue = float(row[0])
+
+                    if histValue > maxValue:
+                        syslog.syslog(syslog.LOG_DEBUG, "histogram: %s = %f is higher than maxvalue (%f)" % (fieldName, histValue, maxValue))
+                    elif histValue < minValue:
+                        syslog.syslog(syslog.LOG_DEBUG, "histogram: %s = %f is lower than minvalue (%f)" % (fieldName, histValue, minValue))
+                    else:
+                        # the top of the scale goes in the last bucket
+                        bucketNum = min(int((histValue - minValue) / bucketSpan), numBins - 1)
+                        buckets[bucketNum] += 1.0
+                        
+                        if buckets[bucketNum] > roof: 
+                            roof = buckets[bucketNum]
+        finally:
+            archive.close()
+
+        if roof > 0:
+            buckets = [i / roof for i in buckets]
  
         return buckets
-  
-    def drawGauge(self, gaugeValue, gaugeName):
-        imageWidth = self.gauge_dict.as_int('image_width')
-        imageHeight = self.gauge_dict.as_int('image_height')
-        imageOrigin = (imageWidth / 2, imageHeight / 2)
-        
-        # Check gaugeValue is usable
+
+    def digitalText(self, gaugeName, gaugeValue):
+        """The value as it is written on the gauge"""
         if gaugeValue is None:
-            syslog.syslog(syslog.LOG_INFO, "reportengine: Generating %s gauge, (%d x %d), value = None" % (gaugeName, imageWidth, imageHeight))
-            digitalText = "N/A"
-        else:
-            syslog.syslog(syslog.LOG_INFO, "reportengine: Generating %s gauge, (%d x %d), value = %.1f" % (gaugeName, imageWidth, imageHeight, gaugeValue))
-                
-            if gaugeName == "Temperature":       
-                # Temparature scale
-                degreeSign= u'\N{DEGREE SIGN}'
-                digitalText = "%.1f" % gaugeValue +  degreeSign + "C"
-            elif gaugeName == "Pressure":
-                digitalText = "%d" % gaugeValue + " mbar"
-            elif gaugeName == "Humidity":
-                digitalText = "%d" % gaugeValue + "%"
-            elif gaugeName == "WindSpeed":
-                digitalText = "%.1f" % gaugeValue + " knots"
-            elif gaugeName == "WindGust":
-                digitalText = "%.1f" % gaugeValue + " knots"
-        
+            return "N/A"
+        if gaugeName == "WindDirection":
+            #degreeSign= u'\N{DEGREE SIGN}'
+            #digitalText = "%d" % windDirNow + degreeSign
+            return self.formatter.to_ordinal_compass((gaugeValue, "degree_compass", "group_direction"))
+        if gaugeName == "Temperature":       
+            # Temparature scale
+            degreeSign= u'\N{DEGREE SIGN}'
+            return "%.1f" % gaugeValue +  degreeSign + "C"
+        elif gaugeName == "Pressure":
+            return "%d" % gaugeValue + " mbar"
+        elif gaugeName == "Humidity":
+            return "%d" % gaugeValue + "%"
+        elif gaugeName == "WindSpeed":
+            return "%.1f" % gaugeValue + " knots"
+        elif gaugeName == "WindGust":
+            return "%.1f" % gaugeValue + " knots"
+
+    def needleAngle(self, gaugeName, gaugeValue):
+        """The angle of the needle for the value, in radians clockwise from the bottom of the gauge"""
+        if gaugeName == "WindDirection":
+            return math.radians(gaugeValue)
+
+        minValue = self.gauge_dict[gaugeName].as_float('minvalue')
+        maxValue = self.gauge_dict[gaugeName].as_float('maxvalue')
+        return math.radians(GAUGE_MIN_ANGLE + (gaugeValue - minValue) * (GAUGE_MAX_ANGLE - GAUGE_MIN_ANGLE) / (maxValue - minValue))
+  
+    def composeGauge(self, im, gaugeName, gaugeValue):
+        """Draw the needle and the digital value on a face"""
+        imageWidth, imageHeight, imageOrigin, radius = self.gaugeGeometry()
+        draw = ImageDraw.Draw(im)
+
+        # The needle
+        if gaugeValue is not None:
+            drawNeedle(draw, needlePoints(imageOrigin, radius, self.needleAngle(gaugeName, gaugeValue)))
+
+        # Digital value text
+        drawDigitalText(draw, imageOrigin, radius, self.digitalText(gaugeName, gaugeValue))
+
+        del draw
+
+        return im
+
+    def drawGaugeFace(self, gaugeName):
+        """The gauge without the needle or the digital value"""
+        imageWidth, imageHeight, imageOrigin, radius = self.gaugeGeometry()
+
         minValue = self.gauge_dict[gaugeName].as_float('minvalue')
         maxValue = self.gauge_dict[gaugeName].as_float('maxvalue')
         majorStep = self.gauge_dict[gaugeName].as_float('majorstep')
@@ -335,18 +382,13 @@ class GaugeGenerator(weewx.reportengine.CachedReportGenerator):
         labelFontSize = self.gauge_dict[gaugeName].as_int('labelfontsize')
         labelFormat = "%d"
    
-        minAngle = 45 # in degrees
-        maxAngle = 315
+        minAngle = GAUGE_MIN_ANGLE
+        maxAngle = GAUGE_MAX_ANGLE
 
         im = Image.new("RGB", (imageWidth, imageHeight), (255, 255, 255))
 
         draw = ImageDraw.Draw(im)
 
-        if imageWidth < imageHeight:
-            radius = imageWidth * 0.45
-        else:
-            radius = imageHeight * 0.45
-
         # Background
         if gaugeName == "Temperature":
             if self.gauge_dict[gaugeName].as_int('history') > 0:
@@ -365,9 +407,7 @@ class GaugeGenerator(weewx.reportengine.CachedReportGenerator):
         draw.ellipse(((imageOrigin[0] - radius, imageOrigin[1] - radius),
                      (imageOrigin[0] + radius, imageOrigin[1] + radius)), outline = (0, 0, 0))
 
-        sansFont = ImageFont.truetype("/usr/share/fonts/truetype/freefont/FreeSans.ttf", labelFontSize)
-        bigSansFont = ImageFont.truetype("/usr/share/fonts/truetype/freefont/FreeSans.ttf", 20)
-
+        sansFont = gaugeFont(labelFontSize)
                      
         labelValue = minValue
 
@@ -393,32 +433,125 @@ class GaugeGenerator(weewx.reportengine.CachedReportGenerator):
             endPoint = (imageOrigin[0] - radius * math.sin(angle), imageOrigin[1] + radius * math.cos(angle))
             draw.line((startPoint, endPoint), fill = (0, 0, 0))
 
-        # The needle
-        if gaugeValue is not None:
-            angle = math.radians(minAngle + (gaugeValue - minValue) * (maxAngle - minAngle) / (maxValue - minValue))
-            endPoint = (imageOrigin[0] - radius * math.sin(angle) * 0.7, imageOrigin[1] + radius * math.cos(angle) * 0.7)
-            leftPoint = (imageOrigin[0] - radius * math.sin(angle - math.pi * 7 / 8) * 0.2,
-                          imageOrigin[1] + radius * math.cos(angle - math.pi * 7 / 8) * 0.2)
-            rightPoint = (imageOrigin[0] - radius * math.sin(angle + math.pi * 7 / 8) * 0.2,
-                          imageOrigin[1] + radius * math.cos(angle + math.pi * 7 / 8) * 0.2)
-            midPoint = (imageOrigin[0] - radius * math.sin(angle + math.pi) * 0.1,
-                          imageOrigin[1] + radius * math.cos(angle + math.pi) * 0.1)
+        del draw
 
+        return im
 
-            draw.line((leftPoint, endPoint), fill = (3, 29, 219))
-            draw.line((rightPoint, endPoint), fill = (3, 29, 219))
-            draw.line((leftPoint, midPoint), fill = (3, 29, 219))
-            draw.line((rightPoint, midPoint), fill = (3, 29, 219))
 
-        # Digital value text
-        stringSize = bigSansFont.getsize(digitalText) 
-        draw.text((imageOrigin[0] - stringSize[0] / 2, imageOrigin[1] + radius * 0.4 - stringSize[1] / 2), digitalText,
-                  font = bigSansFont, fill = (3, 29, 219))
+class GaugeGenerator(weewx.reportengine.CachedReportGenerator, GaugeDrawing):
+    """Class for creating nice gauge graphics."""
+       
+    def run(self):
+        t1 = time.time()
+
+        syslog.syslog(syslog.LOG_INFO, "reportengine: Gauge generator code run (yippee!)")
+
+        self.gauges =  [{'field': "outTemp", 	 'name': "Temperature"},
+			            {'field': "barometer", 	 'name': "Pressure"}, 
+			            {'field': "windSpeed",   'name': "WindSpeed"}, 
+			            {'field': "windGust", 	 'name': "WindGust"},
+			            {'field': "outHumidity", 'name': "Humidity"},
+			            {'field': "windDir",     'name': "WindDirection"}]
+
+	    # Load up config info from skin.conf file
+        self.gauge_dict = self.skin_dict['GaugeGenerator']
+        self.formatter = weewx.units.Formatter.fromSkinDict(self.skin_dict)
+        self.converter = weewx.units.Converter.fromSkinDict(self.skin_dict)
+     
+        self.whereToSaveIt = os.path.join(self.config_dict['WEEWX_ROOT'], self.gauge_dict.get('GAUGE_ROOT'))
+
+        # How to save the gauges
+        self.spriteSheet = self.gauge_dict.as_bool('sprite_sheet') if 'sprite_sheet' in self.gauge_dict else False
+        self.imageFormat = imageFormatOption(self.gauge_dict.get('image_format', 'png'))
+        self.paletteColours = self.gauge_dict.as_int('palette_colours') if 'palette_colours' in self.gauge_dict else 0
+        self.sprites = []
+
+        # The live gauges draw these from LOOP packets, so we leave them alone
+        self.liveGaugeNames = []
+        if liveGaugesEnabled(self.config_dict) and \
+                self.config_dict['LiveGauges'].get('skin', 'Standard') == self.skin_dict.get('skin', 'Standard'):
+            self.liveGaugeNames = liveGaugeNames(self.config_dict['LiveGauges'], self.gauge_dict)
+ 
+        archivedb = self._getArchive(self.skin_dict['archive_database'])
+
+        rec = self.getRecord(archivedb, archivedb.lastGoodStamp())
+
+        if rec is not None:
+
+            # Draw a gauge for everything that has a config entry
+            for gauge in self.gauge_dict:
+                if gauge in self.liveGaugeNames:
+                    continue
+                # Is it actually a gauge?             
+                for gaugeinfo in self.gauges:
+                    if gaugeinfo['name'] == gauge:
+                        if rec.has_key(gaugeinfo['field']):
+                            # TODO: Look up units actually used by quantity and call apropriate lookup function
+                            if gaugeinfo['field'] == 'outTemp': self.drawGauge(rec[gaugeinfo['field']].degree_C.raw, gaugeinfo['name'])
+                            if gaugeinfo['field'] == 'barometer': self.drawGauge(rec[gaugeinfo['field']].mbar.raw, gaugeinfo['name'])
+                            if gaugeinfo['field'] == 'windSpeed': self.drawGauge(rec[gaugeinfo['field']].knot.raw, gaugeinfo['name'])
+                            if gaugeinfo['field'] == 'windGust': self.drawGauge(rec[gaugeinfo['field']].knot.raw, gaugeinfo['name'])
+                            if gaugeinfo['field'] == 'outHumidity': self.drawGauge(float(str(rec[gaugeinfo['field']]).strip('%')), gaugeinfo['name'])
+                            
+                            if gaugeinfo['field'] == 'windDir' :self.drawFunkyWindGauge(gaugeinfo['name'])
+
+        if self.sprites:
+            self.saveSpriteSheet()
+                            
+        t2= time.time()
+        syslog.syslog(syslog.LOG_INFO, """reportengine: Time taken %.2f seconds""" % (t2 - t1))
 
-        del draw 
 
-        im.save(self.whereToSaveIt + gaugeName + "Gauge.png", "PNG")
+    def drawFunkyWindGauge(self, gaugeName):
+        """Wind direction gauge generator with shaded background to indicate historic wind directions"""
+        
+        imageWidth, imageHeight, imageOrigin, radius = self.gaugeGeometry()
         
+        syslog.syslog(syslog.LOG_INFO, """reportengine: Generating %s gauge, (%d x %d)""" % (gaugeName, imageWidth, imageHeight))
+
+        archivedb = self._getArchive(self.skin_dict['archive_database'])
+        (data_time, data_value) = archivedb.getSqlVectors('windDir', archivedb.lastGoodStamp() - self.gauge_dict[gaugeName].as_int('history') * 60,
+                                    archivedb.lastGoodStamp(), 300, 'avg')
+    
+        for rec in data_value:
+            syslog.syslog(syslog.LOG_INFO, """reportengine: %s""" % rec)
+
+        buckets, windDirNow = self.windHistory(gaugeName)
+
+        im = self.composeGauge(self.drawWindFace(gaugeName, buckets), gaugeName, windDirNow)
+        self.saveGauge(im, gaugeName)
+
+    def drawGauge(self, gaugeValue, gaugeName):
+        imageWidth, imageHeight, imageOrigin, radius = self.gaugeGeometry()
+        
+        # Check gaugeValue is usable
+        if gaugeValue is None:
+            syslog.syslog(syslog.LOG_INFO, "reportengine: Generating %s gauge, (%d x %d), value = None" % (gaugeName, imageWidth, imageHeight))
+        else:
+            syslog.syslog(syslog.LOG_INFO, "reportengine: Generating %s gauge, (%d x %d), value = %.1f" % (gaugeName, imageWidth, imageHeight, gaugeValue))
+
+        im = self.composeGauge(self.drawGaugeFace(gaugeName), gaugeName, gaugeValue)
+        self.saveGauge(im, gaugeName)
+
+    def saveGauge(self, im, gaugeName):
+        """Save the gauge in a file of its own, or keep it for the sprite sheet"""
+        if self.spriteSheet:
+            self.sprites.append((gaugeName, im))
+        else:
+            saveImage(im, self.whereToSaveIt + gaugeName + "Gauge." + self.imageFormat, self.imageFormat, self.paletteColours)
+
+    def saveSpriteSheet(self):
+        imageWidth, imageHeight, imageOrigin, radius = self.gaugeGeometry()
+        sheet, coordinates = spriteSheet(self.sprites, imageWidth, imageHeight)
+        imageName = SPRITE_SHEET_NAME + "." + self.imageFormat
+        saveImage(sheet, self.whereToSaveIt + imageName, self.imageFormat, self.paletteColours)
+
+        spriteMap = {'image': imageName, 'width': sheet.size[0], 'height': sheet.size[1], 'gauges': coordinates}
+        with open(self.whereToSaveIt + SPRITE_SHEET_NAME + ".json", "w") as jsonFile:
+            json.dump(spriteMap, jsonFile, sort_keys=True)
+        with open(self.whereToSaveIt + SPRITE_SHEET_NAME + ".css", "w") as cssFile:
+            cssFile.write(spriteSheetCss(spriteMap))
+
     def getRecord(self, archivedb, time_ts):
         """Get an observation record from the archive database, returning
         it as a ValueDict."""
@@ -449,3 +582,417 @@ def maxValue(array):
             max = i
 
     return max
+
+# The fonts, by size. Loading a font is slower than drawing a gauge.
+_fonts = {}
+
+def gaugeFont(size):
+    if size not in _fonts:
+        _fonts[size] = ImageFont.truetype("/usr/share/fonts/truetype/freefont/FreeSans.ttf", size)
+    return _fonts[size]
+
+def needlePoints(imageOrigin, radius, angle):
+    """The tip, left, right and tail points of the needle"""
+    endPoint = (imageOrigin[0] - radius * math.sin(angle) * 0.7, imageOrigin[1] + radius * math.cos(angle) * 0.7)
+    leftPoint = (imageOrigin[0] - radius * math.sin(angle - math.pi * 7 / 8) * 0.2,
+                  imageOrigin[1] + radius * math.cos(angle - math.pi * 7 / 8) * 0.2)
+    rightPoint = (imageOrigin[0] - radius * math.sin(angle + math.pi * 7 / 8) * 0.2,
+                  imageOrigin[1] + radius * math.cos(angle + math.pi * 7 / 8) * 0.2)
+    midPoint = (imageOrigin[0] - radius * math.sin(angle + math.pi) * 0.1,
+                  imageOrigin[1] + radius * math.cos(angle + math.pi) * 0.1)
+    return endPoint, leftPoint, rightPoint, midPoint
+
+def drawNeedle(draw, points):
+    endPoint, leftPoint, rightPoint, midPoint = points
+    draw.line((leftPoint, endPoint), fill = (3, 29, 219))
+    draw.line((rightPoint, endPoint), fill = (3, 29, 219))
+    draw.line((leftPoint, midPoint), fill = (3, 29, 219))
+    draw.line((rightPoint, midPoint), fill = (3, 29, 219))
+
+def drawDigitalText(draw, imageOrigin, radius, digitalText):
+    bigSansFont = gaugeFont(20)
+    stringSize = bigSansFont.getsize(digitalText) 
+    draw.text((imageOrigin[0] - stringSize[0] / 2, imageOrigin[1] + radius * 0.4 - stringSize[1] / 2), digitalText,
+              font = bigSansFont, fill = (3, 29, 219))
+
+def imageFormatOption(imageFormat):
+    """The format to save the gauges in, png or webp. Not every PIL can save WebP, so fall back to PNG."""
+    imageFormat = imageFormat.lower()
+    if imageFormat == 'webp':
+        Image.init()
+        if 'WEBP' in Image.SAVE:
+            return imageFormat
+        syslog.syslog(syslog.LOG_WARNING, "reportengine: This PIL can't save WebP, saving the gauges as PNG")
+    elif imageFormat != 'png':
+        syslog.syslog(syslog.LOG_WARNING, "reportengine: Unknown image_format %s, saving the gauges as PNG" % imageFormat)
+    return 'png'
+
+def saveImage(im, fileName, imageFormat='png', paletteColours=0):
+    """Save a gauge image, to a file name or a file. With paletteColours, the image is reduced to a palette of
+    that many colours first, and a PNG is optimised."""
+    if paletteColours:
+        im = im.convert("P", palette=Image.ADAPTIVE, colors=paletteColours)
+    if imageFormat == 'webp':
+        im.save(fileName, "WEBP", lossless=True)
+    elif paletteColours:
+        im.save(fileName, "PNG", optimize=True)
+    else:
+        im.save(fileName, "PNG")
+
+def spriteSheet(sprites, imageWidth, imageHeight):
+    """Paste the gauges, a list of (gaugeName, image), side by side into one image. Returns the image and where
+    each gauge is in it."""
+    sheet = Image.new("RGB", (imageWidth * len(sprites), imageHeight), (255, 255, 255))
+    coordinates = {}
+    for i, (gaugeName, im) in enumerate(sprites):
+        sheet.paste(im, (i * imageWidth, 0))
+        coordinates[gaugeName] = {'x': i * imageWidth, 'y': 0, 'width': imageWidth, 'height': imageHeight}
+    return sheet, coordinates
+
+def spriteSheetCss(spriteMap):
+    """CSS to show a gauge from the sprite sheet, as <div class="gauge gauge-WindSpeed"></div>"""
+    css = ['.gauge { background: url("%s") no-repeat; display: inline-block; }' % spriteMap['image']]
+    for gaugeName, position in sorted(spriteMap['gauges'].items()):
+        css.append('.gauge-%s { background-position: %dpx %dpx; width: %dpx; height: %dpx; }'
+                   % (gaugeName, -position['x'], -position['y'], position['width'], position['height']))
+    return "\n".join(css) + "\n"
+
+def percentile(sortedValues, fraction):
+    return sortedValues[int(round(fraction * (len(sortedValues) - 1)))]
+
+
+def liveGaugesEnabled(config_dict):
+    """Whether weewx runs the LiveGauges service"""
+    serviceList = config_dict.get('Engines', {}).get('WxEngine', {}).get('service_list', [])
+    if isinstance(serviceList, basestring):
+        serviceList = serviceList.split(',')
+    return 'LiveGauges' in config_dict and any(service.strip().endswith('.LiveGauges') for service in serviceList)
+
+def liveGaugeNames(live_dict, gauge_dict):
+    """The gauges the live gauges draw, of those in the [GaugeGenerator] section"""
+    gaugeNames = live_dict.get('gauges', ['WindSpeed', 'WindDirection'])
+    if isinstance(gaugeNames, basestring):
+        gaugeNames = [gaugeNames]
+    return [gaugeName for gaugeName in gaugeNames if gaugeName in LIVE_GAUGES and gaugeName in gauge_dict]
+
+
+class LiveGauges(StdService):
+    """Service that redraws the wind gauges from LOOP packets, between report cycles."""
+
+    def __init__(self, engine, config_dict):
+        super(LiveGauges, self).__init__(engine, config_dict)
+
+        live_dict = config_dict['LiveGauges']
+        skinConfigPath = os.path.join(config_dict['WEEWX_ROOT'], config_dict['StdReport']['SKIN_ROOT'],
+                                      live_dict.get('skin', 'Standard'), 'skin.conf')
+        skin_dict = configobj.ConfigObj(skinConfigPath, file_error=True)
+
+        self.renderer = LiveGaugeRenderer(config_dict, skin_dict, live_dict)
+        self.renderThread = threading.Thread(target=self.renderer.run, name="LiveGauges")
+        self.renderThread.daemon = True
+        self.renderThread.start()
+
+        self.bind(weewx.NEW_LOOP_PACKET, self.newLoopPacket)
+        self.bind(weewx.NEW_ARCHIVE_RECORD, self.newArchiveRecord)
+
+    def newLoopPacket(self, event):
+        self.renderer.offer(packet=event.packet)
+
+    def newArchiveRecord(self, event):
+        # The wind history behind the direction gauge has changed
+        self.renderer.offer(newHistory=True)
+
+    def shutDown(self):
+        self.renderer.stop()
+        self.renderThread.join(10.0)
+
+
+class LiveGaugeRenderer(GaugeDrawing):
+    """Draws the live gauges on a thread of its own, from the latest LOOP packet."""
+
+    def __init__(self, config_dict, skin_dict, live_dict):
+        self.config_dict = config_dict
+        self.gauge_dict = skin_dict['GaugeGenerator']
+        self.formatter = weewx.units.Formatter.fromSkinDict(skin_dict)
+        self.whereToSaveIt = os.path.join(config_dict['WEEWX_ROOT'], self.gauge_dict.get('GAUGE_ROOT'))
+
+        self.gaugeNames = liveGaugeNames(live_dict, self.gauge_dict)
+
+        try:
+            maxRate = float(live_dict.get('max_rate', LIVE_GAUGES_DEFAULT_RATE))
+        except ValueError:
+            maxRate = 0
+        if maxRate <= 0:
+            syslog.syslog(syslog.LOG_ERR, "LiveGauges: max_rate must be more than 0, not %s. Using %.1f"
+                          % (live_dict.get('max_rate'), LIVE_GAUGES_DEFAULT_RATE))
+            maxRate = LIVE_GAUGES_DEFAULT_RATE
+        self.minInterval = 1.0 / maxRate
+        self.interval = self.minInterval
+        self.frameBudget = float(live_dict.get('frame_budget_ms', 100)) / 1000.0
+        self.gaugeTimes = []
+
+        # The faces of the gauges, and the needle and digital value of the last frame of each gauge
+        self.faces = {}
+        self.lastFrames = {}
+
+        # The latest packet, waiting to be drawn
+        self.condition = threading.Condition()
+        self.packet = None
+        self.newHistory = False
+        self.running = True
+
+        self.resetStatistics()
+
+    def offer(self, packet=None, newHistory=False):
+        """Called on the engine thread. Replaces any packet that has not been drawn yet."""
+        with self.condition:
+            if packet is not None:
+                self.packet = packet
+            self.newHistory = self.newHistory or newHistory
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def run(self):
+        syslog.syslog(syslog.LOG_INFO, "LiveGauges: Drawing %s at up to %.2f frames a second" % (", ".join(self.gaugeNames), 1.0 / self.minInterval))
+        lastFrameTime = 0
+        while True:
+            with self.condition:
+                while self.running and self.packet is None:
+                    self.condition.wait()
+                if not self.running:
+                    return
+
+            # Wait until the next frame is due, so that we draw the latest packet. Never more than the interval,
+            # in case the clock has been stepped back.
+            delay = min(lastFrameTime + self.interval - time.time(), self.interval)
+            if delay > 0:
+                time.sleep(delay)
+
+            with self.condition:
+                packet, self.packet = self.packet, None
+                newHistory, self.newHistory = self.newHistory, False
+
+            lastFrameTime = time.time()
+            try:
+                self.drawFrame(packet, newHistory)
+            except Exception, e:
+                syslog.syslog(syslog.LOG_ERR, "LiveGauges: Unable to draw the gauges: %s" % e)
+
+            # Slow down if drawing takes more than its share of the time
+            self.interval = max(self.minInterval, (time.time() - lastFrameTime) / LIVE_GAUGES_MAX_SHARE)
+            self.logStatistics()
+
+    def drawFrame(self, packet, newHistory=False):
+        """Draw every gauge that has changed, rebuilding any face that needs it, and time the whole frame"""
+        t1 = time.time()
+        if newHistory:
+            self.faces.pop('WindDirection', None)
+        self.gaugeTimes = []
+        self.drawPacket(packet)
+        frameTime = time.time() - t1
+
+        self.frameTimes.append(frameTime)
+        if frameTime > self.frameBudget:
+            self.overBudget += 1
+            if self.overBudget == 1:
+                syslog.syslog(syslog.LOG_WARNING, "LiveGauges: frame took %.1f ms (%s), over the budget of %.0f ms"
+                              % (frameTime * 1000, ", ".join(["%s %.1f ms" % gaugeTime for gaugeTime in self.gaugeTimes]),
+                                 self.frameBudget * 1000))
+
+    def drawPacket(self, packet):
+        for gaugeName in self.gaugeNames:
+            # A packet without the field says nothing about it. None is a reading of no value, shown as N/A.
+            if LIVE_GAUGES[gaugeName][0] not in packet:
+                continue
+            self.drawLiveGauge(gaugeName, self.packetValue(packet, gaugeName))
+
+    def packetValue(self, packet, gaugeName):
+        """The value for the gauge from the packet, in the units the gauge shows"""
+        field, unit = LIVE_GAUGES[gaugeName]
+        value = packet.get(field)
+        if value is not None and unit is not None:
+            value = weewx.units.convert((value,) + weewx.units.getStandardUnitType(packet['usUnits'], field), unit)[0]
+        return value
+
+    def drawLiveGauge(self, gaugeName, gaugeValue):
+        """Draw and save one frame of a gauge, unless it would be the same as the last one"""
+        imageWidth, imageHeight, imageOrigin, radius = self.gaugeGeometry()
+
+        t1 = time.time()
+        if gaugeName not in self.faces:
+            if gaugeName == 'WindDirection':
+                try:
+                    buckets, windDirNow = self.windHistory(gaugeName)
+                except Exception, e:
+                    # Draw the face without the history, rather than trying the archive again every frame
+                    syslog.syslog(syslog.LOG_ERR, "LiveGauges: Unable to read the wind history: %s" % e)
+                    buckets = [0.0] * WIND_DIRECTION_BINS
+                self.faces[gaugeName] = self.drawWindFace(gaugeName, buckets)
+            else:
+                self.faces[gaugeName] = self.drawGaugeFace(gaugeName)
+            # Load the digital value's font now, not in the first frame
+            gaugeFont(20)
+            self.lastFrames.pop(gaugeName, None)
+            syslog.syslog(syslog.LOG_DEBUG, "LiveGauges: Drew the %s face in %.1f ms" % (gaugeName, (time.time() - t1) * 1000))
+
+        # The needle is drawn at whole pixels, so that we can tell when it hasn't moved
+        needle = None
+        if gaugeValue is not None:
+            needle = tuple([(int(round(x)), int(round(y)))
+                            for x, y in needlePoints(imageOrigin, radius, self.needleAngle(gaugeName, gaugeValue))])
+        digitalText = self.digitalText(gaugeName, gaugeValue)
+        if self.lastFrames.get(gaugeName) == (needle, digitalText):
+            self.skipped += 1
+            return
+
+        im = self.faces[gaugeName].copy()
+        draw = ImageDraw.Draw(im)
+        if needle is not None:
+            drawNeedle(draw, needle)
+        drawDigitalText(draw, imageOrigin, radius, digitalText)
+        del draw
+
+        # Save it under another name and rename it, so the web server never sends half a file
+        fileName = self.whereToSaveIt + gaugeName + "Gauge.png"
+        im.save(fileName + ".tmp", "PNG")
+        os.rename(fileName + ".tmp", fileName)
+
+        self.lastFrames[gaugeName] = (needle, digitalText)
+        # For the warning when the frame is over its budget
+        self.gaugeTimes.append((gaugeName, (time.time() - t1) * 1000))
+
+    def resetStatistics(self):
+        self.statisticsTime = time.time()
+        self.frameTimes = collections.deque(maxlen=10000)
+        self.skipped = 0
+        self.overBudget = 0
+
+    def statistics(self):
+        """The number of frames, the gauges skipped as unchanged, and the frame times in milliseconds"""
+        frameTimes = sorted(self.frameTimes)
+        stats = {'frames': len(frameTimes), 'skipped': self.skipped, 'overBudget': self.overBudget,
+                 'budgetMs': self.frameBudget * 1000, 'intervalSeconds': self.interval}
+        if frameTimes:
+            stats.update({'p50Ms': percentile(frameTimes, 0.50) * 1000,
+                          'p99Ms': percentile(frameTimes, 0.99) * 1000,
+                          'maxMs': frameTimes[-1] * 1000})
+        return stats
+
+    def logStatistics(self):
+        if time.time() - self.statisticsTime < LIVE_GAUGES_REPORT_INTERVAL:
+            return
+        stats = self.statistics()
+        if stats['frames']:
+            syslog.syslog(syslog.LOG_INFO, "LiveGauges: %(frames)d frames, %(skipped)d skipped, %(p50Ms).1f ms median, %(p99Ms).1f ms p99, "
+                          "%(maxMs).1f ms max, %(overBudget)d over the budget of %(budgetMs).0f ms" % stats)
+        self.resetStatistics()
+
+
+def benchmarkLiveGauges(skinConfigPath, numPackets=600):
+    """Time the live gauges against redrawing each gauge whole, as the generator does, for a gusty wind"""
+    import random
+    import tempfile
+
+    htmlRoot = tempfile.mkdtemp()
+    skin_dict = configobj.ConfigObj(skinConfigPath, file_error=True)
+    skin_dict['GaugeGenerator']['GAUGE_ROOT'] = ''
+    # The made up packets have windGust, so time all three
+    renderer = LiveGaugeRenderer({'WEEWX_ROOT': htmlRoot + '/'}, skin_dict, {'gauges': ['WindSpeed', 'WindGust', 'WindDirection']})
+    # There is no archive, so make up the history
+    renderer.windHistory = lambda gaugeName: ([random.random() for i in range(16)], None)
+
+    random.seed(1)
+    packets = []
+    windDir = 225.0
+    for i in range(numPackets):
+        windSpeed = max(0.0, 14 + random.gauss(0, 3))
+        windDir = (windDir + random.gauss(0, 5)) % 360
+        packets.append({'dateTime': i * 2, 'usUnits': weewx.US, 'windSpeed': windSpeed,
+                        'windGust': windSpeed + abs(random.gauss(0, 4)), 'windDir': windDir})
+
+    t1 = time.time()
+    for packet in packets:
+        renderer.drawFrame(packet)
+    liveSeconds = time.time() - t1
+
+    t1 = time.time()
+    for packet in packets[:numPackets / 10]:
+        for gaugeName in renderer.gaugeNames:
+            value = renderer.packetValue(packet, gaugeName)
+            im = renderer.drawWindFace(gaugeName, renderer.windHistory(gaugeName)[0]) if gaugeName == 'WindDirection' else renderer.drawGaugeFace(gaugeName)
+            renderer.composeGauge(im, gaugeName, value).save(os.path.join(htmlRoot, gaugeName + "Whole.png"), "PNG")
+    wholeSeconds = (time.time() - t1) * 10
+
+    stats = renderer.statistics()
+    stats['packets'] = numPackets
+    stats['liveMsPerPacket'] = liveSeconds * 1000 / numPackets
+    stats['wholeMsPerPacket'] = wholeSeconds * 1000 / numPackets
+    print json.dumps(stats, indent=2, sort_keys=True)
+
+
+def compareGaugeEncodings(skinConfigPath, repeats=5):
+    """Compare the bytes and encoding time of the gauges in files of their own, full colour PNG as they were, with
+    the sprite sheet, and with the palette and WebP encodings"""
+    import io
+    import random
+
+    skin_dict = configobj.ConfigObj(skinConfigPath, file_error=True)
+    drawing = GaugeDrawing()
+    drawing.gauge_dict = skin_dict['GaugeGenerator']
+    drawing.formatter = weewx.units.Formatter.fromSkinDict(skin_dict)
+    # There is no archive, so make up the history
+    random.seed(1)
+    drawing.histogram = lambda gaugeName, fieldName: [random.random() for i in range(drawing.gauge_dict[gaugeName].as_int('bins'))]
+
+    sampleValues = {'Temperature': 12.3, 'Pressure': 1013.0, 'Humidity': 78.0,
+                    'WindSpeed': 14.2, 'WindGust': 21.7, 'WindDirection': 225.0}
+    sprites = []
+    for gaugeName in drawing.gauge_dict.sections:
+        if gaugeName == 'WindDirection':
+            face = drawing.drawWindFace(gaugeName, [random.random() for i in range(16)])
+        elif gaugeName in sampleValues:
+            face = drawing.drawGaugeFace(gaugeName)
+        else:
+            continue
+        sprites.append((gaugeName, drawing.composeGauge(face, gaugeName, sampleValues[gaugeName])))
+    imageWidth, imageHeight, imageOrigin, radius = drawing.gaugeGeometry()
+
+    encodings = [('png', 0), ('png', 64)]
+    Image.init()
+    if 'WEBP' in Image.SAVE:
+        encodings += [('webp', 0), ('webp', 64)]
+
+    print "%-8s %-6s %8s %9s %8s %10s" % ('layout', 'format', 'colours', 'requests', 'bytes', 'encode ms')
+    for imageFormat, paletteColours in encodings:
+        for layout in ('files', 'sprite'):
+            t1 = time.time()
+            for i in range(repeats):
+                if layout == 'sprite':
+                    sheet, coordinates = spriteSheet(sprites, imageWidth, imageHeight)
+                    images = [sheet]
+                else:
+                    images = [im for gaugeName, im in sprites]
+                files = []
+                for im in images:
+                    imageFile = io.BytesIO()
+                    saveImage(im, imageFile, imageFormat, paletteColours)
+                    files.append(imageFile.getvalue())
+            encodeMs = (time.time() - t1) * 1000 / repeats
+
+            if layout == 'sprite':
+                spriteMap = {'image': SPRITE_SHEET_NAME + "." + imageFormat, 'width': sheet.size[0], 'height': sheet.size[1],
+                             'gauges': coordinates}
+                files.append(spriteSheetCss(spriteMap))
+            print "%-8s %-6s %8s %9d %8d %10.1f" % (layout, imageFormat, paletteColours or 'full', len(files),
+                                                     sum([len(f) for f in files]), encodeMs)
+
+
+if __name__ == '__main__':
+    import sys
+    skinConfigPath = sys.argv[1] if len(sys.argv) > 1 else "/etc/weewx/skins/Standard/skin.conf"
+    benchmarkLiveGauges(skinConfigPath)
+    compareGaugeEncodings(skinConfigPath)
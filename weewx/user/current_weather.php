@@ -2,9 +2,22 @@
 $mem = new Memcached();
 $mem->addServer("127.0.0.1", 11211);
 
-$result = $mem->get("current_weather");
+# get the fresh document and the last one in one round trip. If only the last one is there, weewx has stopped
+# publishing, so we say the document is stale.
+$result = $mem->getMulti(array("current_weather:v2", "current_weather:v2:last"));
 
 header('Content-Type: application/json');
 
-echo $result
+if (isset($result["current_weather:v2"])) {
+	echo $result["current_weather:v2"];
+} elseif (isset($result["current_weather:v2:last"])) {
+	$document = json_decode($result["current_weather:v2:last"], true);
+	$document["stale"] = true;
+	if (isset($document["dateTime"])) {
+		$document["age"] = time() - $document["dateTime"];
+	}
+	echo json_encode($document);
+} else {
+	http_response_code(503);
+}
 ?>
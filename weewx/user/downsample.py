@@ -0,0 +1,96 @@
+#==============================================================================
+#                    downsample.py
+#
+# Shape preserving downsampling of chart series
+#
+#==============================================================================
+
+
+"""
+Functions to pick which points of a chart series to keep, so that a long series can be sent to the browser as a few
+hundred points without losing its shape or its peaks.
+
+Smooth series, such as the mean wind speed or temperature, use Largest-Triangle-Three-Buckets (Sveinn Steinarsson,
+2013). The points are split into buckets, and from each bucket we keep the point that makes the largest triangle with
+the point kept from the bucket before and the average of the bucket after. That keeps the turning points, where a
+plain average or every nth point would flatten them.
+
+Series where the extremes are what matters, such as the maximum gust or the minimum and maximum temperature, use an
+envelope: from each bucket we keep the point with the largest value, the smallest value, or both.
+
+The functions work on column arrays, a list of timestamps and a list of values, and return the indexes of the points
+to keep, in order, so that a file with several series can keep the union of the points each series needs. Values
+of None are never picked, except that the first and last point are always kept.
+"""
+
+
+def lttb_indexes(xs, ys, threshold):
+    """The indexes of threshold points to keep from the series xs, ys, by Largest-Triangle-Three-Buckets"""
+    points = [i for i in range(len(ys)) if ys[i] is not None]
+    if threshold >= len(points):
+        return points
+    if threshold < 3:
+        # there are no buckets between the first and last points, which we always keep
+        return sorted(set([points[0], points[-1]]))
+    xs = [xs[i] for i in points]
+    ys = [ys[i] for i in points]
+    n = len(points)
+
+    every = float(n - 2) / (threshold - 2)
+    a = 0
+    kept = [0]
+    for bucket in range(threshold - 2):
+        # the average of the next bucket
+        next_start = int((bucket + 1) * every) + 1
+        next_end = min(int((bucket + 2) * every) + 1, n)
+        next_length = next_end - next_start
+        avg_x = sum(xs[next_start:next_end]) / float(next_length)
+        avg_y = sum(ys[next_start:next_end]) / float(next_length)
+
+        # the point in this bucket with the largest triangle. Twice the area is enough to compare them.
+        start = int(bucket * every) + 1
+        end = int((bucket + 1) * every) + 1
+        ax, ay = xs[a], ys[a]
+        dx, dy = avg_x - ax, avg_y - ay
+        a = max(range(start, end), key=lambda i: abs(dx * (ys[i] - ay) - (xs[i] - ax) * dy))
+        kept.append(a)
+    kept.append(n - 1)
+    return [points[i] for i in kept]
+
+
+def envelope_indexes(ys, buckets, keep='max'):
+    """The indexes of the largest value, the smallest value or both ('max', 'min' or 'minmax') in each of
+    buckets buckets, with the first and last point"""
+    n = len(ys)
+    if n <= buckets:
+        return range(n)
+    every = float(n) / buckets
+    kept = set([0, n - 1])
+    for bucket in range(buckets):
+        bucket_points = [i for i in range(int(bucket * every), int((bucket + 1) * every)) if ys[i] is not None]
+        if not bucket_points:
+            continue
+        if keep in ('max', 'minmax'):
+            kept.add(max(bucket_points, key=ys.__getitem__))
+        if keep in ('min', 'minmax'):
+            kept.add(min(bucket_points, key=ys.__getitem__))
+    return sorted(kept)
+
+
+def downsample_indexes(xs, columns, max_points):
+    """The indexes of the points to keep from several series sharing the timestamps xs, at most max_points.
+    columns is a list of (values, method), where method is 'lttb', 'max', 'min' or 'minmax'. Each series gets an
+    equal share of max_points, and we keep the union of the points they pick."""
+    if not max_points or len(xs) <= max_points:
+        return range(len(xs))
+
+    share = max_points // len(columns)
+    kept = set()
+    for values, method in columns:
+        if method == 'lttb':
+            kept.update(lttb_indexes(xs, values, share))
+        else:
+            # the first and last points, and one or two for each bucket
+            buckets = max(1, (share - 2) // (2 if method == 'minmax' else 1))
+            kept.update(envelope_indexes(values, buckets, method))
+    return sorted(kept)
@@ -0,0 +1,539 @@
+#==============================================================================
+#                    jsonreports.py
+#
+# Writes the JSON files for the Google Charts pages
+#
+#==============================================================================
+import os
+import time
+import json
+import syslog
+import collections
+import gzip
+import shutil
+import tempfile
+import StringIO
+
+import configobj
+
+import weewx
+import weewx.units
+import weewx.reportengine
+from weewx.engine import StdService
+from weeutil.weeutil import to_int, to_bool, option_as_list
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+"""
+Report generator and service that write the day JSON files used by the Google Charts pages:
+
+day.json            - the latest archive record, and the day's wind, pressure, outside and inside temperature
+day-wind.json       - the day's wind
+day-temp.json       - the day's outside and inside temperature
+day-pressure.json   - the day's pressure
+
+These used to be Cheetah templates that looped over $span($day_delta=1).records, formatting every value of every
+record through a ValueHelper and checking the result for "N/A". That was by far the slowest part of each report
+cycle. The generator, JsonGenerator, runs one SQL query for the day, converts each observation type for the whole
+day in one go, and encodes each series once with the json module, reusing it in every file it appears in.
+
+The service, RollingDayJson, goes further. It keeps the day in memory, and on each new archive record appends the
+record and drops the records that have fallen out of the day, then writes the files. It only reads the archive once,
+for the first archive record after weewx starts. Use one or the other, not both.
+
+The files are written to a temporary file and renamed, so the web server never sees a partly written file.
+
+Optionally, the day is also written as day-columns.json, in a compact columnar format:
+
+{"start": 1500000000, "interval": 300, "count": 288,
+ "windSpeed": [4.3, 5.1, ...], "windGust": [...], "windDir": [212, 230, ...], "barometer": [...],
+ "outTemp": [...], "inTemp": [...], "latestArchiveRecord": {...}}
+
+start is the dateTime of the first record, as seconds since the epoch, and every record follows the one before
+after interval seconds. If they don't, because the station missed a record, there is also "dt", the count - 1
+seconds between each record and the one before. Missing values are null, and values are rounded to the precision
+we display them at, rather than the six decimal places of the other files.
+
+Each file can also be written pre-compressed, as file.json.gz and, if the brotli module is installed,
+file.json.br, so that the web server doesn't compress them on every request. For nginx, use gzip_static on; and
+brotli_static on;. If you turn precompression off, delete the old .gz and .br files, or they will be served stale.
+
+The series are lists of [dateTime, value, ...] with the dateTime as local time in ISO 8601 format, and the values
+in knots, degrees C and mbar as before. A missing value is null. In the wind, pressure and temperature series of
+day.json, and in day-wind.json and day-pressure.json, a record without a wind direction, pressure or temperature
+is left out, as the templates did.
+
+********************************************************************************
+
+To use the service, add it to the archive_services in weewx.conf, after StdArchive, so that the archive already
+holds the new record when the service first reads it:
+
+[Engine]
+    [[Services]]
+        archive_services = weewx.engine.StdArchive, user.jsonreports.RollingDayJson
+
+and, optionally, configure it in weewx.conf:
+
+[RollingDayJson]
+    # The binding for the archive. The default is wx_binding
+    data_binding = wx_binding
+    # The length of the day series, in seconds. The default is 86400, 24 hours
+    time_length = 86400
+    # Write day-columns.json too. The default is false
+    columnar = true
+    # Write pre-compressed copies of the files, gzip and/or brotli. The default is none
+    precompress = gzip, brotli
+    # The report whose skin formats the latest archive record, and whose HTML_ROOT the files are written to.
+    # The default is StandardReport
+    report = StandardReport
+    # Where to write the files, if not to the report's HTML_ROOT
+    html_root = /var/www/html/weewx
+
+********************************************************************************
+
+To use the generator instead, add it to the generator_list in skin.conf:
+
+[Generators]
+    generator_list = weewx.cheetahgenerator.CheetahGenerator, weewx.imagegenerator.ImageGenerator, weewx.reportengine.CopyGenerator, user.jsonreports.JsonGenerator
+
+and, optionally, configure it in skin.conf:
+
+[JsonGenerator]
+    # The binding for the archive. The default is wx_binding
+    data_binding = wx_binding
+    # The length of the day series, in seconds. The default is 86400, 24 hours
+    time_length = 86400
+    columnar = true
+    precompress = gzip
+
+********************************************************************************
+
+To compare the size and parse time of the row and columnar formats, run this module with weewx on the path:
+
+PYTHONPATH=bin python bin/user/jsonreports.py
+
+********************************************************************************
+"""
+
+# the observation types we read from the archive, and the units we publish them in
+OBS_UNITS = [
+    ('windSpeed', 'knot'),
+    ('windGust', 'knot'),
+    ('windDir', 'degree_compass'),
+    ('barometer', 'mbar'),
+    ('outTemp', 'degree_C'),
+    ('inTemp', 'degree_C'),
+]
+
+# how many decimal places we publish. The templates formatted with %f, which gives six.
+VALUE_DECIMALS = 6
+
+# how many decimal places we publish in the columnar format, the precision the pages display
+DISPLAY_DECIMALS = {
+    'windSpeed': 1,
+    'windGust': 1,
+    'windDir': 0,
+    'barometer': 1,
+    'outTemp': 1,
+    'inTemp': 1,
+}
+
+# the pre-compressed copies we can write, and their file extensions
+PRECOMPRESS_EXTENSIONS = {
+    'gzip': '.gz',
+    'brotli': '.br',
+}
+
+
+def json_time(ts):
+    """Format a timestamp as local time in ISO 8601 format"""
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(ts))
+
+
+def write_file_atomically(path, content, precompress=()):
+    """Write the content to a temporary file next to path, then rename it over path. Write the pre-compressed
+    copies first, so they are never older than the file."""
+    for encoding in precompress:
+        write_file_atomically(path + PRECOMPRESS_EXTENSIONS[encoding], compress(content, encoding))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.rename(tmp_path, path)
+
+
+def compress(content, encoding):
+    """Compress the content as gzip or brotli, at the highest level, as it is compressed once and served often"""
+    if encoding == 'brotli':
+        return brotli.compress(content, quality=11)
+    buf = StringIO.StringIO()
+    # a fixed mtime, so the same content always compresses to the same file
+    gzip_file = gzip.GzipFile(filename='', mode='wb', compresslevel=9, fileobj=buf, mtime=0)
+    gzip_file.write(content)
+    gzip_file.close()
+    return buf.getvalue()
+
+
+def precompress_option(option):
+    """The list of encodings from the precompress option, leaving out brotli if the module isn't installed"""
+    encodings = [encoding for encoding in option_as_list(option) or [] if encoding != 'none']
+    for encoding in encodings:
+        if encoding not in PRECOMPRESS_EXTENSIONS:
+            raise ValueError("jsonreports: Unknown precompress encoding '%s'" % encoding)
+    if 'brotli' in encodings and brotli is None:
+        syslog.syslog(syslog.LOG_INFO, "jsonreports: brotli module not installed, not writing .br files")
+        encodings.remove('brotli')
+    return encodings
+
+
+class DayColumns(object):
+    """The archive records for a span of time, held as columns: a list of timestamps, and for each observation
+    type, a list of values in the units we publish, with None where there is no value."""
+
+    def __init__(self, timestamps, columns):
+        self.timestamps = timestamps
+        self.columns = columns
+        self.times = [json_time(ts) for ts in timestamps]
+
+    @staticmethod
+    def from_archive(dbmanager, start_ts, stop_ts, obs_units=OBS_UNITS):
+        """Read the records in the span with a single query, and convert each column to its unit"""
+        obs_types = [obs_type for (obs_type, unit) in obs_units if obs_type in dbmanager.sqlkeys]
+        sql = "SELECT dateTime, usUnits, %s FROM %s WHERE dateTime > ? AND dateTime <= ? ORDER BY dateTime ASC" % (
+            ", ".join(obs_types), dbmanager.table_name)
+
+        timestamps = []
+        unit_systems = []
+        raw_columns = dict((obs_type, []) for obs_type in obs_types)
+        for row in dbmanager.genSql(sql, (start_ts, stop_ts)):
+            timestamps.append(row[0])
+            unit_systems.append(row[1])
+            for i in range(len(obs_types)):
+                raw_columns[obs_types[i]].append(row[i + 2])
+
+        columns = {}
+        for obs_type, unit in obs_units:
+            if obs_type in raw_columns:
+                columns[obs_type] = convert_column(obs_type, raw_columns[obs_type], unit_systems, unit)
+            else:
+                columns[obs_type] = [None] * len(timestamps)
+        return DayColumns(timestamps, columns)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def timestamp_column(self):
+        return self.timestamps
+
+    def column(self, obs_type):
+        return self.columns[obs_type]
+
+    def series(self, obs_types, required=None):
+        """A list of [time, value, ...] for each record. If required is given, records without a value for
+        that observation type are left out."""
+        value_columns = [self.columns[obs_type] for obs_type in obs_types]
+        if required is None:
+            return [[self.times[i]] + [column[i] for column in value_columns] for i in range(len(self.times))]
+        required_column = self.columns[required]
+        return [[self.times[i]] + [column[i] for column in value_columns]
+                for i in range(len(self.times)) if required_column[i] is not None]
+
+
+def convert_column(obs_type, values, unit_systems, target_unit):
+    """Convert a column of values, in the unit systems of their records, to the target unit. The archive
+    almost always has a single unit system, so this is normally a single conversion of the whole column."""
+    if not values:
+        return []
+
+    converted = [None] * len(values)
+    for unit_system in set(unit_systems):
+        indexes = [i for i in range(len(values)) if unit_systems[i] == unit_system]
+        (from_unit, unit_group) = weewx.units.getStandardUnitType(unit_system, obs_type)
+        from_values = [values[i] for i in indexes]
+        if from_unit == target_unit:
+            to_values = from_values
+        else:
+            to_values = weewx.units.convert((from_values, from_unit, unit_group), target_unit)[0]
+        for i, value in zip(indexes, to_values):
+            if value is not None:
+                value = round(value, VALUE_DECIMALS)
+            converted[i] = value
+    return converted
+
+
+def convert_value(obs_type, value, unit_system, target_unit):
+    """Convert a single value, in the unit system of its record, to the target unit"""
+    if value is None:
+        return None
+    (from_unit, unit_group) = weewx.units.getStandardUnitType(unit_system, obs_type)
+    if from_unit != target_unit:
+        value = weewx.units.convert((value, from_unit, unit_group), target_unit)[0]
+    return round(value, VALUE_DECIMALS)
+
+
+class RollingDay(object):
+    """The records for the last time_length seconds, held in memory as rows of timestamp, time and values in
+    the units we publish. New records are appended at the end, and expired records dropped from the start."""
+
+    def __init__(self, time_length, obs_units=OBS_UNITS):
+        self.time_length = time_length
+        self.obs_units = obs_units
+        self.rows = collections.deque()
+
+    @staticmethod
+    def from_archive(dbmanager, stop_ts, time_length, obs_units=OBS_UNITS):
+        """Fill the day from the archive, as it stands at stop_ts"""
+        rolling_day = RollingDay(time_length, obs_units)
+        day = DayColumns.from_archive(dbmanager, stop_ts - time_length, stop_ts, obs_units)
+        for i in range(len(day)):
+            values = dict((obs_type, day.columns[obs_type][i]) for (obs_type, unit) in obs_units)
+            rolling_day.rows.append((day.timestamps[i], day.times[i], values))
+        return rolling_day
+
+    def __len__(self):
+        return len(self.rows)
+
+    def last_timestamp(self):
+        return self.rows[-1][0] if self.rows else None
+
+    def timestamp_column(self):
+        return [ts for (ts, time_string, values) in self.rows]
+
+    def column(self, obs_type):
+        return [values[obs_type] for (ts, time_string, values) in self.rows]
+
+    def add_record(self, record):
+        """Append an archive record, and drop the records that are now more than time_length old. Returns
+        False if the record is no newer than the last one we have."""
+        ts = record['dateTime']
+        last_ts = self.last_timestamp()
+        if last_ts is not None and ts <= last_ts:
+            return False
+
+        values = dict((obs_type, convert_value(obs_type, record.get(obs_type), record['usUnits'], unit))
+                      for (obs_type, unit) in self.obs_units)
+        self.rows.append((ts, json_time(ts), values))
+
+        start_ts = ts - self.time_length
+        while self.rows and self.rows[0][0] <= start_ts:
+            self.rows.popleft()
+        return True
+
+    def series(self, obs_types, required=None):
+        """A list of [time, value, ...] for each record. If required is given, records without a value for
+        that observation type are left out."""
+        return [[time_string] + [values[obs_type] for obs_type in obs_types]
+                for (ts, time_string, values) in self.rows
+                if required is None or values[required] is not None]
+
+
+def columnar_json(day, latest):
+    """The day in the columnar format: the times as a start, interval and deltas, and a column of values,
+    rounded to display precision, for each observation type"""
+    timestamps = day.timestamp_column()
+    deltas = [timestamps[i] - timestamps[i - 1] for i in range(1, len(timestamps))]
+    interval = collections.Counter(deltas).most_common(1)[0][0] if deltas else None
+
+    document = {
+        'start': timestamps[0] if timestamps else None,
+        'interval': interval,
+        'count': len(timestamps),
+        'latestArchiveRecord': latest,
+    }
+    if any(delta != interval for delta in deltas):
+        document['dt'] = deltas
+    for obs_type, decimals in DISPLAY_DECIMALS.items():
+        document[obs_type] = [display_value(value, decimals) for value in day.column(obs_type)]
+    return json.dumps(document, separators=(',', ':'))
+
+
+def display_value(value, decimals):
+    if value is None:
+        return None
+    if decimals == 0:
+        return int(round(value))
+    return round(value, decimals)
+
+
+def write_day_files(html_root, day, latest, columnar=False, precompress=()):
+    """Write the day JSON files from the day's series, and the latest record as formatted by
+    format_latest_record. Returns the number of files written, not counting the pre-compressed copies."""
+    # encode each series once, and reuse it in every file it appears in
+    wind_json = json.dumps(day.series(['windSpeed', 'windGust', 'windDir'], required='windDir'))
+    pressure_json = json.dumps(day.series(['barometer'], required='barometer'))
+    out_temp_json = json.dumps(day.series(['outTemp'], required='outTemp'))
+    in_temp_json = json.dumps(day.series(['inTemp'], required='inTemp'))
+    temps_json = json.dumps(day.series(['outTemp', 'inTemp']))
+    latest_json = json.dumps(latest)
+
+    files = [
+        ('day.json', '{"latestArchiveRecord":%s,\n"dayWindData":%s,\n"dayPressureData":%s,\n"dayOutTemp":%s,\n"dayInTemp":%s}\n' % (
+            latest_json, wind_json, pressure_json, out_temp_json, in_temp_json)),
+        ('day-wind.json', '{"dayWindData":%s}\n' % wind_json),
+        ('day-temp.json', '{"dayOutTempData":%s}\n' % temps_json),
+        ('day-pressure.json', '{"dayPressureData":%s}\n' % pressure_json),
+    ]
+    if columnar:
+        files.append(('day-columns.json', columnar_json(day, latest) + '\n'))
+    for file_name, content in files:
+        write_file_atomically(os.path.join(html_root, file_name), content, precompress)
+    return len(files)
+
+
+def format_latest_record(record, skin_dict):
+    """The latest archive record, formatted with the skin's units and labels, as $current was in day.json"""
+    if record is None:
+        return {}
+
+    formatter = weewx.units.Formatter.fromSkinDict(skin_dict)
+    converter = weewx.units.Converter.fromSkinDict(skin_dict)
+
+    def value_helper(obs_type):
+        value_t = weewx.units.as_value_tuple(record, obs_type)
+        return weewx.units.ValueHelper(value_t, 'current', formatter, converter)
+
+    return {
+        'dateTime': json_time(record['dateTime']),
+        'outsideTemperature': unicode(value_helper('outTemp')),
+        'windSpeed': unicode(value_helper('windSpeed')),
+        'windDirection': unicode(value_helper('windDir')),
+        'windDirectionOrdinal': unicode(value_helper('windDir').ordinal_compass()),
+        'windGust': unicode(value_helper('windGust')),
+        'pressure': unicode(value_helper('barometer')),
+    }
+
+
+class JsonGenerator(weewx.reportengine.ReportGenerator):
+    """Writes the day JSON files from a single query of the archive"""
+
+    def run(self):
+        t1 = time.time()
+        json_dict = self.skin_dict.get('JsonGenerator', {})
+        data_binding = json_dict.get('data_binding', 'wx_binding')
+        time_length = to_int(json_dict.get('time_length', 86400))
+        columnar = to_bool(json_dict.get('columnar', False))
+        precompress = precompress_option(json_dict.get('precompress'))
+        html_root = os.path.join(self.config_dict['WEEWX_ROOT'], self.skin_dict['HTML_ROOT'])
+
+        dbmanager = self.db_binder.get_manager(data_binding)
+        stop_ts = self.gen_ts if self.gen_ts else dbmanager.lastGoodStamp()
+        if stop_ts is None:
+            syslog.syslog(syslog.LOG_INFO, "jsonreports: No records in the archive")
+            return
+
+        day = DayColumns.from_archive(dbmanager, stop_ts - time_length, stop_ts)
+        latest = format_latest_record(dbmanager.getRecord(stop_ts), self.skin_dict)
+        number_files = write_day_files(html_root, day, latest, columnar, precompress)
+
+        t2 = time.time()
+        syslog.syslog(syslog.LOG_INFO, "jsonreports: Generated %d files from %d records in %.2f seconds" % (
+            number_files, len(day), t2 - t1))
+
+
+class RollingDayJson(StdService):
+    """Keeps the day in memory, and writes the day JSON files on each new archive record"""
+
+    def __init__(self, engine, config_dict):
+        super(RollingDayJson, self).__init__(engine, config_dict)
+
+        rolling_dict = config_dict.get('RollingDayJson', {})
+        self.data_binding = rolling_dict.get('data_binding', 'wx_binding')
+        self.time_length = to_int(rolling_dict.get('time_length', 86400))
+        self.columnar = to_bool(rolling_dict.get('columnar', False))
+        self.precompress = precompress_option(rolling_dict.get('precompress'))
+        report = rolling_dict.get('report', 'StandardReport')
+
+        self.skin_dict = load_skin_dict(config_dict, report)
+        html_root = rolling_dict.get('html_root', self.skin_dict.get('HTML_ROOT',
+                                                                      config_dict['StdReport']['HTML_ROOT']))
+        self.html_root = os.path.join(config_dict['WEEWX_ROOT'], html_root)
+
+        # filled from the archive on the first archive record
+        self.day = None
+
+        syslog.syslog(syslog.LOG_INFO, "jsonreports: RollingDayJson will write to %s" % self.html_root)
+        self.bind(weewx.NEW_ARCHIVE_RECORD, self.new_archive_record)
+
+    def new_archive_record(self, event):
+        # an error here must not reach the engine, or it stops archiving
+        try:
+            self.update_day(event.record)
+        except Exception, e:
+            syslog.syslog(syslog.LOG_ERR, "jsonreports: Unable to update the day files: %s: %s" % (type(e).__name__, e))
+            # the day may be half updated, so read it from the archive again with the next record
+            self.day = None
+
+    def update_day(self, record):
+        t1 = time.time()
+        if self.day is None:
+            dbmanager = self.engine.db_binder.get_manager(self.data_binding)
+            self.day = RollingDay.from_archive(dbmanager, record['dateTime'], self.time_length)
+            syslog.syslog(syslog.LOG_INFO, "jsonreports: Read %d records from the archive" % len(self.day))
+        self.day.add_record(record)
+
+        try:
+            number_files = write_day_files(self.html_root, self.day, format_latest_record(record, self.skin_dict),
+                                           self.columnar, self.precompress)
+        except (IOError, OSError), e:
+            syslog.syslog(syslog.LOG_ERR, "jsonreports: Unable to write the day files: %s" % e)
+            return
+
+        t2 = time.time()
+        syslog.syslog(syslog.LOG_DEBUG, "jsonreports: Wrote %d files from %d records in %.3f seconds" % (
+            number_files, len(self.day), t2 - t1))
+
+
+def load_skin_dict(config_dict, report):
+    """The skin dictionary of the report, with the report's overrides from weewx.conf, as the report engine
+    builds it. If the skin can't be read, the latest record is formatted with the defaults."""
+    report_dict = config_dict['StdReport'].get(report, {})
+    skin_config_path = os.path.join(config_dict['WEEWX_ROOT'], config_dict['StdReport']['SKIN_ROOT'],
+                                    report_dict.get('skin', 'Standard'), 'skin.conf')
+    try:
+        skin_dict = configobj.ConfigObj(skin_config_path, file_error=True)
+    except (IOError, SyntaxError), e:
+        syslog.syslog(syslog.LOG_ERR, "jsonreports: Unable to read skin configuration file %s: %s" % (
+            skin_config_path, e))
+        skin_dict = configobj.ConfigObj()
+    skin_dict.merge(report_dict)
+    return skin_dict
+
+
+def compare_formats(repeats=200):
+    """Compare the size and parse time of day.json and day-columns.json, for a synthetic day of five minute
+    records that drift as the weather does, so that they compress about as well as the real thing"""
+    import random
+    import timeit
+
+    rng = random.Random(1)
+    day = RollingDay(86400)
+    wind_speed, wind_dir, barometer, out_temp, in_temp = 10.0, 200.0, 29.9, 50.0, 65.0
+    start_ts = 1500000000
+    for i in range(288):
+        wind_speed = max(0.0, wind_speed + rng.gauss(0, 1))
+        wind_dir = (wind_dir + rng.gauss(0, 10)) % 360
+        barometer += rng.gauss(0, 0.005)
+        out_temp += rng.gauss(0, 0.3)
+        in_temp += rng.gauss(0, 0.1)
+        day.add_record({'dateTime': start_ts + i * 300, 'usUnits': weewx.US, 'windSpeed': wind_speed,
+                        'windGust': wind_speed + abs(rng.gauss(0, 5)), 'windDir': wind_dir, 'barometer': barometer,
+                        'outTemp': out_temp, 'inTemp': in_temp})
+
+    html_root = tempfile.mkdtemp()
+    write_day_files(html_root, day, {}, columnar=True)
+    print "%-18s %8s %8s %8s %10s" % ('file', 'bytes', 'gzip', 'brotli', 'parse ms')
+    for file_name in ['day.json', 'day-columns.json']:
+        with open(os.path.join(html_root, file_name)) as f:
+            content = f.read()
+        parse_seconds = min(timeit.repeat(lambda: json.loads(content), number=repeats, repeat=3)) / repeats
+        print "%-18s %8d %8d %8s %10.3f" % (file_name, len(content), len(compress(content, 'gzip')),
+                                            len(compress(content, 'brotli')) if brotli else '-',
+                                            parse_seconds * 1000)
+    shutil.rmtree(html_root)
+
+
+if __name__ == '__main__':
+    compare_formats()
@@ -12,9 +12,20 @@ import memcache
 import json
 import datetime
 import Queue
+import socket
 import threading
 import syslog
-from weeutil.weeutil import to_int, to_float, to_bool, timestamp_to_string, accumulateLeaves
+import time
+import os
+import math
+import struct
+import collections
+import hashlib
+import email.utils
+import BaseHTTPServer
+import SocketServer
+from weeutil.weeutil import to_int, to_float, to_bool, timestamp_to_string, accumulateLeaves, startOfDay, \
+    startOfArchiveDay
 
 
 """
@@ -71,7 +82,7 @@ To output the label for the units,
 To use this service, add the following to your configuration file
 weewx.conf:
 	
-The cache_key = the key that this service will use when writing the JSON document to the memcache server
+The cache_key = the start of the keys that this service will use when writing the JSON document to the memcache server
 obs_type = list of observation types that the service will include in the JSON document
 output_formats = corresponding list of output formats, using the dot format for output described in the WeeWx
 	documentation at http://www.weewx.com/docs/customizing.htm#customizing_templates. The first . is not needed.
@@ -86,6 +97,138 @@ output_formats = corresponding list of output formats, using the dot format for
 In this example, we are outputing wind speed, wind gust, wind direction, outside
 temperature and pressure. We also always output the current date and time as dateTime.
 
+The service can also serve the JSON document itself, over HTTP, straight from
+memory, so that browsers don't need to go through PHP and memcache:
+
+[MemcacheJson]
+  ...
+  # the port to serve the document on. If not given, there is no HTTP server
+  http_port = 14581
+  # the address to listen on. The default is all addresses
+  http_address = 0.0.0.0
+  # how long, in seconds, browsers may cache the document. The default is the
+  # loop_interval of the station, or 2 seconds
+  http_max_age = 2
+  # the Access-Control-Allow-Origin header, so that pages on other sites can
+  # fetch the document. The default is *
+  http_allow_origin = *
+
+The document is at any path, e.g. http://hillheadsc.dyndns.biz:14581/current_weather.json
+It is sent with a weak ETag and a Last-Modified header, and a poll with
+If-None-Match or If-Modified-Since gets a 304 Not Modified if the observations
+haven't changed. The ETag leaves out seq, dateTime and timestamp, which change
+with every LOOP packet, so a browser polling in a lull doesn't fetch the same
+readings again. Connections are kept alive, so a browser polling every few
+seconds doesn't open a new connection each time.
+
+The document is written to memcache under three keys:
+
+current_weather:v2            - the document, which expires ttl seconds after
+                                it was written, so a reader that finds it
+                                knows it is fresh
+current_weather:v2:last       - the same document, which expires stale_ttl
+                                seconds after it was written, so a reader that
+                                only finds this knows it is stale, and how old
+                                it is from its dateTime
+current_weather:v2:heartbeat  - "seq dateTime", which expires with the
+                                document, for a cheap check that the feed is
+                                alive
+
+A reader gets current_weather:v2 and current_weather:v2:last in one round trip
+with a multi-get, and knows whether the data is fresh, stale or missing. The
+document has the dateTime of the LOOP packet, and seq, which goes up by one
+with every document published since weewx started. The v2 in each key name is
+the version of the document. It changes when the document does, so that a
+reader never gets a document it doesn't understand from before an upgrade.
+
+[MemcacheJson]
+  ...
+  # how long, in seconds, the document is fresh for. The default is four
+  # times the loop_interval of the station, and at least 10 seconds
+  ttl = 10
+  # how long, in seconds, the last document is kept. The default is 3600
+  stale_ttl = 3600
+
+Machine readers, such as the display boards and the racing app, can read a
+compact binary form of the observations instead, under its own key, which
+expires with the document:
+
+current_weather:bin:v1        - 29 bytes, little endian, struct format <BII5f:
+                                the version (1), seq, the dateTime, then the
+                                wind speed and gust in m/s, the wind direction
+                                in degrees, the outside temperature in degrees
+                                C and the pressure in mbar, as 32 bit floats.
+                                A missing value is NaN.
+
+decode_binary() in this module decodes it. When the layout changes, the version
+changes, in the data and in the key name. To write it:
+
+[MemcacheJson]
+  ...
+  binary = true
+
+To compare the size and the encode and decode time of the two, run this
+module on the weewx host. The JSON encode time is format_record's, with weewx's
+own unit conversion and formatting, so it is only meaningful with the weewx
+that the feed runs under on the path:
+
+PYTHONPATH=bin python bin/user/livefeed.py
+
+The document also has today's extremes, with the times they happened, and the
+change in pressure over the last three hours. They are kept up to date from
+every LOOP packet and archive record, and start again at local midnight, so
+they are as up to date as the current values, without waiting for a report:
+
+"today": {"windGustMax": {"value": "35", "unit_label": "knots",
+                          "time": "2016-04-17T14:05:12"},
+          "windSpeedMax": ..., "outTempMin": ..., "outTempMax": ...,
+          "pressureMin": ..., "pressureMax": ...},
+"pressureTrend": {"value": "+1.2", "unit_label": "mbar", "hours": 3,
+                  "description": "Rising slowly"}
+
+The pressure trend is only there once we have an archive record from three
+hours ago.
+
+Before they are published, or go into today's extremes, the values in the LOOP
+packets pass through quality control, which rejects:
+
+- values outside the range the sensor can read
+- spikes, values further from the median of the last 15 than the wind or
+  weather can explain, by the median absolute deviation
+- temperatures and pressures changing faster than the weather can change them
+
+A missing or rejected value is replaced by the last good one for up to qc_hold
+seconds. The document has "qc": the number of values rejected since weewx
+started, and the age in seconds of any value being held:
+
+"qc": {"rejected": {"windGust": 3}, "held": {"outTemp": 4.0}}
+
+[MemcacheJson]
+  ...
+  # quality control. The default is true
+  qc = true
+  # how long to hold the last good value for, in seconds. The default is 60
+  qc_hold = 60
+
+So that there is something to publish as soon as weewx restarts, rather than
+nothing until the first LOOP packet, the service can save the document to a
+snapshot file as it publishes it:
+
+[MemcacheJson]
+  ...
+  # the snapshot file. If not given, there is no snapshot
+  snapshot_file = /var/lib/weewx/livefeed_snapshot.json
+  # save the snapshot at most this often, in seconds. The default is 60
+  snapshot_interval = 60
+
+The snapshot has today's extremes and the recent pressures too, so they carry
+on across a restart. It is also saved when weewx shuts down. When weewx starts, the
+document in the snapshot is published straight away, with two more fields:
+"stale": true, and "age", the number of seconds since it was published. In
+memcache it only goes under current_weather:v2:last, so readers of
+current_weather:v2 and the heartbeat don't take it as live. The next LOOP packet
+replaces it.
+
 
 
 
@@ -105,6 +248,61 @@ configuration option "report_services", located in sub-section [Engine][[Service
 ********************************************************************************
 """
 
+# the version of the document, in the names of the keys it is written under
+DOCUMENT_VERSION = 2
+
+# the binary form: the version, seq, dateTime and the values of BINARY_FIELDS, in their units
+BINARY_VERSION = 1
+BINARY_STRUCT = struct.Struct('<BII5f')
+BINARY_FIELDS = [
+    ('windSpeed', 'meter_per_second'),
+    ('windGust', 'meter_per_second'),
+    ('windDir', 'degree_compass'),
+    ('outTemp', 'degree_C'),
+    ('pressure', 'mbar'),
+]
+
+# the quality control of each observation type, in the US units of the LOOP packets: the minimum and maximum, the
+# fastest change per second, how many median absolute deviations from the median a spike is, and the smallest
+# median absolute deviation we use. Wind is gusty, so only a very big jump in it is a spike. The wind direction
+# wraps around, so it is only checked for range.
+QC_LIMITS = {
+    'windSpeed': (0, 150, None, 10, 2.0),
+    'windGust': (0, 200, None, 10, 3.0),
+    'windDir': (0, 360, None, None, None),
+    'outTemp': (-40, 130, 1.0, 6, 0.5),
+    'pressure': (25.0, 32.5, 0.01, 6, 0.02),
+}
+
+# the number of values in each quality control window, and how often we log what it has rejected
+QC_WINDOW = 15
+QC_REPORT_SECONDS = 3600
+
+# the extremes we keep for today: the name in the document, the observation type, and whether a value is a new
+# extreme, given the extreme so far
+DAILY_EXTREMES = {
+    'windGustMax': ('windGust', lambda value, extreme: value > extreme),
+    'windSpeedMax': ('windSpeed', lambda value, extreme: value > extreme),
+    'outTempMin': ('outTemp', lambda value, extreme: value < extreme),
+    'outTempMax': ('outTemp', lambda value, extreme: value > extreme),
+    'pressureMin': ('pressure', lambda value, extreme: value < extreme),
+    'pressureMax': ('pressure', lambda value, extreme: value > extreme),
+}
+
+# the pressure trend is over three hours, from the archive record nearest three hours ago, if there is one within
+# PRESSURE_TREND_TOLERANCE seconds
+PRESSURE_TREND_SECONDS = 3 * 3600
+PRESSURE_TREND_TOLERANCE = 900
+
+# the pressure tendencies: up to a change in mbar, rising and falling
+PRESSURE_TENDENCIES = [
+    (0.1, None, None),
+    (1.6, 'Rising slowly', 'Falling slowly'),
+    (3.6, 'Rising', 'Falling'),
+    (6.1, 'Rising quickly', 'Falling quickly'),
+    (float('inf'), 'Rising very rapidly', 'Falling very rapidly'),
+]
+
 # for examples of python memcache
 # http://stackoverflow.com/questions/868690/good-examples-of-python-memcache-memcached-being-used-in-python
 #
@@ -121,6 +319,10 @@ class MemcacheJson(StdService):
     def shutDown(self):
         """Shut down any threads"""
         
+        if self.http_server:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+
         """Function to shut down a thread."""
         if self.loop_queue and self.loop_thread.isAlive():
             # Put a None in the queue to signal the thread to shutdown
@@ -136,11 +338,33 @@ class MemcacheJson(StdService):
     def __init__(self, engine, config_dict):
         super(MemcacheJson, self).__init__(engine, config_dict)
         self.loop_queue = Queue.Queue()
-        self.poster = MemcacheJsonPoster(engine,config_dict,self.loop_queue)
+        self.live_document = LiveDocument()
+        self.poster = MemcacheJsonPoster(engine,config_dict,self.loop_queue,self.live_document)
         self.loop_thread = threading.Thread(target=self.poster.run) 
         self.loop_thread.start()
+
+        self.http_server = None
+        memcache_dict = config_dict['MemcacheJson']
+        if 'http_port' in memcache_dict:
+            self.start_http_server(config_dict, memcache_dict)
         self.bind(weewx.NEW_LOOP_PACKET, self.new_loop_packet)
+        self.bind(weewx.NEW_ARCHIVE_RECORD, self.new_archive_record)
         
+    def start_http_server(self, config_dict, memcache_dict):
+        # browsers may cache the document until the next LOOP packet is due
+        max_age = to_int(memcache_dict.get('http_max_age', round(station_loop_interval(config_dict))))
+        address = (memcache_dict.get('http_address', ''), to_int(memcache_dict['http_port']))
+        try:
+            self.http_server = CurrentWeatherServer(address, self.live_document, max_age,
+                                                    memcache_dict.get('http_allow_origin', '*'))
+        except socket.error, e:
+            syslog.syslog(syslog.LOG_ERR, "MemcacheJson: Unable to serve HTTP on port %s: %s" % (address[1], e))
+            return
+        http_thread = threading.Thread(target=self.http_server.serve_forever, name="MemcacheJsonHTTP")
+        http_thread.daemon = True
+        http_thread.start()
+        syslog.syslog(syslog.LOG_INFO, "MemcacheJson: Serving HTTP on port %s" % address[1])
+
     def new_loop_packet(self, event):
     	  # TO-DO
         # if there is anything on the queue, remove it because we only want to update the 
@@ -148,19 +372,45 @@ class MemcacheJson(StdService):
         # should not cause a problem with the loop thread
         
         self.loop_queue.put(event)
+
+    def new_archive_record(self, event):
+        # the poster thread adds it to the daily stats
+        self.loop_queue.put(event)
           
 		             
         
              
 class MemcacheJsonPoster():
 
-    def __init__(self,engine, config_dict,loop_queue):
+    def __init__(self,engine, config_dict,loop_queue,live_document=None):
 
         self.memcache_server = config_dict['MemcacheJson']['memcache_server']
         self.obs_types = config_dict['MemcacheJson']['obs_types']
         self.cache_key = config_dict['MemcacheJson']['cache_key']
         self.log_success = True
         self.queue = loop_queue
+        self.live_document = live_document
+
+        # the keys we write, and how long they last
+        self.document_key = '%s:v%d' % (self.cache_key, DOCUMENT_VERSION)
+        self.last_key = '%s:v%d:last' % (self.cache_key, DOCUMENT_VERSION)
+        self.heartbeat_key = '%s:v%d:heartbeat' % (self.cache_key, DOCUMENT_VERSION)
+        self.ttl = to_int(config_dict['MemcacheJson'].get('ttl',
+                                                          max(10, int(math.ceil(4 * station_loop_interval(config_dict))))))
+        self.stale_ttl = to_int(config_dict['MemcacheJson'].get('stale_ttl', 3600))
+        # the number of documents we have published
+        self.seq = 0
+        self.daily_stats = DailyStats()
+        self.quality_control = QualityControl(to_int(config_dict['MemcacheJson'].get('qc_hold', 60))) if to_bool(
+            config_dict['MemcacheJson'].get('qc', True)) else None
+        self.binary_key = '%s:bin:v%d' % (self.cache_key, BINARY_VERSION) if to_bool(
+            config_dict['MemcacheJson'].get('binary', False)) else None
+
+        self.snapshot_file = config_dict['MemcacheJson'].get('snapshot_file')
+        self.snapshot_interval = to_int(config_dict['MemcacheJson'].get('snapshot_interval', 60))
+        self.snapshot_time = 0
+        # the last document we published, and when
+        self.published = None
         
 		  # figure out what our input units must be. This is a one off, as our input units won't change.
         self.obs_type_input_units = dict([ (obs_type, weewx.units.getStandardUnitType(weewx.US, obs_type)) for obs_type in self.obs_types])
@@ -181,6 +431,7 @@ class MemcacheJsonPoster():
             else:
             	 syslog.syslog(syslog.LOG_INFO, "MemcacheJson: Unable to connect to memcache server %s." % self.memcache_server)
             
+            self.publish_snapshot()
             self.run_loop()
         
     def createMemcacheConnection(self):
@@ -198,6 +449,7 @@ class MemcacheJsonPoster():
                 # A None record is our signal to exit:
                 if _record is None:
                     syslog.syslog(syslog.LOG_INFO, "MemcacheJson: Disconnecting from memcache server %s ." % self.memcache_server)
+                    self.save_snapshot(force=True)
                     try:
                         self.mc.disconnect_all()
                     finally:
@@ -219,12 +471,17 @@ class MemcacheJsonPoster():
                         # we limit the rate of retrying.
                         
                         
-                            if self.mc:
+                            if _record.event_type == weewx.NEW_ARCHIVE_RECORD:
+                                # archive records only update the daily stats, the next LOOP packet publishes them
+                                self.daily_stats.add_archive_record(self.check_archive_record(_record.record))
+                            elif self.mc:
                                 success = self.process_record(_record)
                                 if not success:
                                     syslog.syslog(syslog.LOG_ERR, "MemcacheJson: Lost connection to memcache server %s ." % self.memcache_server)	
                                     self.mc = None
                             else:
+                                # keep the HTTP document up to date while memcache is away
+                                self.publish_live(self.format_record(self.check_packet(_record)))
                                 self.mc = self.createMemcacheConnection()	
                             
                         # TO-Do - catch a memcache unavailable exception, 
@@ -244,6 +501,93 @@ class MemcacheJsonPoster():
     
     def process_record(self, event):
         """Write the  LOOP packet to memcache"""
+        event = self.check_packet(event)
+        json_string = self.format_record(event)
+        self.publish_live(json_string)
+        binary = encode_binary(event.packet, self.seq) if self.binary_key else None
+        return self.set_cache(json_string, self.seq, event.packet.get('dateTime'), binary)
+
+    def check_packet(self, event):
+        """Pass the LOOP packet through quality control, if it is on, and add it to the daily stats. Returns an
+        event with the packet as we publish it. The event is weewx's, so we don't change it."""
+        if self.quality_control is not None:
+            event = weewx.Event(event.event_type, packet=self.quality_control.filter_packet(event.packet))
+        self.daily_stats.add_packet(event.packet)
+        return event
+
+    def check_archive_record(self, record):
+        """The archive record without the values quality control would reject. weewx works out the gust in the
+        record from the LOOP packets, so a spike in them is in the record too."""
+        if self.quality_control is None:
+            return record
+        return self.quality_control.filter_record(record)
+
+    def set_cache(self, json_string, seq, date_time, binary=None):
+        """Write the document, the heartbeat and the binary form, which expire together, in one round trip, then
+        the last document. Returns False if memcache didn't take the document."""
+        values = {self.document_key: json_string, self.heartbeat_key: '%d %s' % (seq, date_time)}
+        if binary is not None:
+            values[self.binary_key] = binary
+        failed_keys = self.mc.set_multi(values, time=self.ttl)
+        self.mc.set(self.last_key, json_string, time=self.stale_ttl)
+        return self.document_key not in failed_keys
+
+    def publish_live(self, json_string):
+        if self.live_document is not None:
+            self.live_document.update(json_string)
+        self.published = (json_string, time.time())
+        self.save_snapshot()
+
+    def save_snapshot(self, force=False):
+        """Save the last document we published to the snapshot file, at most every snapshot_interval seconds.
+        The file is written to a temporary file and renamed, so a crash never leaves half a snapshot."""
+        if not self.snapshot_file or self.published is None:
+            return
+        now = time.time()
+        if not force and now - self.snapshot_time < self.snapshot_interval:
+            return
+        self.snapshot_time = now
+
+        json_string, published_time = self.published
+        tmp_file = self.snapshot_file + '.tmp'
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump({'publishedTime': published_time, 'document': json_string,
+                           'dailyStats': self.daily_stats.state()}, f)
+            os.rename(tmp_file, self.snapshot_file)
+        except (IOError, OSError), e:
+            syslog.syslog(syslog.LOG_ERR, "MemcacheJson: Unable to save snapshot %s: %s" % (self.snapshot_file, e))
+
+    def publish_snapshot(self):
+        """Publish the document in the snapshot, marked as stale, so there is something to publish until the
+        first LOOP packet"""
+        if not self.snapshot_file or not os.path.exists(self.snapshot_file):
+            return
+        try:
+            with open(self.snapshot_file) as f:
+                snapshot = json.load(f)
+            document = json.loads(snapshot['document'])
+            age = max(0, int(time.time() - snapshot['publishedTime']))
+            if 'dailyStats' in snapshot:
+                self.daily_stats.restore(snapshot['dailyStats'])
+        except (IOError, ValueError, KeyError, TypeError), e:
+            syslog.syslog(syslog.LOG_ERR, "MemcacheJson: Unable to read snapshot %s: %s" % (self.snapshot_file, e))
+            return
+
+        document['stale'] = True
+        document['age'] = age
+        json_string = json.dumps(document)
+        if self.live_document is not None:
+            self.live_document.update(json_string)
+        # the snapshot is stale, so it only goes in the last key. Readers take the fresh key, and the heartbeat,
+        # to mean the feed is alive. It expires when it would have if we had never stopped.
+        stale_ttl = self.stale_ttl - age
+        if self.mc and stale_ttl > 0 and not self.mc.set(self.last_key, json_string, time=stale_ttl):
+            syslog.syslog(syslog.LOG_ERR, "MemcacheJson: Unable to publish snapshot to memcache server %s ." % self.memcache_server)
+        syslog.syslog(syslog.LOG_INFO, "MemcacheJson: Published snapshot from %d seconds ago" % age)
+
+    def format_record(self, event):
+        """Format the LOOP packet as the JSON document"""
         # we should really put this into a separate thread with a queue to keep it all tidy
 
         # as of weewx 3.8.2, if there is no reading for an observation type then it doesn't appear in the event packet
@@ -269,29 +613,13 @@ class MemcacheJsonPoster():
            }
 
         
+        self.seq += 1
         filtered_output = {}
         filtered_output['timestamp'] = datetime.datetime.now().isoformat()
+        filtered_output['dateTime'] = event.packet.get('dateTime')
+        filtered_output['seq'] = self.seq
         for obs_type in filtered_packet.viewkeys():
-            value_helper = weewx.units.ValueHelper(filtered_packet_value_tuples[obs_type])
-            
-            # hard coded conversion and formatting
-            if obs_type == 'windSpeed':
-            	output_value = value_helper.knot.nolabel("%0.f")
-            	unit_label = 'knots'
-            elif obs_type == 'windGust':
-            	output_value = value_helper.knot.nolabel("%0.f")
-            	unit_label = 'knots'
-            elif obs_type=='windDir':
-               output_value = value_helper.ordinal_compass()
-               unit_label = ''
-            elif obs_type=='outTemp':
-            	output_value = value_helper.degree_C.format("%0.f")
-            	unit_label = ''
-            elif obs_type=='pressure':
-            	output_value = value_helper.mbar.nolabel("%0.f")
-            	unit_label = 'mbar'
-            else:
-            	output_value = str(value_helper)
+            output_value, unit_label = self.format_value(obs_type, filtered_packet_value_tuples[obs_type])
             observation_output = {
                 'value':output_value,
                 'unit_label':unit_label
@@ -306,8 +634,392 @@ class MemcacheJsonPoster():
             else:
                 filtered_output[obs_type] = "N/A"
 
-        json_string = json.dumps(filtered_output)
-        return self.mc.set(self.cache_key,json_string)
-        
-    
-   
+        filtered_output.update(self.format_daily_stats())
+        if self.quality_control is not None:
+            filtered_output['qc'] = self.quality_control.summary()
+        return json.dumps(filtered_output)
+
+    def format_value(self, obs_type, value_tuple):
+        """The value, converted and formatted for the document, and its unit label"""
+        value_helper = weewx.units.ValueHelper(value_tuple)
+
+        # hard coded conversion and formatting
+        if obs_type in ('windSpeed', 'windGust'):
+            return value_helper.knot.nolabel("%0.f"), 'knots'
+        elif obs_type == 'windDir':
+            return value_helper.ordinal_compass(), ''
+        elif obs_type == 'outTemp':
+            return value_helper.degree_C.format("%0.f"), ''
+        elif obs_type == 'pressure':
+            return value_helper.mbar.nolabel("%0.f"), 'mbar'
+        else:
+            return str(value_helper), ''
+
+    def format_daily_stats(self):
+        """Today's extremes, with their times, and the pressure trend, for the document"""
+        today = {}
+        for name, (value, ts) in self.daily_stats.extremes.items():
+            obs_type = DAILY_EXTREMES[name][0]
+            (unit, unit_group) = weewx.units.getStandardUnitType(weewx.US, obs_type)
+            output_value, unit_label = self.format_value(obs_type, (value, unit, unit_group))
+            today[name] = {'value': output_value, 'unit_label': unit_label,
+                           'time': datetime.datetime.fromtimestamp(ts).isoformat()}
+        output = {'today': today}
+
+        change = self.daily_stats.pressure_change()
+        if change is not None:
+            (unit, unit_group) = weewx.units.getStandardUnitType(weewx.US, 'pressure')
+            change_mbar = weewx.units.convert((change, unit, unit_group), 'mbar')[0]
+            output['pressureTrend'] = {'value': "%+.1f" % change_mbar, 'unit_label': 'mbar',
+                                       'hours': PRESSURE_TREND_SECONDS // 3600,
+                                       'description': pressure_tendency(change_mbar)}
+        return output
+
+
+class ObservationFilter(object):
+    """Quality control of one observation type, over the last QC_WINDOW values"""
+
+    def __init__(self, obs_type, hold_seconds):
+        self.obs_type = obs_type
+        (self.minimum, self.maximum, self.max_rate, self.spike_mads, self.min_mad) = QC_LIMITS[obs_type]
+        self.hold_seconds = hold_seconds
+        self.window = collections.deque(maxlen=QC_WINDOW)
+        self.last_good = None
+        self.rejected = 0
+
+    def is_spike(self, value):
+        """Whether the value is further from the median of the window than spike_mads times the median absolute
+        deviation, scaled to a standard deviation, which is never taken as less than min_mad"""
+        if self.spike_mads is None or len(self.window) < QC_WINDOW // 2:
+            return False
+        ordered = sorted(self.window)
+        median = ordered[len(ordered) // 2]
+        deviations = sorted([abs(x - median) for x in ordered])
+        mad = max(1.4826 * deviations[len(deviations) // 2], self.min_mad)
+        return abs(value - median) > self.spike_mads * mad
+
+    def is_good(self, value, ts):
+        """Check a value, and add it to the window if it is in range, so that the median follows a lasting change
+        and only a short burst is rejected as a spike"""
+        if value < self.minimum or value > self.maximum:
+            return False
+        spike = self.is_spike(value)
+        self.window.append(value)
+        if spike:
+            return False
+        # as time passes since the last good value, a bigger change is allowed, so a lasting change gets through
+        if self.max_rate is not None and self.last_good is not None and ts > self.last_good[1]:
+            if abs(value - self.last_good[0]) / (ts - self.last_good[1]) > self.max_rate:
+                return False
+        return True
+
+    def filter(self, value, ts):
+        """The value to publish and its age in seconds, or None if there is nothing good to publish. A missing or
+        rejected value is replaced by the last good value, for up to hold_seconds."""
+        if value is not None:
+            if self.is_good(value, ts):
+                self.last_good = (value, ts)
+                return value, 0
+            self.rejected += 1
+        if self.last_good is not None and ts - self.last_good[1] <= self.hold_seconds:
+            return self.last_good[0], ts - self.last_good[1]
+        return None, None
+
+    def check(self, value):
+        """Whether a value from an archive record passes the range and spike checks, without adding it to the
+        window"""
+        return self.minimum <= value <= self.maximum and not self.is_spike(value)
+
+
+class QualityControl(object):
+    """Streaming quality control of the LOOP packets: values out of range, spikes and changes faster than the
+    weather can make are rejected, and a missing or rejected value is held at the last good one for a while"""
+
+    def __init__(self, hold_seconds=60):
+        self.filters = dict((obs_type, ObservationFilter(obs_type, hold_seconds)) for obs_type in QC_LIMITS)
+        # the age of each value we are holding
+        self.held = {}
+        self.report_time = time.time()
+
+    def filter_packet(self, packet):
+        """A copy of the packet with the values to publish"""
+        filtered = dict(packet)
+        ts = packet['dateTime']
+        self.held = {}
+        for obs_type, observation_filter in self.filters.items():
+            value, age = observation_filter.filter(packet.get(obs_type), ts)
+            if value is None:
+                filtered.pop(obs_type, None)
+            else:
+                filtered[obs_type] = value
+                if age:
+                    self.held[obs_type] = age
+        self.log_rejected()
+        return filtered
+
+    def filter_record(self, record):
+        filtered = dict(record)
+        for obs_type, observation_filter in self.filters.items():
+            if filtered.get(obs_type) is not None and not observation_filter.check(filtered[obs_type]):
+                observation_filter.rejected += 1
+                del filtered[obs_type]
+        return filtered
+
+    def summary(self):
+        """The number of values rejected since weewx started, and the age of the values being held"""
+        return {'rejected': dict((obs_type, observation_filter.rejected)
+                                 for obs_type, observation_filter in self.filters.items() if observation_filter.rejected),
+                'held': self.held}
+
+    def log_rejected(self):
+        if time.time() - self.report_time < QC_REPORT_SECONDS:
+            return
+        self.report_time = time.time()
+        rejected = self.summary()['rejected']
+        if rejected:
+            syslog.syslog(syslog.LOG_INFO, "MemcacheJson: Quality control has rejected %s" % ", ".join(
+                ["%d %s" % (count, obs_type) for obs_type, count in sorted(rejected.items())]))
+
+
+class DailyStats(object):
+    """Today's extremes and their times, from the LOOP packets and archive records, and the recent pressure, for
+    the trend. The values are in the units of the packets."""
+
+    def __init__(self):
+        self.day_start = None
+        # the name of each extreme, as in DAILY_EXTREMES, to its value and time
+        self.extremes = {}
+        # the (dateTime, pressure) of the archive records, for the last PRESSURE_TREND_SECONDS and a bit
+        self.pressure_history = collections.deque()
+        self.latest_pressure = None
+
+    def add_packet(self, packet, day_start=None):
+        ts = packet['dateTime']
+        if day_start is None:
+            day_start = startOfDay(ts)
+        if self.day_start is None or day_start > self.day_start:
+            # a new day
+            self.day_start = day_start
+            self.extremes = {}
+        elif day_start < self.day_start:
+            # a late archive record from yesterday
+            return
+
+        for name, (obs_type, better) in DAILY_EXTREMES.items():
+            value = packet.get(obs_type)
+            if value is None:
+                continue
+            extreme = self.extremes.get(name)
+            if extreme is None or better(value, extreme[0]):
+                self.extremes[name] = (value, ts)
+
+        if packet.get('pressure') is not None and (self.latest_pressure is None or ts >= self.latest_pressure[0]):
+            self.latest_pressure = (ts, packet['pressure'])
+
+    def add_archive_record(self, record):
+        # an archive record stamped at midnight belongs to the day before
+        self.add_packet(record, startOfArchiveDay(record['dateTime']))
+        if record.get('pressure') is not None:
+            self.pressure_history.append((record['dateTime'], record['pressure']))
+        while self.pressure_history and \
+                self.pressure_history[0][0] < record['dateTime'] - PRESSURE_TREND_SECONDS - PRESSURE_TREND_TOLERANCE:
+            self.pressure_history.popleft()
+
+    def pressure_change(self):
+        """The change in pressure over the last PRESSURE_TREND_SECONDS, or None if we don't have a pressure
+        from then"""
+        if self.latest_pressure is None:
+            return None
+        latest_ts, latest_pressure = self.latest_pressure
+        then_ts = latest_ts - PRESSURE_TREND_SECONDS
+        earlier = [(ts, pressure) for (ts, pressure) in self.pressure_history if ts <= then_ts]
+        if not earlier or then_ts - earlier[-1][0] > PRESSURE_TREND_TOLERANCE:
+            return None
+        return latest_pressure - earlier[-1][1]
+
+    def state(self):
+        return {'dayStart': self.day_start, 'extremes': self.extremes,
+                'pressureHistory': list(self.pressure_history), 'latestPressure': self.latest_pressure}
+
+    def restore(self, state):
+        self.day_start = state['dayStart']
+        self.extremes = dict((name, tuple(extreme)) for name, extreme in state['extremes'].items()
+                             if name in DAILY_EXTREMES)
+        self.pressure_history = collections.deque(tuple(entry) for entry in state['pressureHistory'])
+        self.latest_pressure = tuple(state['latestPressure']) if state['latestPressure'] else None
+
+
+def pressure_tendency(change_mbar):
+    """Describe a three hour change in pressure, as the Met Office does in the shipping forecast"""
+    for limit, rising, falling in PRESSURE_TENDENCIES:
+        if abs(change_mbar) < limit:
+            break
+    if rising is None:
+        return 'Steady'
+    return rising if change_mbar > 0 else falling
+
+
+def encode_binary(packet, seq):
+    """The binary form of a LOOP packet"""
+    unit_system = packet.get('usUnits', weewx.US)
+    values = []
+    for obs_type, unit in BINARY_FIELDS:
+        value = packet.get(obs_type)
+        if value is None:
+            values.append(float('nan'))
+            continue
+        (from_unit, unit_group) = weewx.units.getStandardUnitType(unit_system, obs_type)
+        if from_unit != unit:
+            value = weewx.units.convert((value, from_unit, unit_group), unit)[0]
+        values.append(value)
+    return BINARY_STRUCT.pack(BINARY_VERSION, seq, int(packet.get('dateTime') or 0), *values)
+
+
+def decode_binary(data):
+    """Decode the binary form into a dictionary of version, seq, dateTime and the observations, with None for
+    a missing value"""
+    if not data or ord(data[0]) != BINARY_VERSION or len(data) != BINARY_STRUCT.size:
+        raise ValueError("not version %d of the binary form" % BINARY_VERSION)
+    fields = BINARY_STRUCT.unpack(data)
+    decoded = {'version': fields[0], 'seq': fields[1], 'dateTime': fields[2]}
+    for (obs_type, unit), value in zip(BINARY_FIELDS, fields[3:]):
+        decoded[obs_type] = None if value != value else value
+    return decoded
+
+
+def station_loop_interval(config_dict):
+    """The seconds between LOOP packets, from the station's section of weewx.conf, or 2 if it doesn't say, which
+    is about right for a Vantage"""
+    station_dict = config_dict.get(config_dict['Station'].get('station_type'), {})
+    return to_float(station_dict.get('loop_interval', 2))
+
+
+class LiveDocument(object):
+    """The latest JSON document, and the headers we serve it with. The poster thread replaces the tuple whole, so
+    an HTTP thread always sees a document with its own headers."""
+
+    # the fields that change with every LOOP packet, which the ETag leaves out
+    PACKET_FIELDS = ('seq', 'dateTime', 'timestamp')
+
+    def __init__(self):
+        self.current = None
+
+    def update(self, json_string):
+        observations = dict((key, value) for key, value in json.loads(json_string).items()
+                            if key not in self.PACKET_FIELDS)
+        # weak, as the document we send has the latest seq and timestamp, although the observations are the same
+        etag = 'W/"%s"' % hashlib.sha1(json.dumps(observations, sort_keys=True)).hexdigest()[:20]
+        now = int(time.time())
+        if self.current is not None and self.current[1] == etag:
+            # the same observations, so they keep their Last-Modified
+            self.current = (json_string,) + self.current[1:]
+            return
+        # Last-Modified is to the second, so if the observations changed more than once this second, a browser
+        # with the last ones has the same If-Modified-Since as one with these
+        exact_second = self.current is None or self.current[3] != now
+        self.current = (json_string, etag, email.utils.formatdate(now, usegmt=True), now, exact_second)
+
+
+class CurrentWeatherHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the latest JSON document, or 304 Not Modified if the browser already has it"""
+
+    # so that browsers can keep the connection open between polls
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_document(True)
+
+    def do_HEAD(self):
+        self.send_document(False)
+
+    def send_document(self, send_body):
+        document = self.server.live_document.current
+        if document is None:
+            self.send_response(503)
+            self.send_header('Retry-After', str(self.server.max_age or 1))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        json_string, etag, last_modified, modified_ts, exact_second = document
+        not_modified = self.is_not_modified(etag, modified_ts, exact_second)
+        self.send_response(304 if not_modified else 200)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.send_header('Cache-Control', 'max-age=%d' % self.server.max_age)
+        if self.server.allow_origin:
+            self.send_header('Access-Control-Allow-Origin', self.server.allow_origin)
+        if not_modified:
+            self.end_headers()
+            return
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(json_string)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(json_string)
+
+    def is_not_modified(self, etag, modified_ts, exact_second):
+        # If-None-Match takes precedence over If-Modified-Since, as in RFC 7232
+        if_none_match = self.headers.getheader('If-None-Match')
+        if if_none_match is not None:
+            # a weak comparison, as our ETags are weak
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or etag[2:] in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+        if_modified_since = self.headers.getheader('If-Modified-Since')
+        if if_modified_since is not None:
+            since = email.utils.parsedate_tz(if_modified_since)
+            if since is None:
+                return False
+            since = email.utils.mktime_tz(since)
+            return since > modified_ts or (since == modified_ts and exact_second)
+        return False
+
+    def log_message(self, format, *args):
+        # a request every few seconds from every browser is too much for syslog
+        pass
+
+
+class CurrentWeatherServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A thread for each connection, so a slow browser doesn't hold up the others"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+    # every browser with the page open polls, so allow more than the default of 5 waiting connections
+    request_queue_size = 64
+
+    def __init__(self, server_address, live_document, max_age, allow_origin):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, CurrentWeatherHandler)
+        self.live_document = live_document
+        self.max_age = max_age
+        self.allow_origin = allow_origin
+
+
+def compare_encodings(repeats=20000):
+    """Compare the size and the encode and decode time of the JSON document and the binary form, for a typical
+    LOOP packet. The JSON is encoded by format_record, as the poster does, so the time includes weewx's
+    ValueHelper formatting and the daily stats."""
+    import timeit
+
+    config_dict = {'Station': {}, 'MemcacheJson': {'memcache_server': None, 'cache_key': 'current_weather',
+                                                   'obs_types': [obs_type for obs_type, unit in BINARY_FIELDS]}}
+    poster = MemcacheJsonPoster(None, config_dict, None)
+
+    class Event(object):
+        packet = {'dateTime': int(time.time()), 'usUnits': weewx.US, 'windSpeed': 14.2, 'windGust': 21.7,
+                  'windDir': 228.0, 'outTemp': 54.3, 'pressure': 29.92}
+    event = Event()
+    json_string = poster.format_record(event)
+    binary = encode_binary(event.packet, 1)
+
+    def microseconds(function):
+        return min(timeit.repeat(function, number=repeats, repeat=3)) / repeats * 1e6
+
+    print "%-8s %8s %12s %12s" % ('form', 'bytes', 'encode us', 'decode us')
+    print "%-8s %8d %12.1f %12.1f" % ('json', len(json_string), microseconds(lambda: poster.format_record(event)),
+                                      microseconds(lambda: json.loads(json_string)))
+    print "%-8s %8d %12.1f %12.1f" % ('binary', len(binary), microseconds(lambda: encode_binary(event.packet, 1)),
+                                      microseconds(lambda: decode_binary(binary)))
+
+
+if __name__ == '__main__':
+    compare_encodings()
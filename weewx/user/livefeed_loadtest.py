@@ -0,0 +1,269 @@
+#==============================================================================
+#                    livefeed_loadtest.py
+#
+# Load test of the live feed HTTP server against the PHP and memcache path
+#
+#==============================================================================
+import sys
+import time
+import json
+import datetime
+import socket
+import random
+import getopt
+import httplib
+import threading
+import multiprocessing
+import BaseHTTPServer
+import SocketServer
+
+from user.livefeed import LiveDocument, CurrentWeatherServer
+
+
+"""
+Polls the current weather document as the club web site's update-live-weather.js does, from many clients at once,
+and reports the requests per second and the p50 and p99 latency of two paths:
+
+php     - the browser asks PHP, which connects to memcache for the document on every request and sends it with
+          Cache-Control: no-cache, as current_weather_with_cache.php does. PHP is stood in for by a small HTTP
+          server, and memcache by a small memcache server, in processes of their own. The stand-in doesn't have the
+          cost of starting PHP for each request, so the real thing is slower.
+
+live    - the browser asks the live feed's HTTP server, which sends the document from memory, and sends the ETag
+          back with If-None-Match, so a document with unchanged observations gets a 304. There is a new document
+          every loop_interval, as there is with LOOP packets, with a new seq and timestamp, and the wind changes
+          by a knot in some of them.
+
+Usage, on the weewx host, from the weewx directory:
+
+PYTHONPATH=bin python bin/user/livefeed_loadtest.py -c [clients, default 50] -d [seconds per path, default 10]
+    -i [seconds between polls for each client, default 0, as fast as possible] -l [loop_interval, default 2]
+"""
+
+# a document like the one the live feed writes
+SAMPLE_DOCUMENT = {
+    "outTemp": {"unit_label": "", "value": u"12\u00b0C"}, "windDir": {"unit_label": "", "value": "SW"},
+    "pressure": {"unit_label": "mbar", "value": "1013"}, "windSpeed": {"unit_label": "knots", "value": "14"},
+    "windGust": {"unit_label": "knots", "value": "21"},
+}
+
+CACHE_KEY = 'current_weather:v2'
+
+# the number of processes the clients are spread over, so that the clients don't wait on each other for the GIL
+CLIENT_PROCESSES = 4
+
+
+def sample_document(loop_interval):
+    """The document for the LOOP packet now. Both paths get the same document for the same packet."""
+    seq = int(time.time() // loop_interval)
+    # the same seq always has the same wind, so the paths agree on when the observations change
+    wind = random.Random(seq)
+    document = dict(SAMPLE_DOCUMENT)
+    document['windSpeed'] = {"unit_label": "knots", "value": str(wind.choice([14, 14, 14, 15]))}
+    document['windGust'] = {"unit_label": "knots", "value": str(wind.choice([21, 21, 21, 22]))}
+    document['timestamp'] = datetime.datetime.now().isoformat()
+    document['dateTime'] = int(seq * loop_interval)
+    document['seq'] = seq
+    return json.dumps(document)
+
+
+class MemcacheStubHandler(SocketServer.StreamRequestHandler):
+    """Answers memcache get commands with the sample document"""
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            if line.startswith('get '):
+                value = sample_document(self.server.loop_interval)
+                self.wfile.write('VALUE %s 0 %d\r\n%s\r\nEND\r\n' % (CACHE_KEY, len(value), value))
+            else:
+                self.wfile.write('ERROR\r\n')
+
+
+class PhpStubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Connects to memcache for every request, as PHP does, and sends the document uncached"""
+
+    def do_GET(self):
+        connection = socket.create_connection(self.server.memcache_address)
+        try:
+            connection.sendall('get %s\r\n' % CACHE_KEY)
+            reply = ''
+            while not reply.endswith('END\r\n'):
+                data = connection.recv(4096)
+                if not data:
+                    break
+                reply += data
+        finally:
+            connection.close()
+        value = reply.split('\r\n')[1]
+
+        self.send_response(200)
+        self.send_header('Cache-Control', 'no-cache, must-revalidate')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(value)))
+        self.end_headers()
+        self.wfile.write(value)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    # the same backlog as the live feed, so that we are comparing the paths, not the listen queues
+    request_queue_size = CurrentWeatherServer.request_queue_size
+
+
+class ThreadingTCPServer(SocketServer.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = CurrentWeatherServer.request_queue_size
+
+
+def serve_memcache_stub(port, loop_interval):
+    server = ThreadingTCPServer(('127.0.0.1', port), MemcacheStubHandler)
+    server.loop_interval = loop_interval
+    server.serve_forever()
+
+
+def serve_php_stub(port, memcache_port):
+    server = ThreadingServer(('127.0.0.1', port), PhpStubHandler)
+    server.memcache_address = ('127.0.0.1', memcache_port)
+    server.serve_forever()
+
+
+def serve_live(port, loop_interval):
+    live_document = LiveDocument()
+    live_document.update(sample_document(loop_interval))
+    server = CurrentWeatherServer(('127.0.0.1', port), live_document, int(round(loop_interval)), '*')
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    # a new document every loop_interval, as the LOOP packets arrive
+    while True:
+        time.sleep(loop_interval - time.time() % loop_interval)
+        live_document.update(sample_document(loop_interval))
+
+
+def poll(port, conditional, stop_time, poll_interval, latencies, statuses):
+    """One client. Poll until stop_time, keeping the connection open if the server lets us."""
+    # browsers open the page at different times, so spread the first polls over the interval
+    time.sleep(random.random() * poll_interval)
+    connection = httplib.HTTPConnection('127.0.0.1', port)
+    etag = None
+    while time.time() < stop_time:
+        headers = {}
+        if conditional and etag:
+            headers['If-None-Match'] = etag
+        t1 = time.time()
+        try:
+            connection.request('GET', '/current_weather.json', headers=headers)
+            response = connection.getresponse()
+            response.read()
+        except (socket.error, httplib.HTTPException):
+            statuses['error'] = statuses.get('error', 0) + 1
+            connection.close()
+            continue
+        latencies.append(time.time() - t1)
+        statuses[response.status] = statuses.get(response.status, 0) + 1
+        etag = response.getheader('ETag', etag)
+        if poll_interval:
+            time.sleep(poll_interval)
+    connection.close()
+
+
+def client_process(port, conditional, number_clients, stop_time, poll_interval, results):
+    latencies = []
+    statuses = {}
+    clients = [threading.Thread(target=poll, args=(port, conditional, stop_time, poll_interval, latencies, statuses))
+               for client in range(number_clients)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    results.put((latencies, statuses))
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[int(round(fraction * (len(sorted_values) - 1)))]
+
+
+def load_test(port, conditional, number_clients, duration, poll_interval):
+    results = multiprocessing.Queue()
+    stop_time = time.time() + duration
+    processes = [multiprocessing.Process(target=client_process,
+                                         args=(port, conditional, number_clients // CLIENT_PROCESSES + (
+                                             1 if i < number_clients % CLIENT_PROCESSES else 0),
+                                               stop_time, poll_interval, results))
+                 for i in range(CLIENT_PROCESSES)]
+    for process in processes:
+        process.start()
+
+    latencies = []
+    statuses = {}
+    for process in processes:
+        process_latencies, process_statuses = results.get()
+        latencies.extend(process_latencies)
+        for status, count in process_statuses.items():
+            statuses[str(status)] = statuses.get(str(status), 0) + count
+    for process in processes:
+        process.join()
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'requestsPerSecond': len(latencies) / float(duration),
+        'p50LatencyMs': percentile(latencies, 0.50) * 1000 if latencies else None,
+        'p99LatencyMs': percentile(latencies, 0.99) * 1000 if latencies else None,
+        'statuses': statuses,
+    }
+
+
+def main():
+    number_clients = 50
+    duration = 10
+    poll_interval = 0
+    loop_interval = 2.0
+
+    options, args = getopt.getopt(sys.argv[1:], "c:d:i:l:", ["clients=", "duration=", "interval=", "loop="])
+    for option, value in options:
+        if option in ('-c', '--clients'):
+            number_clients = int(value)
+        elif option in ('-d', '--duration'):
+            duration = float(value)
+        elif option in ('-i', '--interval'):
+            poll_interval = float(value)
+        elif option in ('-l', '--loop'):
+            loop_interval = float(value)
+
+    memcache_port, php_port, live_port = 21211, 28080, 28081
+    servers = [
+        multiprocessing.Process(target=serve_memcache_stub, args=(memcache_port, loop_interval)),
+        multiprocessing.Process(target=serve_php_stub, args=(php_port, memcache_port)),
+        multiprocessing.Process(target=serve_live, args=(live_port, loop_interval)),
+    ]
+    for server in servers:
+        server.daemon = True
+        server.start()
+    time.sleep(0.5)
+
+    report = {
+        'clients': number_clients,
+        'durationSeconds': duration,
+        'pollIntervalSeconds': poll_interval,
+        'loopIntervalSeconds': loop_interval,
+        'php': load_test(php_port, False, number_clients, duration, poll_interval),
+        'live': load_test(live_port, True, number_clients, duration, poll_interval),
+    }
+    for server in servers:
+        server.terminate()
+    print json.dumps(report, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+#==============================================================================
+#                    rollups.py
+#
+# Keeps hourly and daily rollups of the archive, and writes the week, month
+# and year JSON files for the Google Charts pages from them
+#
+#==============================================================================
+import os
+import math
+import time
+import json
+import syslog
+
+import weedb
+import weewx
+from weewx.engine import StdService
+from weeutil.weeutil import to_int, startOfInterval, startOfArchiveDay
+
+from user.downsample import downsample_indexes
+from user.jsonreports import OBS_UNITS, DISPLAY_DECIMALS, json_time, convert_value, write_file_atomically, \
+    precompress_option
+
+
+"""
+Service that keeps hourly and daily rollups of the archive, in two tables next to the archive table, and writes
+the week, month and year JSON files for the Google Charts pages from them:
+
+week-wind.json, week-temp.json, week-pressure.json      - hourly, for the last 7 days
+month-wind.json, month-temp.json, month-pressure.json   - hourly, for the last 31 days
+year-wind.json, year-temp.json, year-pressure.json      - daily, for the last 366 days
+
+Reading a month or a year of five minute records for each report, as $span(...).records does, is far too slow.
+Instead, each new archive record is added to the row for its hour in rollup_hour and its day in rollup_day, and the
+files are written from a few hundred rows.
+
+For wind speed, outside and inside temperature and pressure, each row has the minimum, maximum, sum and count, so the
+mean is sum / count. For the wind direction it has the sums of the wind vectors, for the vector mean direction, and
+for the gusts, the maximum. The values are stored in the units we publish: knots, degrees C and mbar. The rows are
+stamped with the start of their hour or day, in local time.
+
+The files are in the same style as day-wind.json, day-temp.json and day-pressure.json, with the period start as the
+time:
+
+{"weekWindData": [[time, mean wind speed, maximum gust, vector mean wind direction], ...]}
+{"weekTempData": [[time, mean outside temperature, mean inside temperature, minimum outside, maximum outside], ...]}
+{"weekPressureData": [[time, mean pressure, minimum pressure, maximum pressure], ...]}
+
+and likewise month and year. As in the day files, a period without a wind direction or pressure is left out of the
+wind or pressure series.
+
+A series longer than max_points is downsampled, with the functions in downsample.py. The means are downsampled with
+Largest-Triangle-Three-Buckets, which keeps their shape, and the maximum gust and the minimum and maximum temperature
+and pressure with an envelope, which keeps the peaks. Each series in a file gets an equal share of max_points, and
+the file keeps every period any of them picked.
+
+The first time the service sees an archive record, it creates the tables if they don't exist, and adds the records
+in the archive it hasn't seen yet, going back at most backfill_days. After that, it only adds the new record.
+
+********************************************************************************
+
+To use this service, add it to the archive_services in weewx.conf, after StdArchive:
+
+[Engine]
+    [[Services]]
+        archive_services = weewx.engine.StdArchive, user.rollups.Rollups
+
+and, optionally, configure it in weewx.conf:
+
+[Rollups]
+    # The binding for the archive. The rollup tables go in the same database. The default is wx_binding
+    data_binding = wx_binding
+    # How far back to fill the tables from the archive, when they are first created. The default is 366
+    backfill_days = 366
+    # The most points to write in a series. Longer series are downsampled. 0 for no limit. The default is 300
+    max_points = 300
+    # Where to write the files. The default is the HTML_ROOT of [StdReport]
+    html_root = /var/www/html/weewx
+    # Write pre-compressed copies of the files, gzip and/or brotli. The default is none
+    precompress = gzip
+
+********************************************************************************
+"""
+
+# the observation types we keep the minimum, maximum and mean of
+SCALAR_TYPES = ['windSpeed', 'outTemp', 'inTemp', 'barometer']
+
+# the columns of the rollup tables
+ROLLUP_COLUMNS = ['dateTime', 'lastTime', 'count'] + \
+    ['%s_%s' % (obs_type, aggregate) for obs_type in SCALAR_TYPES for aggregate in ('min', 'max', 'sum', 'count')] + \
+    ['windGust_max', 'wind_xsum', 'wind_ysum', 'wind_dircount']
+
+# the files we write: the name, the rollup table and the length of the span in seconds
+ROLLUP_FILES = [
+    ('week', 'rollup_hour', 7 * 86400),
+    ('month', 'rollup_hour', 31 * 86400),
+    ('year', 'rollup_day', 366 * 86400),
+]
+
+
+def new_row(start_ts):
+    row = dict((column, None) for column in ROLLUP_COLUMNS)
+    row.update({'dateTime': start_ts, 'count': 0, 'wind_xsum': 0.0, 'wind_ysum': 0.0, 'wind_dircount': 0})
+    for obs_type in SCALAR_TYPES:
+        row[obs_type + '_sum'] = 0.0
+        row[obs_type + '_count'] = 0
+    return row
+
+
+def accumulate(row, ts, values):
+    """Add the values of an archive record, in the units we publish, to a rollup row"""
+    row['count'] += 1
+    row['lastTime'] = ts
+    for obs_type in SCALAR_TYPES:
+        value = values[obs_type]
+        if value is not None:
+            row[obs_type + '_min'] = value if row[obs_type + '_min'] is None else min(row[obs_type + '_min'], value)
+            row[obs_type + '_max'] = value if row[obs_type + '_max'] is None else max(row[obs_type + '_max'], value)
+            row[obs_type + '_sum'] += value
+            row[obs_type + '_count'] += 1
+
+    if values['windGust'] is not None:
+        row['windGust_max'] = values['windGust'] if row['windGust_max'] is None else max(row['windGust_max'],
+                                                                                          values['windGust'])
+    if values['windSpeed'] is not None and values['windDir'] is not None:
+        row['wind_xsum'] += values['windSpeed'] * math.sin(math.radians(values['windDir']))
+        row['wind_ysum'] += values['windSpeed'] * math.cos(math.radians(values['windDir']))
+        row['wind_dircount'] += 1
+
+
+def mean(row, obs_type):
+    count = row[obs_type + '_count']
+    return row[obs_type + '_sum'] / count if count else None
+
+
+def vector_direction(row):
+    """The direction of the mean wind vector, or None if there was no wind direction, or no wind"""
+    if not row['wind_dircount'] or (row['wind_xsum'] == 0 and row['wind_ysum'] == 0):
+        return None
+    return math.degrees(math.atan2(row['wind_xsum'], row['wind_ysum'])) % 360
+
+
+def display(value, obs_type):
+    if value is None:
+        return None
+    return round(value, DISPLAY_DECIMALS[obs_type])
+
+
+# the series we write for each span: the file suffix, the name of the data, the column a row must have a non zero
+# value in to be included, and the columns after the time. Each column is the function that gets its value from a
+# rollup row, its observation type, and how to downsample it, or None if it goes along with the others.
+ROLLUP_SERIES = [
+    ('wind', 'Wind', 'wind_dircount', [
+        (lambda row: mean(row, 'windSpeed'), 'windSpeed', 'lttb'),
+        (lambda row: row['windGust_max'], 'windGust', 'max'),
+        (vector_direction, 'windDir', None),
+    ]),
+    ('temp', 'Temp', None, [
+        (lambda row: mean(row, 'outTemp'), 'outTemp', 'lttb'),
+        (lambda row: mean(row, 'inTemp'), 'inTemp', 'lttb'),
+        (lambda row: row['outTemp_min'], 'outTemp', 'min'),
+        (lambda row: row['outTemp_max'], 'outTemp', 'max'),
+    ]),
+    ('pressure', 'Pressure', 'barometer_count', [
+        (lambda row: mean(row, 'barometer'), 'barometer', 'lttb'),
+        (lambda row: row['barometer_min'], 'barometer', 'min'),
+        (lambda row: row['barometer_max'], 'barometer', 'max'),
+    ]),
+]
+
+
+class RollupTable(object):
+    """A rollup table, and the row for the period we are adding records to"""
+
+    def __init__(self, dbmanager, table_name, start_of_period):
+        self.dbmanager = dbmanager
+        self.connection = dbmanager.connection
+        self.table_name = table_name
+        self.start_of_period = start_of_period
+        self.row = None
+
+    def create(self):
+        if self.table_name in self.connection.tables():
+            return
+        columns = ['dateTime INTEGER NOT NULL PRIMARY KEY', 'lastTime INTEGER', 'count INTEGER']
+        for column in ROLLUP_COLUMNS[3:]:
+            columns.append('%s %s' % (column, 'INTEGER' if column.endswith('count') else 'REAL'))
+        with weedb.Transaction(self.connection) as cursor:
+            cursor.execute("CREATE TABLE %s (%s)" % (self.table_name, ", ".join(columns)))
+        syslog.syslog(syslog.LOG_INFO, "rollups: Created table %s" % self.table_name)
+
+    def last_time(self):
+        return self.dbmanager.getSql("SELECT MAX(lastTime) FROM %s" % self.table_name)[0]
+
+    def read_row(self, start_ts):
+        values = self.dbmanager.getSql("SELECT %s FROM %s WHERE dateTime = ?" % (
+            ", ".join(ROLLUP_COLUMNS), self.table_name), (start_ts,))
+        return dict(zip(ROLLUP_COLUMNS, values)) if values else None
+
+    def add(self, ts, values, cursor):
+        """Add an archive record to the row for its period. If it starts a new period, save the row for the
+        last one first. A record the row already has, from before a restart, is left out."""
+        start_ts = self.start_of_period(ts)
+        if self.row is None or self.row['dateTime'] != start_ts:
+            if self.row is not None:
+                self.save(cursor)
+            self.row = self.read_row(start_ts) or new_row(start_ts)
+        if self.row['lastTime'] is not None and ts <= self.row['lastTime']:
+            return
+        accumulate(self.row, ts, values)
+
+    def save(self, cursor):
+        if self.row is None:
+            return
+        cursor.execute("REPLACE INTO %s (%s) VALUES (%s)" % (self.table_name, ", ".join(ROLLUP_COLUMNS),
+                                                              ", ".join(["?"] * len(ROLLUP_COLUMNS))),
+                       [self.row[column] for column in ROLLUP_COLUMNS])
+
+    def rows_since(self, start_ts):
+        return [dict(zip(ROLLUP_COLUMNS, values)) for values in self.dbmanager.genSql(
+            "SELECT %s FROM %s WHERE dateTime >= ? ORDER BY dateTime ASC" % (", ".join(ROLLUP_COLUMNS),
+                                                                             self.table_name), (start_ts,))]
+
+
+class Rollups(StdService):
+    """Adds each new archive record to the hourly and daily rollups, and writes the week, month and year files"""
+
+    def __init__(self, engine, config_dict):
+        super(Rollups, self).__init__(engine, config_dict)
+
+        rollups_dict = config_dict.get('Rollups', {})
+        self.data_binding = rollups_dict.get('data_binding', 'wx_binding')
+        self.backfill_days = to_int(rollups_dict.get('backfill_days', 366))
+        self.max_points = to_int(rollups_dict.get('max_points', 300))
+        self.precompress = precompress_option(rollups_dict.get('precompress'))
+        self.html_root = os.path.join(config_dict['WEEWX_ROOT'],
+                                      rollups_dict.get('html_root', config_dict['StdReport']['HTML_ROOT']))
+
+        # set up on the first archive record
+        self.tables = None
+
+        self.bind(weewx.NEW_ARCHIVE_RECORD, self.new_archive_record)
+
+    def new_archive_record(self, event):
+        t1 = time.time()
+        record = event.record
+        if self.tables is None:
+            self.open_tables(record['dateTime'])
+        else:
+            with weedb.Transaction(self.dbmanager.connection) as cursor:
+                self.add_record(record['dateTime'], record['usUnits'], record, cursor)
+                for table in self.tables.values():
+                    table.save(cursor)
+
+        try:
+            number_files = self.write_files(record['dateTime'])
+        except (IOError, OSError), e:
+            syslog.syslog(syslog.LOG_ERR, "rollups: Unable to write the files: %s" % e)
+            return
+
+        t2 = time.time()
+        syslog.syslog(syslog.LOG_DEBUG, "rollups: Wrote %d files in %.3f seconds" % (number_files, t2 - t1))
+
+    def open_tables(self, stop_ts):
+        """Create the tables if need be, and add the archive records they don't have yet, up to stop_ts"""
+        self.dbmanager = self.engine.db_binder.get_manager(self.data_binding)
+        self.tables = {
+            'rollup_hour': RollupTable(self.dbmanager, 'rollup_hour', lambda ts: startOfInterval(ts, 3600)),
+            'rollup_day': RollupTable(self.dbmanager, 'rollup_day', startOfArchiveDay),
+        }
+        for table in self.tables.values():
+            table.create()
+
+        start_ts = stop_ts - self.backfill_days * 86400
+        last_times = [table.last_time() for table in self.tables.values()]
+        if None not in last_times:
+            start_ts = max(start_ts, min(last_times))
+
+        t1 = time.time()
+        obs_types = [obs_type for (obs_type, unit) in OBS_UNITS if obs_type in self.dbmanager.sqlkeys]
+        sql = "SELECT dateTime, usUnits, %s FROM %s WHERE dateTime > ? AND dateTime <= ? ORDER BY dateTime ASC" % (
+            ", ".join(obs_types), self.dbmanager.table_name)
+        number_records = 0
+        with weedb.Transaction(self.dbmanager.connection) as cursor:
+            for values in self.dbmanager.genSql(sql, (start_ts, stop_ts)):
+                self.add_record(values[0], values[1], dict(zip(obs_types, values[2:])), cursor)
+                number_records += 1
+            for table in self.tables.values():
+                table.save(cursor)
+        syslog.syslog(syslog.LOG_INFO, "rollups: Added %d archive records to the rollups in %.2f seconds" % (
+            number_records, time.time() - t1))
+
+    def add_record(self, ts, unit_system, record, cursor):
+        values = dict((obs_type, convert_value(obs_type, record.get(obs_type), unit_system, unit))
+                      for (obs_type, unit) in OBS_UNITS)
+        for table in self.tables.values():
+            table.add(ts, values, cursor)
+
+    def write_files(self, stop_ts):
+        number_files = 0
+        for name, table_name, time_length in ROLLUP_FILES:
+            rows = self.tables[table_name].rows_since(stop_ts - time_length)
+            files = []
+            for file_suffix, data_name, required, columns in ROLLUP_SERIES:
+                series_rows = [row for row in rows if required is None or row[required]]
+                timestamps = [row['dateTime'] for row in series_rows]
+                values = [[display(value_of(row), obs_type) for row in series_rows]
+                          for (value_of, obs_type, method) in columns]
+                keep = downsample_indexes(timestamps, [(values[i], columns[i][2]) for i in range(len(columns))
+                                                       if columns[i][2]], self.max_points)
+                data = [[json_time(timestamps[i])] + [column[i] for column in values] for i in keep]
+                files.append(('%s-%s.json' % (name, file_suffix),
+                              '{"%s%sData":%s}\n' % (name, data_name, json.dumps(data))))
+            for file_name, content in files:
+                write_file_atomically(os.path.join(self.html_root, file_name), content, self.precompress)
+            number_files += len(files)
+        return number_files